@@ -47,7 +47,7 @@ def fileParser(filename, nbins, timeHist, timeHist_bins, adcHist):
     infile = io.open(filename,  'rb', buffering=0)
     print('file opened')
     
-    p = Parse(infile)
+    p = Parse(infile, follow=True)
     t = h.time_hist()
     adc = h.hist(min = ADC_HIST_MIN, max = ADC_HIST_MAX, nbins = nbins) # adc is 14 bit @ 250Mhz
 
@@ -56,13 +56,16 @@ def fileParser(filename, nbins, timeHist, timeHist_bins, adcHist):
         eventTime = []
         eventPeak = []
         while time.perf_counter() - tic < update_timeout:
-            try:
-                event = p.next()
-                eventTime.append( event.ts/ SAMPLING_RATE)
-                if hasattr(event, 'peak'):
-                    eventPeak.append( event.peak )
-                
-            except StopIteration: # End of file
+            nevents = 0
+            for events in p.iter_batches():
+                nevents += len(events)
+                eventTime.extend( (events['ts'] / SAMPLING_RATE).tolist() )
+                if 'peak' in events.dtype.names:
+                    eventPeak.extend( events['peak'].tolist() )
+                if time.perf_counter() - tic > update_timeout:
+                    break
+            
+            if not nevents: # End of file
                 time.sleep(0.5)
                 break
 
@@ -1,39 +1,220 @@
 #!/usr/bin/env python
 '''ZMQ server for sis3316 config loading and data readout'''
 import os, sys, argparse, json, io, zmq, time
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Pipe
 import sis3316
 #sys.path.append('./tools')
 from tools.conf import conf_load
-from tools.readout import readout_loop, get_iterable, makedirs
+from tools.readout import readout_loop, get_iterable, makedirs, format_link_stats
+from tools.parse import count_events
 
 
 from zmqGlobals import *
 
 
-def readout_process( dev, channels, outfiles ):
-    '''Readout from sis3316. dev should be opened already
+def readout_worker( conn, host, port, maxRetries ):
+    '''Readout process, owns the sis3316 for the whole server lifetime.
+    Executes device commands (zmq messages) received from conn: CONFIG, START, STOP, SHUTDOWN.
+    Sends True to conn when the device is connected (False if it is not), replies to the status monitor itself.
     '''
+    # Report to the status monitor
+    context = zmq.Context()  # the worker's own, do not share zmq contexts between processes
+    status_out = context.socket(zmq.PUSH)
+    status_out.setsockopt(zmq.LINGER, 0)
+    status_out.connect(f"tcp://localhost:{PUSH_SOCKET}")
+    
+    def send(msg):
+        try:
+            status_out.send(msg, zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+    
+    def send_status(link):
+        send(format_link_stats(link).strip().encode())
+    
+    print('Connecting to sis3316...')
+    dev = sis3316.Sis3316_udp(host, port)
+    for i in range(maxRetries):
+        if i == maxRetries -1:
+            print('Max retries reached')
+            conn.send(False)
+            return
+        try:
+            dev.open()
+        except Exception as e:
+            # print(e)
+            print(f'Reponse timeout. Retried {i} times')
+            print('Please check that the sis3316 is turned on...\n')
+            send(b"sis3316 is offline")
+            time.sleep(3)
+        else:
+            if i > 0:
+                print('WARNING: You may need to reload your config file in the GUI!!')
+            break
+    
+    print('connected!')
+    print_device(dev)
+    conn.send(True)
+    send(b"sis3316 is online")
+    
+    # Prepare the device once, a START only clears timestamps and arms
+    scheduler = prepare_device(dev)
+    opts = {'chunk_size': 'auto',  # words per chunk follow the setup cost and the transfer rate, kept between runs
+            'scheduler': scheduler,
+            'pool': sis3316.writer.BufferPool() }  # files are written by a thread, buffers are kept between runs
+    
+    msg = None
+    while True:
+        if msg is None or msg[0] != b'SHUTDOWN':  # or it stopped a run
+            msg = conn.recv()
+        if msg[0] == b'CONFIG':
+            # Expect ['CONFIG', config_filename]
+            try:
+                if len(msg) != 2:
+                    raise ValueError('Invalid command CONFIG format')
+                configFile = msg[1].decode('utf_8')
+                print(f'Loading config file {configFile}...', end='')
+                with open(configFile, 'r') as json_file:
+                    conf_load(dev, json.load(json_file))
+                opts['scheduler'] = prepare_device(dev)
+                print('Done')
+                send(b'Config loaded')
+            except Exception as e:
+                print(e)
+                continue
+        elif msg[0] == b'SHUTDOWN':
+            dev.disarm()
+            dev.close()
+            send(b"sis3316 server closed")
+            return
+        elif msg[0] == b'START' and len(msg) == 3:
+            # Expect [b'START', b'outputFolder', b'[0,1,...]']
+            try:
+                outpath = msg[1].decode('utf_8')
+                channels = eval( msg[2] )
+                    
+            except Exception as e:
+                print(e)
+                send(b"Invalid command START format")
+                print('Invalid command START format')
+                continue
+            
+            try:
+                channels, outfiles = genFileNames(outpath, channels)
+            except FileExistsError as e:
+                print(e)
+                send(b"File exists error")
+                continue
+            except Exception as e:
+                print(e)
+                send(b"Invalid channel number")
+                continue
+            
+            msg = readout_run(dev, conn, channels, outfiles, opts, send, send_status)
+            
+            print('Data collection stopped')
+            print_device(dev)
 
-    # Prepare device
+        elif msg[0] == b'STOP':
+            print("Error: Data collection not started yet")
+            send(b"Cannot stop sis3316 when it hasn't started yet")
+        
+        else:
+            send(b"Invalid command")
+            print('Invalid command received')
+
+
+def prepare_device(dev):
+    '''Set up the device after it is opened or configured, leave it disarmed.
+    Returns a bank scheduler for the configured address thresholds.
+    '''
     if not dev.configure():  # set channel numbers and so on.
         sys.stderr.write('Warning: After configure(), dev.status = false\n')
     dev.disarm()
-    dev.arm()
-    dev.ts_clear()
-    dev.mem_toggle()  # flush the device memory to not to read a large chunk of old data
+    return sis3316.scheduler.BankScheduler(dev)
 
 
+def readout_run( dev, conn, channels, outfiles, opts, send, send_status ):
+    '''Read out a run until STOP (or SHUTDOWN) is received from conn, return that message.
+    On stop the device is disarmed and both banks are read out (within opts['stop_timeout']),
+    then the files are synced to disk and closed, "sis3316 stopped" and the run summary are sent.
+    '''
     # Open files
     files_ = [io.FileIO( name, 'w') for name in outfiles] 
-
-    # Perform readout
-    chunksize = 1024*1024  # how many bytes to request at once
-    opts = {'chunk_size': chunksize/4 }
-    
     destinations = list(zip( get_iterable(channels), get_iterable(files_) ))  # Python3 has changed zip behavior, need to wrap in list()
-    readout_loop(dev, destinations, opts, quiet=False, print_stats=True)
+    
+    # Save readout counters to the run folder when stopped
+    counters = sis3316.counters.RunCounters([ch for ch, f in destinations], 
+            os.path.join(os.path.dirname(outfiles[0]), COUNTERS_FILE))
+    
+    stopped_by = []
+    def stop():
+        while conn.poll():
+            msg = conn.recv()
+            if msg[0] in (b'STOP', b'SHUTDOWN'):
+                stopped_by.append(msg)
+                return True
+            send(b"Invalid command: send STOP first")
+        return False
+    
+    # Start: the device is configured and disarmed already
+    dev.ts_clear()
+    dev.arm(0)  # a new run starts from the beginning of bank 0
+    opts['scheduler'].reset(bank=0)
+    send(b"sis3316 started")
+    os.system('clear')
+    
+    try:
+        readout_loop(dev, destinations, opts, quiet=False, print_stats=True, status=send_status,
+            counters=counters, stop=stop)
+    finally:
+        dev.disarm()  # if the loop has failed before
+        try:
+            opts['pool'].close()  # readout_loop closes it unless it has failed, write what is queued
+        finally:
+            for f in files_:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+    
+    summary = run_summary(dev, [(ch, f.name) for ch, f in destinations])
+    os.system('clear')
+    print(summary)
+    send(b"sis3316 stopped")
+    send(summary.encode())
+    return stopped_by[0] if stopped_by else [b'STOP']
+
 
+def run_summary(dev, outputs):
+    '''Bytes and events written to [(channel, file name), ...], the total and a line per channel.
+    Events are counted by the file size and the first event format.
+    '''
+    lines = []
+    total_bytes, total_events = 0, 0
+    for ch, name in outputs:
+        try:
+            maw_length = dev.channels[ch].group.maw_window
+        except Exception:  # the device is not available, count as without MAW data
+            maw_length = 0
+        nbytes = os.path.getsize(name)
+        events, rest = count_events(name, maw_length)
+        total_bytes += nbytes
+        line = f'ch{ch:02d}: {nbytes} bytes'
+        if events is None:
+            line += ', not ADC data'
+        else:
+            total_events += events
+            line += f', {events} events'
+            if rest:
+                line += f', {rest} bytes of a truncated event'
+        lines.append(line)
+    return '\n'.join([f'Run: {total_bytes} bytes, {total_events} events'] + lines)
+
+
+def print_device(dev):
+    print(f'module id: {dev.id}')
+    print(f'serial: {dev.serno}')
+    print(f'temp: {dev.temp} \u2103')
 
 
 def genFileNames(outpath, channels):
@@ -49,8 +230,7 @@ def genFileNames(outpath, channels):
 
     for x in channels:
         if not 0 <= x <= 15:
-            sys.stderr.write("%d is not a valid channel number!\n" %x)
-            sys.exit()
+            raise ValueError("%d is not a valid channel number!" %x)
     chans = sorted(set(channels)) #deduplicated
 
     # --output
@@ -75,6 +255,13 @@ def main():
     args = parser.parse_args()
 
     print(f'Starting {SERVER_ID} server')
+    
+    # The worker is started before any zmq context exists in this process
+    conn, worker_conn = Pipe()
+    worker = Process( target = readout_worker, 
+                      args = (worker_conn, args.host, args.port, args.maxRetries,))
+    worker.start()
+    
     context = zmq.Context.instance()
     worker_in = context.socket(zmq.DEALER)
     worker_in.setsockopt(zmq.IDENTITY, SERVER_ID)
@@ -85,30 +272,9 @@ def main():
     worker_out.setsockopt(zmq.LINGER,0)  # Don't linger on send()
     worker_out.connect(f"tcp://localhost:{PUSH_SOCKET}")
     
-    print('Connecting to sis3316...')
-    dev = sis3316.Sis3316_udp(args.host, args.port)
-    for i in range(args.maxRetries):
-        if i == args.maxRetries -1:
-            print('Max retries reached')
-            sys.exit()
-        try:
-            dev.open()
-        except Exception as e:
-            # print(e)
-            print(f'Reponse timeout. Retried {i} times')
-            print('Please check that the sis3316 is turned on...\n')
-            worker_out.send(b"sis3316 is offline", zmq.NOBLOCK)
-            time.sleep(3)
-        else:
-            if i > 0:
-                print('WARNING: You may need to reload your config file in the GUI!!')
-            break
-   
-    print('connected!')
-    print(f'module id: {dev.id}')
-    print(f'serial: {dev.serno}')
-    print(f'temp: {dev.temp} \u2103')
-    worker_out.send(b"sis3316 is online")
+    if not conn.recv():  # connected to sis3316
+        worker.join()
+        sys.exit()
 
     
     while True:
@@ -116,72 +282,21 @@ def main():
 
         msg = worker_in.recv_multipart()
         print(f'Received: {msg}')
-        if msg[0] == b'CONFIG' and len(msg) == 2:
-            # Expect ['CONFIG', config_filename]
-            configFile = msg[1].decode('utf_8')
-            print(f'Loading config file {configFile}...', end='')
-            try:
-                with open(configFile, 'r') as json_file:
-                    conf_load(dev, json.load(json_file))
-                print('Done')
-                worker_out.send(b'Config loaded')
-            except Exception as e:
-                print(e)
-                continue
-        elif msg[0] == b'SHUTDOWN':
-            dev.close()
+        if not worker.is_alive():
+            print('Readout worker has exited')
             worker_out.send(b"sis3316 server closed")
-            print('Closing server')
             sys.exit()
-        elif msg[0] == b'PING':
+        
+        if msg[0] == b'PING':
             print('sent PONG')
             worker_out.send(b"PONG")
-        elif msg[0] == b'START' and len(msg) == 3:
-            # Expect [b'START', b'outputFolder', b'[0,1,...]']
-            try:
-                outpath = msg[1].decode('utf_8')
-                channels = eval( msg[2] )
-                    
-            except Exception as e:
-                print(e)
-                worker_out.send(b"Invalid command START format")
-                print('Invalid command START format')
-                continue
-            
-            try:
-                channels, outfiles = genFileNames(outpath, channels)
-            except Exception as e:
-                print(e)
-                worker_out.send(b"File exists error")
-                continue
-
-            
-            process = Process( target = readout_process, 
-                                args = (dev, channels, outfiles,))
-            worker_out.send(b"sis3316 started")
-            os.system('clear')
-            process.start()
-            
-            while process.is_alive():
-                if worker_in.recv() == b'STOP':
-                    process.terminate()
-                    os.system('clear')
-                    worker_out.send(b"sis3316 stopped")
-                else:
-                    worker_out.send(b"Invalid command: send STOP first")
-
-            print('Data collection stopped')
-            print(f'module id: {dev.id}')
-            print(f'serial: {dev.serno}')
-            print(f'temp: {dev.temp} \u2103')
-
-        elif msg[0] == b'STOP':
-            print("Error: Data collection not started yet")
-            worker_out.send(b"Cannot stop sis3316 when it hasn't started yet")
-        
         else:
-            worker_out.send(b"Invalid command")
-            print('Invalid command received')
+            # Device commands are executed by the worker, STOP while it reads out
+            conn.send(msg)
+            if msg[0] == b'SHUTDOWN':
+                worker.join()
+                print('Closing server')
+                sys.exit()
                 
         
     return
@@ -1,6 +1,11 @@
 
-__all__ = ['Sis3316_udp']
+__all__ = ['Sis3316_udp', 'congestion', 'counters', 'framing', 'scheduler', 'writer']
 
 #TODO: check requirements:  abs, 
 
 from .sis3316_udp import Sis3316 as Sis3316_udp
+from . import congestion
+from . import counters
+from . import framing
+from . import scheduler
+from . import writer
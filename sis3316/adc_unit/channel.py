@@ -52,11 +52,8 @@ class Adc_channel(object):
 		self.trig = Adc_trigger(self, self.gid, self.cid)
 		
 		
-	def bank_read(self, bank, dest, wcount, woffset = 0):
-		""" Read channel memory. """
-		if woffset + wcount > const.MEM_BANK_SIZE:
-			raise ValueError("out of channel bound")
-		
+	def bank_address(self, bank, woffset = 0):
+		""" Memory chip index and FIFO address (in words) of the `woffset'-th word of the channel's bank. """
 		if bank != 0 and bank != 1:
 			raise ValueError("bank should be 0 or 1")
 		
@@ -71,7 +68,15 @@ class Adc_channel(object):
 		else:
 			mem_no = 1
 		
-		return self.board.read_fifo(dest, self.gid, mem_no, wcount, woffset)
+		return mem_no, woffset
+	
+	def bank_read(self, bank, dest, wcount, woffset = 0, keep = False):
+		""" Read channel memory. keep: the next read continues from here (see read_fifo). """
+		if woffset + wcount > const.MEM_BANK_SIZE:
+			raise ValueError("out of channel bound")
+		
+		mem_no, woffset = self.bank_address(bank, woffset)
+		return self.board.read_fifo(dest, self.gid, mem_no, wcount, woffset, keep)
 
 
 	def bank_poll(self, bank):
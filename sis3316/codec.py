@@ -0,0 +1,138 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Encoding of requests and decoding of responces of the SIS3316 UDP protocol.
+# All struct formats are compiled once. Requests are packed into a reusable buffer,
+# so an encoded request is valid until the next one is encoded.
+# VME FPGA versions V_3316-2008 and higher put a packet identifier after the command byte.
+
+from struct import Struct
+
+LINK_READ  = 0x10
+LINK_WRITE = 0x11
+VME_READ   = 0x20
+VME_WRITE  = 0x21
+FIFO_READ  = 0x30
+FIFO_WRITE = 0x31
+
+
+class Codec(object):
+    """ Precompiled protocol messages, for up to `read_limit'/`write_limit' VME words per request. """
+
+    def __init__(self, with_pid=True, read_limit=64, write_limit=64):
+        self.with_pid = with_pid
+        p = 'B' if with_pid else ''
+        self.hdr_sz = 3 if with_pid else 2 # command, [pid], status
+        
+        self._link_read = Struct('<B%sI' % p)
+        self._link_read_resp = Struct('<B%sII' % p)
+        self._link_write = Struct('<BII')
+        self._vme_read = [None] + [Struct('<B%sH%dI' % (p, n)) for n in range(1, read_limit + 1)]
+        self._vme_write = [None] + [Struct('<B%sH%dI' % (p, 2*n)) for n in range(1, write_limit + 1)]
+        self._fifo_read = Struct('<B%sHI' % p)
+        self._header = Struct('<B%sB' % p)
+        self._words = [None] + [Struct('<%dI' % n) for n in range(1, max(read_limit, write_limit) + 1)]
+        
+        self._buf = bytearray(self._vme_write[write_limit].size)
+        self._view = memoryview(self._buf)
+        self._msgs = {s: self._view[:s.size] for s in self._vme_read[1:] + self._vme_write[1:]}
+        self._requests = {}
+        self._responces = {}
+        
+        if with_pid: # responces unpack as they are
+            self.header = self._header.unpack_from
+            self.link_read_resp = self._link_read_resp.unpack_from
+    
+    def _encode(self, s, cmd, pid, *args):
+        if self.with_pid:
+            s.pack_into(self._buf, 0, cmd, pid, *args)
+        else:
+            s.pack_into(self._buf, 0, cmd, *args)
+        return self._view[:s.size]
+    
+    # ---- requests, `pid' is ignored by old VME FPGA versions
+    
+    def link_read(self, pid, addr):
+        return self._encode(self._link_read, LINK_READ, pid, addr)
+    
+    def link_write(self, addr, data):
+        self._link_write.pack_into(self._buf, 0, LINK_WRITE, addr, data)
+        return self._view[:self._link_write.size]
+    
+    def vme_read(self, pid, addrlist):
+        """ Read request for 1..read_limit addresses. """
+        n = len(addrlist)
+        s = self._vme_read[n]
+        if self.with_pid:
+            s.pack_into(self._buf, 0, VME_READ, pid, n - 1, *addrlist)
+        else:
+            s.pack_into(self._buf, 0, VME_READ, n - 1, *addrlist)
+        return self._msgs[s]
+    
+    def vme_write(self, pid, admix):
+        """ Write request, admix is [addr1, data1, addr2, data2, ...] for 1..write_limit words. """
+        n = len(admix) // 2
+        s = self._vme_write[n]
+        if self.with_pid:
+            s.pack_into(self._buf, 0, VME_WRITE, pid, n - 1, *admix)
+        else:
+            s.pack_into(self._buf, 0, VME_WRITE, n - 1, *admix)
+        return self._msgs[s]
+    
+    def fifo_read(self, pid, nwords, fifo_addr):
+        return self._encode(self._fifo_read, FIFO_READ, pid, nwords - 1, fifo_addr)
+    
+    # ---- responces, `pid' is None for old VME FPGA versions
+    
+    def header(self, resp):
+        """ (command, pid, status) """
+        if self.with_pid:
+            return self._header.unpack_from(resp)
+        cmd, stat = self._header.unpack_from(resp)
+        return cmd, None, stat
+    
+    def link_read_resp(self, resp):
+        """ (command, pid, addr, data) """
+        if self.with_pid:
+            return self._link_read_resp.unpack_from(resp)
+        cmd, addr, data = self._link_read_resp.unpack_from(resp)
+        return cmd, None, addr, data
+    
+    def words(self, resp, count):
+        """ `count' data words after the header. """
+        return self._words[count].unpack_from(resp, self.hdr_sz)
+    
+    # ---- any other message
+    
+    def request(self, format):
+        """ A Struct for a request body in `format' ('<...', no command byte), with the pid in front. """
+        s = self._requests.get(format)
+        if s is None:
+            if format[:1] != '<':
+                raise ValueError('Request format should start with "<": %r' % format)
+            s = self._requests[format] = Struct('<B' + format[1:] if self.with_pid else format)
+        return s
+    
+    def responce(self, format):
+        """ A Struct for a responce in `format' ('<X...', X is the command), with the pid after the command. """
+        s = self._responces.get(format)
+        if s is None:
+            if format[:1] != '<' or not format[1:2].isalpha():
+                raise ValueError('Responce format should start with "<" and a single item: %r' % format)
+            s = self._responces[format] = Struct(format[:2] + 'B' + format[2:] if self.with_pid else format)
+        return s
@@ -0,0 +1,114 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Congestion control strategies for FIFO reads.
+# A strategy decides how many words to request at once (the window).
+# Sis3316_udp.read_fifo calls start() at the beginning of each read, then one of
+# on_success(), on_loss() or on_congestion() for each request with a sample dict:
+#   time, window [words], rtt [s] (to the first packet, None if nothing came),
+#   duration [s], packets, lost, bytes, rate [bytes/s].
+
+from collections import deque
+
+
+class Window(object):
+    """ Base strategy: a constant window of `limit' words. """
+    window = 0
+
+    def start(self, limit, wmtu):
+        """ A new FIFO read. limit: max words per request, wmtu: words per packet. """
+        self.limit = limit
+        self.wmtu = wmtu
+        self.window = limit
+
+    def on_success(self, sample):
+        """ All packets came with the first request. """
+
+    def on_loss(self, sample):
+        """ Some packets were lost, but it does not look like congestion. """
+
+    def on_congestion(self, sample):
+        """ Nothing came, or many packets were lost in a row. """
+
+    def __repr__(self):
+        return '%s(window=%d)' % (self.__class__.__name__, self.window)
+
+
+class AIMD(Window):
+    """ Additive increase, multiplicative decrease. Starts from the half of the limit for each read. """
+
+    def start(self, limit, wmtu):
+        Window.start(self, limit, wmtu)
+        self.window = limit//2
+        self.wmax = limit//2
+
+    def on_success(self, sample):
+        if self.wmax > self.window: #recovery after congestion
+            self.window += (self.wmax - self.window)//2
+        else:    #probe new maximum
+            self.window = min(self.limit, self.window + self.wmtu + (self.window - self.wmax) )
+
+    def on_congestion(self, sample):
+        self.wmax = self.window
+        self.window = self.window // 2 # Reduce window by 50%
+
+
+class Fixed(Window):
+    """ Always the same window, `size' words (the limit by default). """
+
+    def __init__(self, size=None):
+        self.size = size
+
+    def start(self, limit, wmtu):
+        Window.start(self, limit, wmtu)
+        self.window = min(limit, self.size or limit)
+
+
+class RateRTT(Window):
+    """
+    Delay-based: grows the window by a packet while the transfer rate is close to the best recent one
+    and the round trip time is close to the minimal one, otherwise shrinks it by a packet.
+    The window and history are kept between reads.
+    """
+
+    def __init__(self, history=16, rate_tolerance=0.1, rtt_tolerance=1.0):
+        self.rates = deque(maxlen=history)
+        self.rtts = deque(maxlen=history)
+        self.rate_tolerance = rate_tolerance
+        self.rtt_tolerance = rtt_tolerance
+
+    def start(self, limit, wmtu):
+        window = self.window
+        Window.start(self, limit, wmtu)
+        self.window = min(limit, window or limit//2)
+
+    def on_success(self, sample):
+        self.rates.append(sample['rate'])
+        if sample['rtt'] is not None:
+            self.rtts.append(sample['rtt'])
+
+        rate_ok = sample['rate'] >= max(self.rates) * (1 - self.rate_tolerance)
+        rtt_ok = sample['rtt'] is None or sample['rtt'] <= min(self.rtts) * (1 + self.rtt_tolerance)
+
+        if rate_ok and rtt_ok:
+            self.window = min(self.limit, self.window + self.wmtu)
+        else:
+            self.window = max(self.wmtu, self.window - self.wmtu)
+
+    def on_congestion(self, sample):
+        self.window = max(self.wmtu, self.window * 3//4)
+        self.rates.clear()
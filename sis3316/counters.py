@@ -0,0 +1,105 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Per-channel counters of a readout run, to correct rates for lost data
+# and to see what limits the throughput. The readout loop updates them for every bank,
+# save() writes a table next to the run attribute file.
+
+from datetime import datetime
+from time import time
+
+from .common import const
+
+FIELDS = (
+    'words',          # words read
+    'banks',          # non-empty banks read
+    'full_banks',     # banks which reached the bank size (data after it is lost)
+    'swaps_during_read', # banks swapped while they were read (the data may be inconsistent)
+    'dropped_words',  # words left unread at stop (no time left)
+    'errors',         # other readout failures
+    'retries',        # register request retries
+    'timeouts',       # request timeouts
+    'retransmits',    # FIFO ranges requested again
+    'lost_packets',   # FIFO packets lost on the link
+    )
+
+FULL_BANK = const.MEM_BANK_SIZE // 4 - 1 # the last sample address, words
+
+
+class RunCounters(object):
+    """
+    Counters for each channel in `channels'. Link counters (retries, timeouts, retransmits,
+    lost packets) are taken as differences of the device statistics around a channel readout,
+    the ones which can't be told apart by channel (concurrent readout) go to `shared'.
+    """
+
+    def __init__(self, channels, path=None):
+        """ path: a file to save() to. """
+        self.path = path
+        self.start = datetime.now()
+        self.t_start = time()
+        self.channels = dict((ch, dict.fromkeys(FIELDS, 0)) for ch in channels)
+        self.shared = dict.fromkeys(FIELDS, 0)
+
+    @staticmethod
+    def link(dev):
+        """ A snapshot of device link counters, pass two of them to add_link(). """
+        return {
+            'retries': dev.request_stats['retries'],
+            'timeouts': dev.request_stats['timeouts'],
+            'retransmits': dev.fifo_stats['retransmits'],
+            'lost_packets': dev.fifo_stats['lost'],
+            }
+
+    def add_link(self, chan, before, after):
+        """ Add link counters between two snapshots to the channel (to `shared' if chan is None). """
+        counters = self.shared if chan is None else self.channels[chan]
+        for key, value in after.items():
+            counters[key] += value - before[key]
+
+    def add_bank(self, chan, words, bank_words):
+        """ A bank of the channel was read: `words' of `bank_words' in it. """
+        counters = self.channels[chan]
+        counters['words'] += words
+        if bank_words:
+            counters['banks'] += 1
+        if bank_words >= FULL_BANK:
+            counters['full_banks'] += 1
+
+    def add(self, chan, key, count=1):
+        counters = self.shared if chan is None else self.channels[chan]
+        counters[key] += count
+
+    def total(self):
+        """ Sums over channels and `shared'. """
+        total = dict(self.shared)
+        for counters in self.channels.values():
+            for key, value in counters.items():
+                total[key] += value
+        return total
+
+    def save(self, path=None):
+        """ Write a table: a line per channel, `shared' and `total'. """
+        path = path or self.path
+        end = datetime.now()
+        rows = [('%02d' % ch, self.channels[ch]) for ch in sorted(self.channels)]
+        rows += [('shared', self.shared), ('total', self.total())]
+        with open(path, 'w') as f:
+            f.write('# start=%s\n# end=%s\n# elapsed=%.3f\n' % (self.start, end, time() - self.t_start))
+            f.write('# chan ' + ' '.join(FIELDS) + '\n')
+            for name, counters in rows:
+                f.write(' '.join([name] + [str(counters[key]) for key in FIELDS]) + '\n')
@@ -20,15 +20,36 @@
 
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
+from contextlib import contextmanager
 
 from .common import * 
 from .registers import *
 from . import adc_unit as adcunit
+from .adc_unit import registers as adcregs
 
 #TODO: wrapper to translate configuration options 
 
 Flag = namedtuple('flag', 'offset, reg, doc')
 
+# Registers which change by themselves or are commands/status, never put them to the shadow cache.
+VOLATILE_REGS = frozenset([
+    SIS3316_INTERFACE_ACCESS_ARBITRATION_CONTROL,
+    SIS3316_INTERNAL_TEMPERATURE_REG, SIS3316_ONE_WIRE_CONTROL_REG, SIS3316_ADC_FPGA_BOOT,
+    SIS3316_ADC_CLK_OSC_I2C_REG, SIS3316_NIM_CLK_MULTIPLIER_SPI_REG,
+    SIS3316_ACQUISITION_CONTROL_STATUS,
+    SIS3316_VME_FPGA_LINK_ADC_PROT_STATUS, SIS3316_ADC_FPGA_SPI_BUSY_STATUS_REG,
+    ] + [SIS3316_DATA_TRANSFER_GRP_CTRL_REG + 4*i for i in range(0, const.CHAN_GRP_COUNT)]
+    + [SIS3316_DATA_TRANSFER_GRP_STATUS_REG + 4*i for i in range(0, const.CHAN_GRP_COUNT)]
+    )
+
+# The same for ADC FPGA group registers (offsets in a group register space).
+VOLATILE_ADC_GRP_REGS = frozenset([
+    adcregs.INPUT_TAP_DELAY_REG, adcregs.DAC_OFFSET_CTRL_REG, adcregs.SPI_CTRL_REG, 
+    adcregs.STATUS_REG, adcregs.DAC_OFFSET_READBACK_REG, adcregs.SPI_READBACK_REG,
+    ] + [adcregs.ACTUAL_SAMPLE_ADDRESS_REG + 4*i for i in range(0, const.CHAN_PER_GRP)]
+    + [adcregs.PREVIOUS_BANK_SAMPLE_ADDRESS_REG + 4*i for i in range(0, const.CHAN_PER_GRP)]
+    )
+
 class Sis3316(object):
     ''' Provides clean and clear interface to SIS3316 board. 
     The main goal was to hide all hardware implementation details. '''
@@ -58,7 +79,7 @@ class Sis3316(object):
         'jumbo_ena'            : Flag( 4, SIS3316_UDP_PROTOCOL_CONFIG, "Enable Jumbo Frame for larger packets and faster read from daq"),
         }
     
-    _help_methods = [ 'reset', 'fire', 'ts_clear', 'read', 'write', 'read_list', 'write_list']
+    _help_methods = [ 'reset', 'fire', 'ts_clear', 'read', 'write', 'read_list', 'write_list', 'batch', 'shadow_enable', 'shadow_invalidate']
     _help_properties = ['id','serno', 'hardwareVersion', 'status']
     
     __slots__ = ('groups', 'channels', 'triggers', 'sum_triggers')
@@ -80,6 +101,11 @@ class Sis3316(object):
         self.trig = self.triggers
         self.strig = self.sum_triggers
         
+        self._shadow = None # register shadow cache {addr: value}
+        self._shadow_enabled = False
+        self._shadow_dirty = {} # registers to write back at the end of batch()
+        self._batch_level = 0
+        
 
     def configure(self, id = 0x00):
         """ Prepere after restart.
@@ -130,15 +156,106 @@ class Sis3316(object):
     
     def _set_field(self, addr, value, offset, mask):
         """ Read value, set bits and write back. """
-        data = self.read(addr)
+        data = self._read_shadowed(addr)
         data = set_bits(data, value, offset, mask)
-        self.write(addr, data)
+        
+        if self._batch_level and not self._is_volatile(addr):
+            self._shadow[addr] = data
+            self._shadow_dirty[addr] = True # write back at the end of batch
+        else:
+            self.write(addr, data)
     
     def _get_field(self, addr, offset, mask):
         """ Read a bitfield from register."""
-        data = self.read(addr)
+        data = self._read_shadowed(addr)
         return get_bits(data, offset, mask)
     
+    @staticmethod
+    def _is_key(addr):
+        """ True if writing to the register is an action (a key register), so it can't be repeated. """
+        return SIS3316_KEY_RESET <= addr < adcregs.SIS3316_FPGA_ADC_GRP_REG_BASE
+    
+    @staticmethod
+    def _is_volatile(addr):
+        """ True if a register value can't be cached. """
+        if addr in VOLATILE_REGS:
+            return True
+        if Sis3316._is_key(addr):
+            return True
+        if addr >= adcregs.SIS3316_FPGA_ADC_GRP_REG_BASE:
+            return (addr % adcregs.SIS3316_FPGA_ADC_GRP_REG_OFFSET) in VOLATILE_ADC_GRP_REGS
+        return False
+    
+    def _read_shadowed(self, addr):
+        """ Read a register, use the shadow cache if it is enabled. """
+        shadow = self._shadow
+        if shadow is None or self._is_volatile(addr):
+            return self.read(addr)
+        
+        if addr not in shadow:
+            shadow[addr] = self.read(addr)
+        return shadow[addr]
+    
+    def _shadow_written(self, addr, data):
+        """ Keep the shadow cache coherent, call it on every register write. """
+        if self._shadow is None:
+            return
+        self._shadow_dirty.pop(addr, None)
+        if self._is_volatile(addr):
+            self._shadow.pop(addr, None)
+        else:
+            self._shadow[addr] = data
+    
+    def shadow_enable(self, enable=True):
+        """ Cache register values to save read requests in property getters/setters.
+        Volatile registers (status, sample addresses, commands) are always read from the device.
+        Use it only if nobody else writes to the device.
+        """
+        self._shadow_enabled = bool(enable)
+        if enable:
+            if self._shadow is None:
+                self._shadow = {}
+        elif not self._batch_level:
+            self._shadow = None
+    
+    def shadow_invalidate(self, addr=None):
+        """ Forget a cached register value (all values if `addr' is None). """
+        if self._shadow is None:
+            return
+        if addr is None:
+            self._shadow = {k: v for k, v in self._shadow.items() if k in self._shadow_dirty}
+        elif addr not in self._shadow_dirty:
+            self._shadow.pop(addr, None)
+    
+    @contextmanager
+    def batch(self):
+        """ Coalesce bit-field updates, write each changed register once on exit:
+            with dev.batch():
+                trig.threshold = 1000
+                trig.enable = True
+        """
+        if self._shadow is None:
+            self._shadow = {}
+        self._batch_level += 1
+        try:
+            yield self
+        finally:
+            self._batch_level -= 1
+            if not self._batch_level:
+                try:
+                    self.shadow_flush()
+                finally:
+                    if not self._shadow_enabled:
+                        self._shadow = None
+    
+    def shadow_flush(self):
+        """ Write back registers changed during batch(). """
+        dirty = self._shadow_dirty
+        while dirty:
+            addr = next(iter(dirty))
+            self.write(addr, self._shadow[addr]) # calls _shadow_written, which cleans the dirty flag
+            dirty.pop(addr, None)
+    
     _freq = None
     
     _freq_presets = {    #Si570 Serial Port 7PPM Registers (13, 14...)
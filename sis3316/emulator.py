@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+A local UDP emulator of SIS3316 (VME FPGA version V_3316-2008 and higher).
+
+Speaks the link (0x10/0x11), VME (0x20/0x21) and FIFO-read (0x30) protocol,
+has two memory banks per channel filled with synthetic or recorded events,
+and can drop, reorder, delay and throttle response packets.
+
+Usage:
+    python -m sis3316.emulator --port 1234 --rate 10000 --loss 0.001
+
+    dev = sis3316.Sis3316_udp('127.0.0.1', 1234, local_port=0)
+"""
+
+import socket, select
+import struct
+import time
+import heapq
+import itertools
+import os
+import random
+
+import numpy as np
+
+from .common import const, get_bits
+from .registers import *
+from .adc_unit.registers import *
+from .i2c import I2C_ACK
+from .sis3316_udp import SIS3316_FPGA_ADC_GRP_MEM_BASE, SIS3316_FPGA_ADC_GRP_MEM_OFFSET
+
+STAT_NO_GRANT   = 1<<4
+STAT_FIFO_TIMEOUT   = 1<<5
+STAT_PROTOCOL_ERROR = 1<<6
+
+BANK_WORDS = 0x1000000 # words per channel per bank (24-bit sample address)
+CLOCK = 250e6 # [Hz] timestamp clock
+
+
+def _event_sizes(data, maw_length=0):
+    """ Split a recorded event stream into a list of events. """
+    events = []
+    pos = 0
+    while pos + 8 <= len(data):
+        fmt = data[pos] & 0xF
+        hlen = 8 + 4 * (7 * (fmt & 1) + 2 * bool(fmt & 2) + 3 * bool(fmt & 4) + 2 * bool(fmt & 8))
+        if pos + hlen + 4 > len(data):
+            break
+        hdr_raw, = struct.unpack_from('<I', data, pos + hlen)
+        size = hlen + 4 + 4 * (hdr_raw & 0x1FFffFF)
+        if hdr_raw & (1<<27):
+            size += 4 * maw_length
+        if hdr_raw >> 28 != 0xE or pos + size > len(data):
+            break
+        events.append(data[pos:pos + size])
+        pos += size
+    return events
+
+
+class Sis3316Emulator(object):
+    """ SIS3316 board emulator. Serves one client at a time. """
+    MODID = 0x33162008
+    SERNO = 0x0
+    TEMP = 35 * 4 # 0.25 C units
+
+    tick = 0.01 # [s] event generation and timer resolution
+    reorder_delay = 0.001 # [s] extra delay of a reordered packet
+
+    def __init__(self, host='127.0.0.1', port=1234, rate=1000., channels=range(0, const.CHAN_TOTAL),
+            loss=0., reorder=0., latency=0., bandwidth=None, replay=None, maw_length=0, seed=None):
+        """
+        Args:
+            rate: events per second per channel.
+            channels: channels which produce events.
+            loss: probability to drop a response packet.
+            reorder: probability to delay a response packet behind the next ones.
+            latency: [s] one-way delay of responses.
+            bandwidth: [bit/s] link speed cap, None is unlimited.
+            replay: a folder with recorded chNN.dat files to use instead of synthetic events.
+            maw_length: MAW test buffer length of recorded events.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        sock.setblocking(0)
+        self._sock = sock
+        self.address = sock.getsockname()
+
+        self.rate = rate
+        self.channels = list(channels)
+        self.loss = loss
+        self.reorder = reorder
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._rand = random.Random(seed)
+
+        self._outq = [] # (send time, seq.no, packet, address)
+        self._seq = itertools.count()
+        self._link_free = 0.
+
+        self._replay = {}
+        if replay:
+            for ch in self.channels:
+                fname = os.path.join(replay, 'ch%02d.dat' % ch)
+                if os.path.exists(fname):
+                    with open(fname, 'rb') as f:
+                        self._replay[ch] = [_event_sizes(f.read(), maw_length), 0]
+
+        self.reset()
+
+    def reset(self):
+        """ Power-on state. """
+        self.regs = {}
+        self.armed = False
+        self.bank = 0
+        self.banks = [[bytearray() for ch in range(const.CHAN_TOTAL)] for b in range(const.MEM_BANK_COUNT)]
+        self.prev_addr = [0] * const.CHAN_TOTAL
+        self.transfer = [None] * const.CHAN_GRP_COUNT # [mem_no, woffset]
+        self._ts_zero = time.time()
+        self._last_gen = time.time()
+        self._pending = [0.] * const.CHAN_TOTAL # fractional events
+        self._templates = {}
+
+# ----------- Registers ----------------------
+    def read_reg(self, addr):
+        regs = self.regs
+        grp, reg = divmod(addr - SIS3316_FPGA_ADC_GRP_REG_BASE, SIS3316_FPGA_ADC_GRP_REG_OFFSET)
+        is_adc = addr >= SIS3316_FPGA_ADC_GRP_REG_BASE and grp < const.CHAN_GRP_COUNT
+
+        if addr == SIS3316_MODID:
+            return self.MODID
+        elif addr == SIS3316_INTERFACE_ACCESS_ARBITRATION_CONTROL:
+            val = regs.get(addr, 0)
+            return val | ((val & 0b1) << 20) # own grant bit
+        elif addr == SIS3316_SERIAL_NUMBER_REG:
+            return self.SERNO
+        elif addr == SIS3316_INTERNAL_TEMPERATURE_REG:
+            return self.TEMP
+        elif addr == SIS3316_ADC_CLK_OSC_I2C_REG:
+            return I2C_ACK
+        elif addr == SIS3316_ACQUISITION_CONTROL_STATUS:
+            return self._acq_status()
+        elif addr == SIS3316_VME_FPGA_LINK_ADC_PROT_STATUS:
+            return 0x18181818
+        elif SIS3316_DATA_TRANSFER_GRP_CTRL_REG <= addr < SIS3316_DATA_TRANSFER_GRP_CTRL_REG + 0x10:
+            return regs.get(addr, 0) & ~(1<<31) # never busy
+        elif is_adc and reg == STATUS_REG:
+            return 0x130018
+        elif is_adc and ACTUAL_SAMPLE_ADDRESS_REG <= reg < ACTUAL_SAMPLE_ADDRESS_REG + 0x10:
+            self._generate()
+            ch = grp * const.CHAN_PER_GRP + (reg - ACTUAL_SAMPLE_ADDRESS_REG) // 4
+            return len(self.banks[self.bank][ch]) // 4 if self.armed else 0
+        elif is_adc and PREVIOUS_BANK_SAMPLE_ADDRESS_REG <= reg < PREVIOUS_BANK_SAMPLE_ADDRESS_REG + 0x10:
+            ch = grp * const.CHAN_PER_GRP + (reg - PREVIOUS_BANK_SAMPLE_ADDRESS_REG) // 4
+            return self.prev_addr[ch]
+        return regs.get(addr, 0)
+
+    def write_reg(self, addr, data):
+        if addr == SIS3316_KEY_RESET:
+            self.reset()
+        elif addr == SIS3316_KEY_DISARM:
+            self._generate()
+            self.armed = False
+        elif addr in (SIS3316_KEY_DISARM_AND_ARM_BANK1, SIS3316_KEY_DISARM_AND_ARM_BANK2):
+            self._arm(0 if addr == SIS3316_KEY_DISARM_AND_ARM_BANK1 else 1)
+        elif addr == SIS3316_KEY_TIMESTAMP_CLEAR:
+            self._ts_zero = time.time()
+        elif addr == SIS3316_KEY_TRIGGER:
+            if self.armed:
+                self._generate() # the events before it
+                for ch in self.channels:
+                    self._append(ch, 1, self._last_gen, 0.)
+        elif SIS3316_DATA_TRANSFER_GRP_CTRL_REG <= addr < SIS3316_DATA_TRANSFER_GRP_CTRL_REG + 0x10:
+            grp = (addr - SIS3316_DATA_TRANSFER_GRP_CTRL_REG) // 4
+            if data >> 30 == 0b10: # read cmd
+                self.transfer[grp] = [get_bits(data, 28, 0b1), get_bits(data, 0, 0xFffFFFF)]
+            else:
+                self.transfer[grp] = None
+            self.regs[addr] = data
+        else:
+            self.regs[addr] = data
+
+    def _acq_status(self):
+        self._generate()
+        data = self.regs.get(SIS3316_ACQUISITION_CONTROL_STATUS, 0) & 0xFFFF
+        data |= self.armed << 16 | self.bank << 17
+
+        for grp in range(const.CHAN_GRP_COUNT):
+            thr = self.regs.get(SIS3316_ADC_GRP(ADDRESS_THRESHOLD_REG, grp), 0) & 0xFFffFF
+            chans = range(grp * const.CHAN_PER_GRP, (grp + 1) * const.CHAN_PER_GRP)
+            if any(len(self.banks[self.bank][ch]) // 4 >= thr for ch in chans):
+                data |= 1 << 19 # threshold overrun
+        return data
+
+    def _arm(self, bank):
+        self._generate()
+        if self.armed:
+            self.prev_addr = [len(mem) // 4 for mem in self.banks[self.bank]]
+        self.bank = bank
+        self.armed = True
+        self._last_gen = time.time()
+        for mem in self.banks[bank]:
+            del mem[:]
+
+# ----------- Events ----------------------
+    def _template(self, ch):
+        """ A pool of synthetic events in the current channel format. Returns 2D uint32 array. """
+        grp, cid = divmod(ch, const.CHAN_PER_GRP)
+        dfmt = self.regs.get(SIS3316_ADC_GRP(DATAFORMAT_CONFIG_REG, grp), 0)
+        fmt = get_bits(dfmt, 8 * cid, 0xF)
+        maw_ena = get_bits(dfmt, 4 + 8 * cid, 0b1)
+        n_raw = get_bits(self.regs.get(SIS3316_ADC_GRP(RAW_DATA_BUFFER_CONFIG_REG, grp), 0), 16, 0xFFFe)
+        n_maw = get_bits(self.regs.get(SIS3316_ADC_GRP(MAW_TEST_BUFFER_CONFIG_REG, grp), 0), 0, 0x3Fe) if maw_ena else 0
+        header = get_bits(self.regs.get(SIS3316_ADC_GRP(CHANNEL_HEADER_REG, grp), 0), 24, 0xFF)
+        chan_id = header << 4 | grp << 2 | cid
+
+        key = (ch, fmt, n_raw, n_maw, chan_id)
+        if key in self._templates:
+            return self._templates[key]
+
+        pool = []
+        samples = np.arange(n_raw)
+        for i in range(16):
+            amp = self._rand.randint(100, 8000)
+            raw = (1000 + amp * np.exp(-((samples - n_raw / 3.) / 10.) ** 2)).astype('<i2')
+            peak = int(raw.max()) if n_raw else 0
+
+            words = struct.pack('<HHI', (chan_id << 4) | fmt, 0, 0)
+            if fmt & 0b1:
+                words += struct.pack('<hh6i', peak, int(raw.argmax()) if n_raw else 0, int(raw.sum()) & 0xffffff, *[amp] * 5)
+            if fmt & 0b10:
+                words += struct.pack('<2i', amp, amp)
+            if fmt & 0b100:
+                words += struct.pack('<3i', amp, amp // 2, 0)
+            if fmt & 0b1000:
+                words += struct.pack('<2i', 0, amp)
+            words += struct.pack('<I', 0xE << 28 | bool(n_maw) << 27 | n_raw // 2)
+            words += raw.tobytes() + np.zeros(n_maw, dtype='<i4').tobytes()
+            pool.append(np.frombuffer(words, dtype='<u4'))
+
+        self._templates[key] = np.array(pool)
+        return self._templates[key]
+
+    def _append(self, ch, count, now, elapsed):
+        """ Put `count` events to the active bank of channel `ch`, spread over the `elapsed` seconds till `now`. """
+        mem = self.banks[self.bank][ch]
+
+        if ch in self._replay:
+            events, idx = self._replay[ch]
+            if not events:
+                return
+            chunk = [events[(idx + i) % len(events)] for i in range(count)]
+            self._replay[ch][1] = (idx + count) % len(events)
+            data = b''.join(chunk)
+        else:
+            pool = self._template(ch)
+            evts = pool[np.array([self._rand.randrange(len(pool)) for i in range(count)], dtype=int)]
+            ts = np.maximum(now - self._ts_zero - elapsed * np.arange(count)[::-1] / count, 0) # in (now - elapsed, now]
+            ts = (ts * CLOCK).astype(np.uint64)
+            evts[:, 0] = (evts[:, 0] & 0xFFFF) | ((ts >> np.uint64(32)) & np.uint64(0xFFFF)).astype(np.uint32) << np.uint32(16)
+            evts[:, 1] = (ts & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+            data = evts.tobytes()
+
+        room = BANK_WORDS * 4 - len(mem)
+        mem += data[:room - room % 4] if len(data) > room else data
+
+    def _generate(self):
+        """ Fill the active bank with events since the last call. """
+        now = time.time()
+        elapsed, self._last_gen = now - self._last_gen, now
+        if not self.armed or not self.rate:
+            return
+        for ch in self.channels:
+            self._pending[ch] += self.rate * elapsed
+            count = int(self._pending[ch])
+            if count:
+                self._pending[ch] -= count
+                self._append(ch, count, now, elapsed)
+
+# ----------- Protocol ----------------------
+    def handle(self, msg, address):
+        """ Process a request packet. """
+        cmd = msg[0]
+        try:
+            if cmd == 0x10: # link read
+                pid, addr = struct.unpack_from('<BI', msg, 1)
+                self._send(struct.pack('<BBII', 0x10, pid, addr, self.read_reg(addr)), address)
+
+            elif cmd == 0x11: # link write, no ack
+                addr, data = struct.unpack_from('<II', msg, 1)
+                self.write_reg(addr, data)
+
+            elif cmd == 0x20: # VME read
+                pid, num = struct.unpack_from('<BH', msg, 1)
+                addrs = struct.unpack_from('<%dI' % (num + 1), msg, 4)
+                data = [self.read_reg(addr) for addr in addrs]
+                self._send(struct.pack('<BBB%dI' % len(data), 0x20, pid, 0, *data), address)
+
+            elif cmd == 0x21: # VME write
+                pid, num = struct.unpack_from('<BH', msg, 1)
+                admix = struct.unpack_from('<%dI' % (2 * (num + 1)), msg, 4)
+                for addr, data in zip(admix[::2], admix[1::2]):
+                    self.write_reg(addr, data)
+                self._send(struct.pack('<BBB', 0x21, pid, 0), address)
+
+            elif cmd == 0x30: # FIFO read
+                pid, num, addr = struct.unpack_from('<BHI', msg, 1)
+                self._fifo_read(pid, num + 1, addr, address)
+
+            else:
+                self._send(struct.pack('<BBB', cmd, 0, STAT_PROTOCOL_ERROR), address)
+
+        except struct.error:
+            self._send(struct.pack('<BBB', cmd, 0, STAT_PROTOCOL_ERROR), address)
+
+    def _fifo_read(self, pid, nwords, addr, address):
+        grp = (addr - SIS3316_FPGA_ADC_GRP_MEM_BASE) // SIS3316_FPGA_ADC_GRP_MEM_OFFSET
+        xfer = self.transfer[grp] if 0 <= grp < const.CHAN_GRP_COUNT else None
+        if xfer is None:
+            self._send(struct.pack('<BBB', 0x30, pid, STAT_FIFO_TIMEOUT), address)
+            return
+
+        mem_no, woffset = xfer
+        bank, odd, widx = get_bits(woffset, 24, 0b1), get_bits(woffset, 25, 0b1), get_bits(woffset, 0, 0xFFffFF)
+        ch = grp * const.CHAN_PER_GRP + 2 * mem_no + odd
+        mem = self.banks[bank][ch]
+
+        data = bytes(mem[4 * widx: 4 * (widx + nwords)])
+        data += bytes(4 * nwords - len(data)) # beyond the sample address
+        xfer[1] += nwords
+
+        jumbo = get_bits(self.regs.get(SIS3316_UDP_PROTOCOL_CONFIG, 0), 4, 0b1)
+        mtu = 8192 if jumbo else 1440
+        for i, pos in enumerate(range(0, len(data), mtu)):
+            self._send(bytes((0x30, pid, i & 0xF)) + data[pos:pos + mtu], address)
+
+# ----------- Network ----------------------
+    def _send(self, packet, address):
+        """ Queue a response packet with configured impairments. """
+        rand = self._rand
+        if self.loss and rand.random() < self.loss:
+            return
+
+        now = time.time()
+        t = now
+        if self.bandwidth:
+            self._link_free = max(self._link_free, now) + len(packet) * 8. / self.bandwidth
+            t = self._link_free
+        t += self.latency
+        if self.reorder and rand.random() < self.reorder:
+            t += self.reorder_delay
+
+        if t <= now and not self._outq:
+            self._sock.sendto(packet, address)
+        else:
+            heapq.heappush(self._outq, (t, next(self._seq), packet, address))
+
+    def _flush(self):
+        """ Send queued packets which are due. Return time to the next one. """
+        outq = self._outq
+        now = time.time()
+        while outq and outq[0][0] <= now:
+            t, seq, packet, address = heapq.heappop(outq)
+            self._sock.sendto(packet, address)
+        if outq:
+            return outq[0][0] - now
+        return None
+
+    def serve_forever(self):
+        sock = self._sock
+        while True:
+            wait = self._flush()
+            timeout = self.tick if wait is None else min(wait, self.tick)
+
+            if select.select([sock], [], [], timeout)[0]:
+                msg, address = sock.recvfrom(0x10000)
+                if msg:
+                    self.handle(msg, address)
+
+            self._generate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=1234, help='UDP port number')
+    parser.add_argument('--rate', type=float, default=1000., help='events per second per channel')
+    parser.add_argument('-c', '--channels', metavar='N', nargs='+', type=int, default=range(0, const.CHAN_TOTAL),
+            help='channels with events (all by default)')
+    parser.add_argument('--replay', type=str, metavar='PATH', default=None, help='a folder with recorded chNN.dat files')
+    parser.add_argument('--maw-length', type=int, default=0, help='MAW test buffer length of recorded events')
+    parser.add_argument('--loss', type=float, default=0., help='response packet loss probability')
+    parser.add_argument('--reorder', type=float, default=0., help='response packet reorder probability')
+    parser.add_argument('--latency', type=float, default=0., help='one-way latency [s]')
+    parser.add_argument('--bandwidth', type=float, default=None, help='link speed cap [Mbit/s]')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    emu = Sis3316Emulator(args.host, args.port, rate=args.rate, channels=args.channels,
+            loss=args.loss, reorder=args.reorder, latency=args.latency,
+            bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+            replay=args.replay, maw_length=args.maw_length, seed=args.seed)
+    print('sis3316 emulator listening on %s:%d' % emu.address)
+    try:
+        emu.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    import argparse
+    main()
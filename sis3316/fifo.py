@@ -41,6 +41,25 @@ class Sis3316(object):
 			_TransferLogicBusyExcept
 		
 		"""
+		reg_addr, cmd = self._fifo_read_cmd(grp_no, mem_no, woffset)
+		
+		if self.read(reg_addr) & BITBUSY:
+			raise self._TransferLogicBusyExcept(group = grp_no)
+		
+		self.write(reg_addr, cmd) #Prepare Data transfer logic
+
+	def _fifo_transfer_start(self, grp_no, mem_no, woffset):
+		"""
+		Reset fifo logic and set it up for read cmd with a single register list write.
+		The same as _fifo_transfer_reset() and _fifo_transfer_read(), but without the BUSY check:
+		the logic is idle right after the reset.
+		"""
+		reg_addr, cmd = self._fifo_read_cmd(grp_no, mem_no, woffset)
+		self.write_list([reg_addr, reg_addr], [0, cmd])
+
+	@staticmethod
+	def _fifo_read_cmd(grp_no, mem_no, woffset):
+		""" Data transfer control register and the "Start Read Transfer" command for it. """
 		if grp_no > 3:
 			raise ValueError("grp_no should be 0...3")
 		
@@ -49,9 +68,6 @@ class Sis3316(object):
 			
 		reg_addr = SIS3316_DATA_TRANSFER_GRP_CTRL_REG + 0x4 * grp_no
 		
-		if self.read(reg_addr) & BITBUSY:
-			raise self._TransferLogicBusyExcept(group = grp_no)
-		
 		# Fire "Start Read Transfer" command (FIFO programming)
 		cmd = 0b10 << 30 # Read cmd
 		cmd += woffset # Start address
@@ -59,7 +75,7 @@ class Sis3316(object):
 		if mem_no == 1:
 			cmd += 1  << 28 #Space select bit
 		
-		self.write(reg_addr, cmd) #Prepare Data transfer logic
+		return reg_addr, cmd
 		
 		
 	def _fifo_transfer_write(self, grp_no, mem_no, datalist, offset=0): #FIXME!
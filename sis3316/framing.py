@@ -0,0 +1,120 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Framed channel files.
+# Raw FIFO data of each bank of a channel can be written as a frame:
+#   header  (32 bytes): magic 'S316', version, flags, channel, bank sequence number,
+#                       wall time [s] (float64), payload words, reserved, CRC32 of the header,
+#   payload (words * 4 bytes): the raw data as it is read, it starts with a whole event,
+#   trailer (12 bytes): magic 'S31T', valid words, CRC32 of the valid payload.
+# The payload goes to the disk before its CRC is known, so the CRC is in the trailer.
+# A read which has failed is padded with zero words to the size in the header,
+# the trailer tells how many words are valid. Frames are found by hopping over the headers.
+
+import zlib
+from struct import Struct
+
+MAGIC = b'S316'
+TRAILER_MAGIC = b'S31T'
+VERSION = 1
+
+HEADER = Struct('<4sBBHIdIII') # magic, version, flags, chan, seq, time, words, reserved, crc
+TRAILER = Struct('<4sII') # magic, valid words, crc
+
+
+def pack_header(chan, seq, wtime, words):
+    """ A frame header for `words' of payload. """
+    fields = (MAGIC, VERSION, 0, chan, seq & 0xFFffFFff, wtime, words, 0)
+    crc = zlib.crc32(HEADER.pack(*(fields + (0,)))[:-4])
+    return HEADER.pack(*(fields + (crc,)))
+
+
+def unpack_header(buf):
+    """ A dict of header fields: chan, seq, time, words. Raises ValueError if it is not a frame header. """
+    if len(buf) < HEADER.size:
+        raise ValueError('short frame header')
+    magic, version, flags, chan, seq, wtime, words, reserved, crc = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError('no frame magic')
+    if crc != zlib.crc32(buf[:HEADER.size - 4]):
+        raise ValueError('wrong frame header CRC')
+    if version != VERSION:
+        raise ValueError('frame version %d is not supported' % version)
+    return {'chan': chan, 'seq': seq, 'time': wtime, 'words': words}
+
+
+def pack_trailer(valid, crc):
+    return TRAILER.pack(TRAILER_MAGIC, valid, crc)
+
+
+def unpack_trailer(buf):
+    """ (valid words, crc). Raises ValueError if it is not a frame trailer. """
+    if len(buf) < TRAILER.size:
+        raise ValueError('short frame trailer')
+    magic, valid, crc = TRAILER.unpack_from(buf)
+    if magic != TRAILER_MAGIC:
+        raise ValueError('no frame trailer magic')
+    return valid, crc
+
+
+def scan(buf):
+    """
+    Frames of a framed file in a buffer (a mmap, bytes), in order. A list of header dicts with
+        offset: of the header in `buf', payload: of the payload,
+        valid, crc: from the trailer (None if the frame is not complete).
+    Stops at the first place which is not a frame header.
+    """
+    frames = []
+    pos = 0
+    while pos + HEADER.size <= len(buf):
+        try:
+            frame = unpack_header(buf[pos:pos + HEADER.size])
+        except ValueError:
+            break
+        frame['offset'] = pos
+        frame['payload'] = pos + HEADER.size
+        end = frame['payload'] + frame['words'] * 4
+        try:
+            frame['valid'], frame['crc'] = unpack_trailer(buf[end:end + TRAILER.size])
+        except ValueError:
+            frame['valid'] = frame['crc'] = None
+        frames.append(frame)
+        pos = end + TRAILER.size
+    return frames
+
+
+def verify(buf, frame):
+    """ The frame payload in `buf' matches the CRC (False for incomplete frames). """
+    if frame['crc'] is None:
+        return False
+    start = frame['payload']
+    return zlib.crc32(buf[start:start + frame['valid'] * 4]) == frame['crc']
+
+
+def split(frames, count):
+    """ Split frames to `count' (or less) ranges of about the same payload, [(first, last + 1), ...]. """
+    total = sum(f['words'] for f in frames)
+    ranges = []
+    first, done = 0, 0
+    for i, frame in enumerate(frames):
+        done += frame['words']
+        if done * count >= total * (len(ranges) + 1) and i + 1 < len(frames):
+            ranges.append( (first, i + 1) )
+            first = i + 1
+    if first < len(frames):
+        ranges.append( (first, len(frames)) )
+    return ranges
@@ -0,0 +1,150 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Receive many datagrams per call.
+# Each datagram is scattered: a header to `hdrs', payload to a fixed-size slot of a destination buffer.
+# MmsgReceiver assumes a 64-bit Linux (pointers and size_t are 8 bytes), batch_receiver() checks that.
+
+import ctypes, ctypes.util
+import errno
+import os
+import socket
+import numpy as np
+
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = int(getattr(socket, 'MSG_TRUNC', 0x20)) # plain int, IntFlag operations are slow
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+        ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    func.restype = ctypes.c_int
+    return func
+
+_recvmmsg = _load_recvmmsg()
+
+
+class MmsgReceiver(object):
+    """ Receive up to `vlen` datagrams per syscall with recvmmsg (Linux).
+    After recv() returns `n', lengths[:n] and flags[:n] describe the datagrams,
+    the i-th header is at hdrs[i*hdr_sz].
+    """
+
+    def __init__(self, sock, hdr_sz, vlen=64):
+        if _recvmmsg is None:
+            raise NotImplementedError('recvmmsg is not available')
+        self.fd = sock.fileno()
+        self.hdr_sz = hdr_sz
+        self.vlen = vlen
+        self.hdrs = bytearray(hdr_sz * vlen)
+
+        hdrs_addr = ctypes.addressof((ctypes.c_char * len(self.hdrs)).from_buffer(self.hdrs))
+        self._iov = (iovec * (2 * vlen))()
+        self._msgs = (mmsghdr * vlen)()
+        for i in range(vlen):
+            self._iov[2*i].iov_base = hdrs_addr + i * hdr_sz
+            self._iov[2*i].iov_len = hdr_sz
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_iov = ctypes.cast(ctypes.byref(self._iov, 2*i * ctypes.sizeof(iovec)), ctypes.POINTER(iovec))
+            hdr.msg_iovlen = 2
+
+        # numpy views to fill payload iovecs and get results without a per-datagram python loop
+        iov = np.frombuffer(self._iov, dtype=np.uint64).reshape(2 * vlen, -1)
+        self._payload_base = iov[1::2, iovec.iov_base.offset // 8]
+        self._payload_len = iov[1::2, iovec.iov_len.offset // 8]
+        msgs = np.frombuffer(self._msgs, dtype=np.uint32).reshape(vlen, -1)
+        self.lengths = msgs[:, mmsghdr.msg_len.offset // 4]
+        self.flags = msgs[:, (mmsghdr.msg_hdr.offset + msghdr.msg_flags.offset) // 4]
+        self._slots = np.arange(vlen, dtype=np.uint64)
+
+    def recv(self, payload, slot_sz):
+        """ Get datagrams which are already in the socket (does not wait).
+        Payload of the i-th datagram goes to payload[i*slot_sz : (i+1)*slot_sz].
+        Returns the number of datagrams.
+        """
+        size = len(payload)
+        if not size:
+            return 0
+        n = min(self.vlen, (size + slot_sz - 1) // slot_sz)
+        buf = (ctypes.c_char * size).from_buffer(payload) # holds the buffer exported during the call
+
+        self._payload_base[:n] = ctypes.addressof(buf) + self._slots[:n] * slot_sz
+        self._payload_len[:n] = slot_sz
+        self._payload_len[n-1] = size - (n-1) * slot_sz
+
+        count = _recvmmsg(self.fd, self._msgs, n, MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise OSError(err, os.strerror(err))
+        return count
+
+
+class LoopReceiver(object):
+    """ The same as MmsgReceiver, but with a tight loop of recvmsg_into calls (no select). """
+
+    def __init__(self, sock, hdr_sz, vlen=64):
+        self.sock = sock
+        self.hdr_sz = hdr_sz
+        self.vlen = vlen
+        self.hdrs = bytearray(hdr_sz * vlen)
+        self.lengths = np.zeros(vlen, dtype=np.uint32)
+        self.flags = np.zeros(vlen, dtype=np.uint32)
+        self._hdr_views = [memoryview(self.hdrs)[i*hdr_sz:(i+1)*hdr_sz] for i in range(vlen)]
+
+    def recv(self, payload, slot_sz):
+        size = len(payload)
+        n = min(self.vlen, (size + slot_sz - 1) // slot_sz)
+        recvmsg_into = self.sock.recvmsg_into
+        for i in range(n):
+            try:
+                nbytes, ancdata, flags, address = recvmsg_into([self._hdr_views[i], payload[i*slot_sz : (i+1)*slot_sz]])
+            except (BlockingIOError, InterruptedError):
+                return i
+            self.lengths[i] = nbytes
+            self.flags[i] = flags
+        return n
+
+
+def batch_receiver(sock, hdr_sz, vlen=64):
+    """ The fastest receiver available on this platform. """
+    if _recvmmsg is not None and ctypes.sizeof(ctypes.c_void_p) == 8:
+        return MmsgReceiver(sock, hdr_sz, vlen)
+    return LoopReceiver(sock, hdr_sz, vlen)
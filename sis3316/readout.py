@@ -21,24 +21,52 @@
 
 from .common import *
 from .registers import *
+from .adc_unit.registers import *
+from . import framing
 from io import IOBase
+from time import time
+import zlib
 
 class destination (object):
-    """ Proxy object. """
+    """ Proxy object. 
+    Besides push(), it provides buffer()/commit() to receive data in place:
+    for bytearrays it is the target itself, for files -- a preallocated buffer,
+    which is written to the file on flush().
+    With a `pool' (writer.BufferPool) file buffers come from the pool, and full ones are 
+    written by its writer thread, so the readout does not wait for the disk.
+    Data between begin_frame() and end_frame() is written as a frame (see framing).
+    """
     target = None
     index = 0
-    def __init__(self, target, skip = 0):
+    bufsize = 4*1024*1024 # [bytes] file buffer size
+    
+    def __init__(self, target, skip = 0, pool = None):
         self.target = target
         self.index = skip
+        self.pool = pool
+        self._buf = None
+        self._view = None
+        self._fill = 0
+        self._frame = None
         
         if isinstance(target, self.__class__): 
             return target
         
         elif isinstance(target, bytearray):
             self.push = self._push_bytearray
+            self.buffer = self._buffer_bytearray
+            self.commit = self._commit_bytearray
+            
+        elif isinstance(target, IOBase) and pool is not None:
+            self.push = self._push_pool
+            self.buffer = self._buffer_pool
+            self.commit = self._commit_file
+            self.flush = self._flush_pool
             
         elif isinstance(target, IOBase):
             self.push = self._push_file
+            self.buffer = self._buffer_file
+            self.commit = self._commit_file
     
     def _push_bytearray(self, source):
         limit = len(self.target)
@@ -53,45 +81,255 @@ class destination (object):
         self.target[left_index : right_index] = source
         self.index += count
         
+    def _buffer_bytearray(self, count):
+        """ Get a writable memoryview for the next `count` bytes. """
+        if self.index + count > len(self.target):
+            raise IndexError("Out of range.")
+        return memoryview(self.target)[self.index : self.index + count]
+    
+    def _commit_bytearray(self, count):
+        """ `count` bytes were written to the buffer. """
+        self.index += count
+        
     def _push_file(self, source):
+        self.flush()
         count = len(source)
         self.target.write(source)
         self.index += count
+    
+    def _buffer_file(self, count):
+        """ Get a writable memoryview for the next `count` bytes. """
+        if self._buf is None or len(self._buf) - self._fill < count:
+            self.flush()
+            if self._buf is None or len(self._buf) < count:
+                self._buf = bytearray(max(count, self.bufsize))
+                self._view = memoryview(self._buf)
+        return self._view[self._fill : self._fill + count]
+    
+    def _commit_file(self, count):
+        """ `count` bytes were written to the buffer. """
+        self._fill += count
+        self.index += count
+    
+    def flush(self):
+        """ Write buffered data to the target file. """
+        if self._fill:
+            self.target.write(self._view[:self._fill])
+            self._fill = 0
+    
+    def _push_pool(self, source):
+        view = memoryview(source).cast('B')
+        while len(view):
+            count = min(len(view), self.pool.size)
+            self._buffer_pool(count)[:] = view[:count]
+            self._commit_file(count)
+            view = view[count:]
+    
+    def _buffer_pool(self, count):
+        """ Get a writable memoryview for the next `count` bytes in a pool buffer. """
+        if count > self.pool.size:
+            raise ValueError("%d bytes do not fit a pool buffer" % count)
+        if self._buf is None or len(self._buf) - self._fill < count:
+            self._flush_pool()
+            self._buf = self.pool.get() # waits if the disk is behind
+            self._view = memoryview(self._buf)
+        return self._view[self._fill : self._fill + count]
+    
+    def _flush_pool(self):
+        """ Queue buffered data for the writer thread, the buffer goes back to the pool. """
+        if self._buf is None:
+            return
+        self._view.release()
+        if self._fill:
+            self.pool.submit(self.target, self._buf, self._fill)
+        else:
+            self.pool.release(self._buf)
+        self._buf = self._view = None
+        self._fill = 0
+    
+    def begin_frame(self, chan, seq, words):
+        """ Write a frame header for `words' of payload, the payload CRC is counted from now on. """
+        self.push(framing.pack_header(chan, seq, time(), words))
+        self._frame = {'words': words, 'bytes': 0, 'crc': 0, 'push': self.push, 'commit': self.commit}
+        self.push = self._push_framed
+        self.commit = self._commit_framed
+    
+    def end_frame(self):
+        """ Pad the payload to the size in the header (if the read has failed), write the trailer and flush. """
+        frame = self._frame
+        if frame is None:
+            return
+        self.push, self.commit = frame['push'], frame['commit']
+        self._frame = None
+        
+        valid = frame['bytes'] // 4
+        if valid < frame['words']:
+            self.push(bytes(4 * (frame['words'] - valid)))
+        self.push(framing.pack_trailer(valid, frame['crc']))
+        self.flush()
+    
+    def _push_framed(self, source):
+        frame = self._frame
+        frame['crc'] = zlib.crc32(source, frame['crc'])
+        frame['bytes'] += memoryview(source).nbytes
+        frame['push'](source)
+    
+    def _commit_framed(self, count):
+        """ Count the CRC of `count' bytes written in place. """
+        frame = self._frame
+        if isinstance(self.target, bytearray):
+            data = memoryview(self.target)[self.index : self.index + count]
+        else:
+            data = self._view[self._fill : self._fill + count]
+        frame['crc'] = zlib.crc32(data, frame['crc'])
+        frame['bytes'] += count
+        data.release()
+        frame['commit'](count)
  
 
+class ChunkTuner (object):
+    """ Chooses the readout() chunk size from measured costs.
+    A chunk has a fixed cost (the transfer logic setup, the bank check after it) and a transfer time,
+    the chunk is the smallest one where the fixed cost takes no more than `overhead' of the time.
+    Both are averaged with `gain' weight of a new sample.
+    """
+    
+    def __init__(self, size=1024*1024, overhead=0.02, smin=256*1024, smax=const.MEM_BANK_SIZE//4, gain=0.25):
+        self.size = size #words
+        self.overhead = overhead
+        self.smin = smin
+        self.smax = smax
+        self.gain = gain
+        self.cost = None #seconds per chunk
+        self.rate = None #words per second
+    
+    def update(self, words, t_transfer, t_fixed):
+        """ A chunk of `words' took `t_transfer' seconds to transfer and `t_fixed' besides. Returns a new size. """
+        if words <= 0 or t_transfer <= 0:
+            return self.size
+        rate = words / t_transfer
+        if self.rate is None:
+            self.rate, self.cost = rate, t_fixed
+        else:
+            self.rate += self.gain * (rate - self.rate)
+            self.cost += self.gain * (t_fixed - self.cost)
+        
+        size = self.cost / self.overhead * self.rate
+        self.size = int(min(self.smax, max(self.smin, size)))
+        return self.size
+    
+    def __repr__(self):
+        return 'ChunkTuner(size=%d)' % self.size
+
+
 class Sis3316(object):
     
-    def readout(self, chan_no, target, target_skip=0, opts={}):
-        """ Rerurns ITERATOR. """
+    def readout(self, chan_no, target, target_skip=0, opts={}, banks=None):
+        """ Rerurns ITERATOR. 
+        banks: a poll_banks() snapshot taken after the last bank swap. If given, the bank and 
+            the address are taken from it and not checked after every chunk (the caller should 
+            compare it with a new snapshot when done).
+        opts['chunk_size']: words per chunk, or 'auto' to choose it with opts['chunk_tuner'] 
+            (a ChunkTuner, created if missing). The transfer logic is kept between chunks, 
+            so only the first chunk of a channel needs a setup.
+        opts['pool']: a writer.BufferPool to write files from a separate thread (see destination).
+        opts['framed']: write the bank as a frame (see framing), banks['seq'] is its sequence number.
+        """
         
         opts.setdefault('chunk_size', 1024*1024) #words
         
         chan = self.channels[chan_no]
-        bank = self.mem_prev_bank
-        max_addr = chan.addr_prev
-        chunksize = opts['chunk_size']
+        if banks is None:
+            bank = self.mem_prev_bank
+            max_addr = chan.addr_prev
+        else:
+            bank = banks['prev_bank']
+            max_addr = banks['addr_prev'][chan_no]
+        tuner = None
+        if opts['chunk_size'] == 'auto':
+            tuner = opts.setdefault('chunk_tuner', ChunkTuner())
         finished = 0
         fsync = True # the first byte in buffer is a first byte of an event
         
-        dest = destination(target, target_skip)
-        while finished < max_addr:
-            toread = min(chunksize, max_addr-finished)
-            wtransferred = chan.bank_read(bank, dest, toread, finished)
+        dest = destination(target, target_skip, opts.get('pool'))
+        if opts.get('framed') and max_addr:
+            dest.begin_frame(chan_no, banks.get('seq', 0) if banks else 0, max_addr)
+        try:
+            while finished < max_addr:
+                chunksize = tuner.size if tuner else opts['chunk_size']
+                toread = min(chunksize, max_addr-finished)
+                t_start, setup_time = time(), self.fifo_stats['setup_time']
+                wtransferred = chan.bank_read(bank, dest, toread, finished, keep = finished + toread < max_addr)
+                t_read = time()
             
-            bank_after = self.mem_prev_bank
-            max_addr_after = chan.addr_prev
+                if banks is None:
+                    bank_after = self.mem_prev_bank
+                    max_addr_after = chan.addr_prev
+                
+                    if bank_after != bank or max_addr_after != max_addr:
+                        raise self._BankSwapDuringReadExcept
             
-            if bank_after != bank or max_addr_after != max_addr:
-                raise self._BankSwapDuringReadExcept
+                if tuner:
+                    setup_time = self.fifo_stats['setup_time'] - setup_time
+                    tuner.update(wtransferred, t_read - t_start - setup_time, time() - t_read + setup_time)
             
-            finished += wtransferred
+                finished += wtransferred
             
-            yield {'transfered': wtransferred, 'sync': fsync, 'leftover': max_addr - finished}
+                yield {'transfered': wtransferred, 'sync': fsync, 'leftover': max_addr - finished}
             
-            fsync = False
+                fsync = False
+        finally:
+            dest.end_frame()
 
 
 
+    def readout_groups(self, targets, banks, pool=None, framed=False):
+        """ Read the previous bank of several channels at once, FIFO transfers of different
+        ADC groups are interleaved (see read_fifo_groups).
+        targets: [(chan_no, target), ...], banks: a poll_banks() snapshot taken after the last bank swap.
+        pool: a writer.BufferPool for file targets (see destination).
+        framed: write each bank as a frame (see framing), banks['seq'] is its sequence number.
+        Returns a dict: 'channels' {chan_no: words}, 'groups' {grp_no: {'bytes', 'time', 'rate'}}, 
+            and 'bytes', 'time', 'rate' in total (rate is bytes per second).
+        """
+        bank = banks['prev_bank']
+        jobs, chans = [], []
+        for chan_no, target in targets:
+            nwords = banks['addr_prev'][chan_no]
+            if not nwords:
+                continue
+            chan = self.channels[chan_no]
+            mem_no, woffset = chan.bank_address(bank)
+            dest = destination(target, 0, pool)
+            if framed:
+                dest.begin_frame(chan_no, banks.get('seq', 0), nwords)
+            jobs.append( (dest, chan.gid, mem_no, nwords, woffset) )
+            chans.append(chan_no)
+        
+        t_start = time()
+        try:
+            words, times = self.read_fifo_groups(jobs)
+        finally:
+            for job in jobs:
+                job[0].end_frame()
+        elapsed = time() - t_start
+        
+        groups = {}
+        for job, wcount in zip(jobs, words):
+            grp = groups.setdefault(job[1], {'bytes': 0, 'time': times.get(job[1], elapsed)})
+            grp['bytes'] += wcount * 4
+        for grp in groups.values():
+            grp['rate'] = grp['bytes'] / grp['time'] if grp['time'] > 0 else 0.
+        
+        total = sum(words) * 4
+        return {
+            'channels': dict(zip(chans, words)),
+            'groups': groups,
+            'bytes': total,
+            'time': elapsed,
+            'rate': total / elapsed if elapsed > 0 else 0.,
+            }
+
     def readout_pipe(self, chan_no, target, target_skip=0, opts={}):
         """ Readout generator. """
         opts.setdefault('swap_banks_auto', False)
@@ -115,22 +353,46 @@ class Sis3316(object):
     def poll_act(self, chanlist=[]):
         """ Get a count of words in active bank for specified channels."""
         if not chanlist:
-            chanlist = range(0,const.CHAN_TOTAL-1)
+            chanlist = range(0,const.CHAN_TOTAL)
 
+        addr_actual = self.poll_banks()['addr_actual']
         data = []        
-        #TODO: make a signle request instead of multiple .addr_actual property calls
         for i in chanlist:
             try:
-                data.append(self.channels[i].addr_actual)
-            except (IndexError, AttributeError):
+                data.append(addr_actual[i])
+            except (IndexError, TypeError):
                 data.append(None)
         #End For
         return data
+    
+    def poll_banks(self):
+        """ Get the acquisition status and sample addresses of all channels in a single request.
+        Returns a dict: _readout_status() fields, 'prev_bank' (None if not armed), 
+            'addr_prev' and 'addr_actual' (lists of words per channel).
+        """
+        nchan = const.CHAN_TOTAL
+        addrs = [SIS3316_ACQUISITION_CONTROL_STATUS]
+        for chan in self.channels:
+            addrs.append(SIS3316_ADC_GRP(PREVIOUS_BANK_SAMPLE_ADDRESS_REG, chan.gid) + 0x4 * chan.cid)
+        for chan in self.channels:
+            addrs.append(SIS3316_ADC_GRP(ACTUAL_SAMPLE_ADDRESS_REG, chan.gid) + 0x4 * chan.cid)
+        
+        data = self.read_list(addrs)
+        
+        ret = self._parse_readout_status(data[0])
+        ret['prev_bank'] = (ret['bank']-1) % const.MEM_BANK_COUNT if ret['armed'] else None
+        ret['addr_prev'] = [get_bits(x, 0, 0xffFFFF) for x in data[1:1+nchan]]
+        ret['addr_actual'] = [get_bits(x, 0, 0xffFFFF) for x in data[1+nchan:1+2*nchan]]
+        return ret
         
     def _readout_status(self):
         """ Return current bank, memory threshold flag """
         data = self.read(SIS3316_ACQUISITION_CONTROL_STATUS)
-        
+        return self._parse_readout_status(data)
+    
+    @staticmethod
+    def _parse_readout_status(data):
+        """ Interpret the acquisition control/status register value. """
         return {'armed'    : bool(get_bits(data, 16, 0b1)),
             'busy'    : bool(get_bits(data, 18, 0b1)), 
             'threshold_overrun':bool(get_bits(data, 19, 0b1)), # more data than .addr_threshold - 512 kbytes. overrun is always True if .addr_threshold is 0!
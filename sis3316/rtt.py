@@ -0,0 +1,81 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Round trip time estimation for request timeouts, as TCP does it (RFC 6298):
+# smoothed RTT and RTT variance give the timeout, a timeout doubles it
+# until a response to a request which was not repeated comes.
+
+from random import uniform
+
+
+class Estimator(object):
+    """
+    Smoothed RTT (srtt) and its variance (rttvar), in seconds.
+    The timeout is srtt + 4*rttvar, between `floor' and `ceiling'. It is `ceiling' before the first sample.
+    """
+    alpha = 1/8.
+    beta = 1/4.
+
+    def __init__(self, floor, ceiling):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.samples = 0
+        self._ambiguous = False
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            rto = self.ceiling
+        else:
+            rto = self.srtt + max(self.floor, 4 * self.rttvar)
+        return min(self.ceiling, max(self.floor, rto * self.backoff))
+
+    def sample(self, rtt):
+        """ A response came `rtt' seconds after its request. """
+        if self._ambiguous: # it can be a response to the request before timeout (Karn's algorithm)
+            self._ambiguous = False
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.backoff = 1
+        self.samples += 1
+
+    def on_timeout(self):
+        """ No response during `timeout'. """
+        if self.timeout < self.ceiling:
+            self.backoff *= 2
+        self._ambiguous = True
+
+    def __repr__(self):
+        if self.srtt is None:
+            return '%s(timeout=%.1f ms)' % (self.__class__.__name__, self.timeout * 1e3)
+        return '%s(srtt=%.3f ms, rttvar=%.3f ms, timeout=%.1f ms)' % (
+            self.__class__.__name__, self.srtt * 1e3, self.rttvar * 1e3, self.timeout * 1e3)
+
+
+def backoff_delay(attempt, base, cap):
+    """ A pause before the `attempt'-th retry (from 0): exponential backoff with jitter, up to `cap'. """
+    delay = min(cap, base * 2**attempt)
+    return uniform(delay/2, delay)
@@ -0,0 +1,177 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+# When to swap memory banks.
+# The ADC groups compare the active bank sample address with their addr_threshold and set the
+# threshold_overrun bit of the acquisition status register, so a single register read tells if
+# the bank is full enough. The bank is swapped then, or when the data gets too old.
+
+from collections import deque
+from time import sleep, time
+
+from .common import const
+
+
+class BankScheduler(object):
+    """
+    wait() polls the acquisition status and returns when the threshold overrun flag is set or
+    `max_latency' seconds have passed since the last swap (but not earlier than `min_interval').
+    The polls are spread: the next one is at about a half of the time left to the threshold,
+    predicted from the fill rate of the last bank, but not less than `poll' seconds apart.
+    swap() toggles the banks and returns a poll_banks() snapshot with the bank sequence number 'seq'
+    (counted from 0 since reset()), every swap is recorded in `swaps':
+        time, interval [s] since the previous swap, reason ('threshold', 'latency', 'stop' or 'start'),
+        words (in all channels), fill (the fullest channel, a fraction of a bank),
+        swap_time [s] (the toggle request round trip, an upper bound of the dead time it causes),
+        dead_time [s] (swap_time, plus the estimated time the fullest channel was full and lost data).
+    threshold: words per channel to set as addr_threshold of all groups, None keeps the configured ones.
+        The overrun flag is always set if addr_threshold is 0, then only `max_latency' counts.
+    stop_poll: how often [s] wait() checks its `stop' function if the status is polled less often.
+    """
+
+    def __init__(self, dev, threshold=None, max_latency=1., min_interval=0.01, poll=0.005, history=1024, stop_poll=0.05):
+        self.dev = dev
+        self.max_latency = max_latency
+        self.min_interval = min_interval
+        self.poll = poll
+        self.stop_poll = stop_poll
+        self.capacity = const.MEM_BANK_SIZE // 4 # words per channel per bank
+        if threshold is not None:
+            for grp in dev.groups:
+                grp.addr_threshold = threshold * 4 # the property takes bytes
+        self.threshold = min(grp.addr_threshold for grp in dev.groups) // 4
+        self.swaps = deque(maxlen=history)
+        self.reset()
+
+    def reset(self, bank=None):
+        """ Forget the last swap before a new run. bank: the armed bank, if known (saves a status read). """
+        self.swaps.clear()
+        self.seq = 0
+        self.bank = bank
+        self.reason = 'start'
+        self.t_swap = None
+        self.rate = None # words per second in the fullest channel
+
+    def wait(self, stop=None):
+        """
+        Wait till the active bank should be swapped. Returns the reason,
+        'stop' if the `stop' function returned True.
+        """
+        dev = self.dev
+        if self.t_swap is None:
+            return self.reason
+
+        deadline = self.t_swap + self.max_latency
+        earliest = self.t_swap + self.min_interval
+        while True:
+            if stop is not None and stop():
+                self.reason = 'stop'
+                return self.reason
+            now = time()
+            if now >= deadline:
+                self.reason = 'latency'
+                return self.reason
+            if now >= earliest and self.threshold:
+                status = dev._readout_status()
+                if not status['armed']:
+                    raise dev._NotArmedExcept
+                self.bank = status['bank']
+                if status['threshold_overrun']:
+                    self.reason = 'threshold'
+                    return self.reason
+
+            delay = deadline - now
+            if self.threshold:
+                if self.rate:
+                    left = (self.threshold - self.rate * (now - self.t_swap)) / self.rate
+                    delay = min(delay, left / 2)
+                else: # nothing to predict from yet
+                    delay = self.poll
+            delay = max(self.poll, earliest - now, delay)
+            if stop is not None:
+                delay = min(delay, max(self.poll, self.stop_poll))
+            sleep(delay)
+
+    def swap(self, disarm=False):
+        """
+        Toggle the banks, record the swap, return a poll_banks() snapshot.
+        disarm: disarm right after the toggle (the last swap of a run), the snapshot is
+            filled in as if still armed: 'bank' is the one toggled to, 'prev_bank' the one to read.
+        """
+        dev = self.dev
+        if self.bank is None:
+            self.bank = dev.mem_bank
+            if self.bank is None:
+                raise dev._NotArmedExcept
+
+        t_start = time()
+        bank = self.bank ^ 1
+        dev.arm(bank)
+        if disarm:
+            dev.disarm()
+        t_swap = time()
+        banks = dev.poll_banks()
+        if disarm:
+            banks['bank'], banks['prev_bank'] = bank, bank ^ 1
+        self.bank = banks['bank']
+        banks['seq'] = self.seq
+        self.seq += 1
+
+        words = max(banks['addr_prev'])
+        interval = t_swap - self.t_swap if self.t_swap is not None else None
+        dead_time = t_swap - t_start
+        if interval:
+            self.rate = words / interval
+            if words >= self.capacity - 1: # the bank was full for a while
+                dead_time += max(0., interval - self.capacity / self.rate)
+
+        self.swaps.append({
+            'time': t_swap,
+            'interval': interval,
+            'reason': self.reason,
+            'words': sum(banks['addr_prev']),
+            'fill': words / float(self.capacity),
+            'swap_time': t_swap - t_start,
+            'dead_time': dead_time,
+            })
+        self.t_swap = t_swap
+        return banks
+
+    def stats(self, since=None):
+        """
+        Summary of the swaps (after `since' timestamp, if given): number of swaps, mean interval [s],
+        fractions of swaps by threshold and by latency, mean and max fill, total dead time [s]
+        and its fraction of the time. Returns None if there are no swaps.
+        """
+        swaps = [s for s in self.swaps if s['interval'] is not None and (since is None or s['time'] >= since)]
+        if not swaps:
+            return None
+        elapsed = sum(s['interval'] for s in swaps)
+        dead = sum(s['dead_time'] for s in swaps)
+        return {
+            'swaps': len(swaps),
+            'interval': elapsed / len(swaps),
+            'threshold': sum(s['reason'] == 'threshold' for s in swaps) / float(len(swaps)),
+            'latency': sum(s['reason'] == 'latency' for s in swaps) / float(len(swaps)),
+            'fill': sum(s['fill'] for s in swaps) / len(swaps),
+            'fill_max': max(s['fill'] for s in swaps),
+            'dead_time': dead,
+            'dead_fraction': dead / elapsed if elapsed > 0 else 0.,
+            }
+
+    def __repr__(self):
+        return 'BankScheduler(threshold=%d, max_latency=%g)' % (self.threshold, self.max_latency)
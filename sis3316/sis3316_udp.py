@@ -22,15 +22,18 @@
 import abc
 import socket, select
 import sys
-from struct import pack, unpack_from, error as struct_error
-from random import randrange
+from struct import error as struct_error
 import time #FIXME
 from functools import wraps
-import re
-from numpy import uint8
+from collections import deque
+import numpy as np
 
 from .common import Sis3316Except, sleep, usleep #FIXME
 from . import device, i2c, fifo, readout, clkMultiplier
+from .mmsg import batch_receiver, LoopReceiver, MSG_TRUNC
+from . import congestion, rtt
+from .codec import Codec
+from .registers import SIS3316_DATA_TRANSFER_GRP_CTRL_REG
 
 
 #link interface
@@ -47,9 +50,29 @@ VME_WRITE_LIMIT = 64    #words
 FIFO_READ_LIMIT    = 0x40000//4    #bytes->words
 FIFO_WRITE_LIMIT = 256    #words
 
+class _GroupTransfer(object):
+    """ State of an ADC group in Sis3316.read_fifo_groups. """
+    
+    def __init__(self, grp_no):
+        self.grp_no = grp_no
+        self.jobs = deque() # indexes of jobs left
+        self.state = None   # 'setup', 'data' or None (finished)
+        self.pid = None     # identifier of the request in flight
+        self.target = None  # (mem_no, woffset) the setup in flight starts from
+        self.position = None # (mem_no, woffset) the transfer logic continues from, if known
+        self.prepared = None # [pid, target, t_sent, done] of a setup sent behind the last window of a job
+        self.t_sent = self.t_first = self.t_last = self.deadline = None
+        self.view = self.buf = None
+        self.wnum = self.npackets = self.count = 0
+        self.fails = 0
+
+
+STALE_PIDS = 128 # responces with up to this many identifiers behind the expected one are late duplicates
+
+
 def retry_on_timeout(f):
-    """ Repeat action with a random timeout. 
-    You can configure it with an object's `.retry_max_count' and `.retry_max_timeout' properties.
+    """ Repeat action after a random pause, which grows exponentially with each retry.
+    You can configure it with an object's `.retry_max_count', `.retry_backoff' and `.retry_max_timeout' properties.
     """
     @wraps(f)
     def wrapper(self, *args, **kwargs):
@@ -57,8 +80,9 @@ def retry_on_timeout(f):
             try:
                 return f(self, *args, **kwargs)
             except self._TimeoutExcept:
-                to = self.retry_max_timeout
-                usleep(randrange(to/2,to))
+                if i + 1 < self.retry_max_count:
+                    self.request_stats['retries'] += 1
+                    sleep(self._retry_delay(i))
                 
         raise self._TimeoutExcept(self.retry_max_count)
     return wrapper
@@ -68,22 +92,55 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
     """ A general implementation of sis3316 UPD-based protocol.
     """
     # Defaults:
-    default_timeout = 0.1    #seconds
+    default_timeout = 0.1    #seconds, the longest response timeout (and the first one, before RTT is known)
+    timeout_min = 0.005      #seconds, the shortest response timeout (see rtt)
+    retry_backoff = 1       #ms, a pause before the first retry, it doubles with each next one
     retry_max_timeout = 100 #ms
     retry_max_count = 10 
+    vme_pipeline_depth = 8 # VME requests in flight in read_list/write_list, 1 sends them one by one
     jumbo = 9000         # set this to your ethernet's jumbo-frame size
+    recv_buffer = 4*1024*1024 # [bytes] socket receive buffer to ask for, the OS limits it (net.core.rmem_max on Linux), 0 keeps the default
+    fifo_recv_batch = 0  # receive up to N FIFO packets per system call (recvmmsg), 0 disables
+    fifo_retransmit_max = 4 # attempts to get lost FIFO packets again
+    fifo_idle_timeout = 0.005 # [s] a pause inside a FIFO responce after which the rest is taken as lost
+    fifo_congestion_burst = 3 # this many FIFO packets lost in a row is taken as network congestion
+    fifo_samples_max = 1024 # FIFO read samples to keep (see link_stats)
+    fifo_group_windows = 2  # FIFO read windows in flight in read_fifo_groups (more may overflow the socket buffer)
+    link_speed = 1e9     # [bit/s] to compute link utilization
     VME_FPGA_VERSION_IS_0008_OR_HIGHER = True # VME FPGA version V_3316-2008 and higher
 
-    def __init__ (self, host, port=5768):
+    def __init__ (self, host, port=5768, local_port=None):
+        """ local_port: UDP port to bind, the same as `port' by default (0 is any free port). """
         self.hostname = host
         self.address = (host, port)
         self.packet_identifier=0    # Unsigned char packet identifier for new VME FPGA access protocol
+        self._codec = None
+
+        if local_port is None:
+            local_port = port
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind( ('', port ) )
+        sock.bind( ('', local_port ) )
         sock.setblocking(0) #guarantee that recv will not block internally
+        if self.recv_buffer:
+            try: # a burst of FIFO packets should not overflow the buffer
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+            except (OSError, socket.error):
+                pass
         #sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) #avoid the TIME_WAIT issue #FIXME: it still relevant?
         self._sock = sock
+        self._fifo_windowbuf = None
+        self._fifo_scratch = None
+        self._fifo_receiver = None
+        self.fifo_stats = {'packets': 0, 'lost': 0, 'discarded': 0, 'retransmits': 0, 'congestion': 0,
+            'setups': 0, 'setups_skipped': 0, 'setup_time': 0.}
+        self._fifo_positions = {} # grp_no: (mem_no, woffset) where a kept transfer logic continues (see read_fifo)
+        self.fifo_samples = deque(maxlen=self.fifo_samples_max)
+        self.congestion = congestion.AIMD() # FIFO read window strategy, see congestion
+        self.rtt = rtt.Estimator(self.timeout_min, self.default_timeout) # register requests
+        self.fifo_rtt = rtt.Estimator(self.timeout_min, self.default_timeout) # FIFO read requests, to the first packet
+        self.request_stats = {'requests': 0, 'timeouts': 0, 'retries': 0, 'stale': 0}
+        self._t_req = 0.
         
         for parent in self.__class__.__bases__: # all parent classes
             parent.__init__(self)
@@ -121,45 +178,73 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
             #~ raise self._GarbageInSocketExcept
 
         sock.sendto(msg, self.address)
+        self._t_req = time.time()
+        self.request_stats['requests'] += 1
+    
+    def _retry_delay(self, attempt):
+        """ A pause [s] before the `attempt'-th retry (from 0). """
+        return rtt.backoff_delay(attempt, self.retry_backoff / 1000., self.retry_max_timeout / 1000.)
+    
+    def _on_response(self):
+        """ Update the RTT estimation with a response to the last request. """
+        self.rtt.sample(time.time() - self._t_req)
+    
+    def _on_timeout(self):
+        """ No response to the last request. """
+        self.rtt.on_timeout()
+        self.request_stats['timeouts'] += 1
     
     def _resp_register(self, timeout = None):
         """ Get a single responce packet. """
         if timeout == None:
-            timeout = self.default_timeout
+            timeout = self.rtt.timeout
         
         sock = self._sock
         bufsz = self.jumbo
         responce = None
+        deadline = time.time() + timeout
+        # late duplicates of previous responces (their requests were retried after a timeout)
+        # have identifiers behind the current one
+        pid = self.packet_identifier if self.codec.with_pid else None
         
-        if select.select([sock], [], [], timeout)[0]:
+        while select.select([sock], [], [], max(0, deadline - time.time()))[0]:
             responce, address = sock.recvfrom(bufsz)
             #TODO:check address
             #if self.address != address
             #     cnt_wrong_addr +=1
             #    pass
+            if responce[:1] == b'\x30': # a late packet of a FIFO read
+                responce = None
+            elif pid is not None and len(responce) > 1 and 0 < (pid - responce[1]) & 0xFF <= STALE_PIDS:
+                self.request_stats['stale'] += 1
+                responce = None
+            else:
+                break
         
         if responce:    
+            self._on_response()
             return responce
         else:
+            self._on_timeout()
             raise self._TimeoutExcept
         
     def _read_link(self, addr):
         """ Read request for a link interface. """
-        msg = b''.join(( b'\x10', self._pack('<I', addr) ))
-        self._req(msg)
+        codec = self.codec
+        self._req(codec.link_read(self.packet_identifier, addr))
         resp = self._resp_register()
         try:    # Parse packet.
-            hdr, resp_addr, data = self._unpack_from('<BII', resp)
-            if hdr != 0x10 or resp_addr != addr:
-                raise self._WrongResponceExcept
+            hdr, pid, resp_addr, data = codec.link_read_resp(resp)
         except struct_error:
             raise self._MalformedResponceExcept
+        self._check_packetID(pid)
+        if hdr != 0x10 or resp_addr != addr:
+            raise self._WrongResponceExcept
         return data
 
     def _write_link(self,addr,data):
         """ Write request for a link interface. """
-        msg = b''.join(( b'\x11', pack('<II', addr, data) ))
-        self._req(msg) # no ACK
+        self._req(self.codec.link_write(addr, data)) # no ACK
 
     def _read_vme(self, addrlist):
         """ Read request on VME interface. """
@@ -173,11 +258,7 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
         if num == 0:
             return
         
-        if not self.VME_FPGA_VERSION_IS_0008_OR_HIGHER:
-            hdrLen = 2
-        else:
-            hdrLen = 3
-        
+        codec = self.codec
         limit = VME_READ_LIMIT
         chunks = (addrlist, )
         if num > limit:
@@ -186,18 +267,17 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
         
         data = []
         for chunk in chunks:
-            cnum = len(chunk)
-            msg = b''.join(( b'\x20', self._pack('<H%dI' % (cnum), cnum-1, *chunk) ))
-            self._req(msg)
+            self._req(codec.vme_read(self.packet_identifier, chunk))
             resp = self._resp_register()
             try:
-                hdr, stat = self._unpack_from('<BB',resp[:hdrLen])
+                hdr, pid, stat = codec.header(resp)
+                self._check_packetID(pid)
                 
                 if hdr != 0x20:
                     raise self._WrongResponceExcept
                 self.__status_err_check(stat)
 
-                data.extend( unpack_from('<%dI' % (cnum), resp[hdrLen:]) )
+                data.extend( codec.words(resp, len(chunk)) )
                 
             except struct_error:
                 raise self._MalformedResponceExcept
@@ -228,17 +308,18 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
         admix[::2] = addrlist
         admix[1::2] = datalist
         
+        codec = self.codec
         limit = VME_WRITE_LIMIT
         
         for idx in range(0, num, limit):
             ilen = min(limit, num-idx)
             
-            msg = b''.join(( b'\x21', self._pack('<H%dI' % (2*ilen), ilen - 1, *admix[2*idx:2*(idx+ilen)]) ))
-            self._req(msg)
+            self._req(codec.vme_write(self.packet_identifier, admix[2*idx:2*(idx+ilen)]))
             resp = self._resp_register()
         
             try:
-                hdr, stat = self._unpack_from('<BB',resp)
+                hdr, pid, stat = codec.header(resp)
+                self._check_packetID(pid)
                 if hdr != 0x21:
                     raise self._WrongResponceExcept
                 self.__status_err_check(stat)
@@ -250,6 +331,112 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
                 # we are not reading anything, so it's OK if FIFO-empty bit is '1'
                 pass
 
+    def _vme_pipeline(self, cmd, chunks, retry=True):
+        """
+        Send VME requests with up to `vme_pipeline_depth' of them in flight, match responces by packet identifier.
+        Each (re)transmission gets a new identifier, so late responces are recognized and dropped.
+        Args:
+            cmd: 0x20 (read, chunks are address lists) or 0x21 (write, chunks are [addr1, data1, ...] lists).
+            retry: send a request again if its responce is missing (up to `retry_max_count' times).
+        Returns:
+            A list of responces in the order of chunks.
+        Raise:
+            _TimeoutExcept, _MalformedResponceExcept, _SisNoGrantExcept, _SisProtocolErrorExcept
+        """
+        codec = self.codec
+        encode = codec.vme_read if cmd == 0x20 else codec.vme_write
+        sock = self._sock
+        bufsz = self.jumbo
+        stats = self.request_stats
+        depth = max(1, self.vme_pipeline_depth)
+        
+        responces = [None] * len(chunks)
+        attempts = [0] * len(chunks)
+        pending = deque(range(len(chunks)))
+        inflight = {} # pid: (chunk index, send time), in order of sending
+        
+        self.cleanup_socket()
+        while pending or inflight:
+            while pending and len(inflight) < depth:
+                idx = pending.popleft()
+                pid = self.packet_identifier
+                self.packet_identifier = (pid + 1) & 0xFF
+                sock.sendto(encode(pid, chunks[idx]), self.address)
+                inflight[pid] = (idx, time.time())
+                stats['requests'] += 1
+            
+            pid, (idx, t_sent) = next(iter(inflight.items())) # the oldest one
+            wait = t_sent + self.rtt.timeout - time.time()
+            
+            if not select.select([sock], [], [], max(0, wait))[0]:
+                del inflight[pid]
+                self.rtt.on_timeout()
+                stats['timeouts'] += 1
+                attempts[idx] += 1
+                if not retry or attempts[idx] >= self.retry_max_count:
+                    raise self._TimeoutExcept(attempts[idx])
+                stats['retries'] += 1
+                pending.appendleft(idx)
+                continue
+            
+            resp, address = sock.recvfrom(bufsz)
+            if resp[:1] != bytes((cmd,)): # a late packet of something else
+                continue
+            try:
+                hdr, pid, stat = codec.header(resp)
+            except struct_error:
+                raise self._MalformedResponceExcept
+            
+            entry = inflight.pop(pid, None)
+            if entry is None: # a late responce to a repeated request
+                continue
+            idx, t_sent = entry
+            if not attempts[idx]:
+                self.rtt.sample(time.time() - t_sent)
+            
+            try:
+                self.__status_err_check(stat)
+            except self._SisFifoTimeoutExcept:
+                if cmd == 0x20:
+                    raise
+                # we are not reading anything, so it's OK if FIFO-empty bit is '1'
+            responces[idx] = resp
+        
+        return responces
+
+    def _read_vme_pipelined(self, addrlist):
+        """ The same as _read_vme, but with several requests in flight (see _vme_pipeline). """
+        if not all(isinstance(item, int) for item in addrlist):
+            raise TypeError("_read_vme_pipelined accepts a list of integers.")
+        limit = VME_READ_LIMIT
+        chunks = [addrlist[i:i+limit] for i in range(0, len(addrlist), limit)]
+        words = self.codec.words
+        data = []
+        for chunk, resp in zip(chunks, self._vme_pipeline(0x20, chunks)):
+            try:
+                data.extend( words(resp, len(chunk)) )
+            except struct_error:
+                raise self._MalformedResponceExcept
+        return data
+
+    def _write_vme_pipelined(self, addrlist, datalist):
+        """ The same as _write_vme, but with several requests in flight (see _vme_pipeline).
+        Requests with lost responces are repeated, unless there are key registers among the addresses.
+        """
+        if not all(isinstance(item, int) for item in addrlist + datalist):
+            raise TypeError('Function accepts two lists of integers.')
+        if len(addrlist) != len(datalist):
+            raise ValueError('Two lists has to have equal size.')
+        
+        # Mix two lists: [addr1, data1, addr2, data2, ...]
+        admix = [None,None] * len(addrlist)
+        admix[::2] = addrlist
+        admix[1::2] = datalist
+        
+        limit = 2 * VME_WRITE_LIMIT
+        chunks = [admix[i:i+limit] for i in range(0, len(admix), limit)]
+        self._vme_pipeline(0x21, chunks, retry = not any(self._is_key(addr) for addr in addrlist))
+
     def open(self):
         """ Enable the link interface. """
         self._write_link(SIS3316_INTERFACE_ACCESS_ARBITRATION_CONTROL,0x1)
@@ -261,46 +448,42 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
         self._write_link(SIS3316_INTERFACE_ACCESS_ARBITRATION_CONTROL,0x0)
 
 # ----------- New VME FPGA Protocol -----------
+    @property
+    def codec(self):
+        """ Message encoder/decoder for the VME FPGA version (see codec). """
+        codec = self._codec
+        if codec is None or codec.with_pid != self.VME_FPGA_VERSION_IS_0008_OR_HIGHER:
+            codec = self._codec = Codec(self.VME_FPGA_VERSION_IS_0008_OR_HIGHER, VME_READ_LIMIT, VME_WRITE_LIMIT)
+        return codec
+
     def _pack(self, format, *args):
         """ Pack extra 1 byte identifier for VME version  >= 2008"""
         """ Assumes no header request byte included here """
-        if format[0] != '<':
-            raise Exception('Sis3316._pack() expects a string with "<" as the first character')
-        # Check VME version. If not 2008, just pack everything normally
-        if not self.VME_FPGA_VERSION_IS_0008_OR_HIGHER:
-            return pack(format, *args)
-        else:
-            # pack msg w/ packetID
-            return pack('<B' + format[1:], self.packet_identifier, *args)
+        codec = self.codec
+        if codec.with_pid:
+            return codec.request(format).pack(self.packet_identifier, *args)
+        return codec.request(format).pack(*args)
 
     def _unpack_from(self, format,  resp):
         """ Unpack a response packet from sis3316 """
         """ Will call self._check_packetID and increment packet ID counter """
-        # Check VME version. If not 2008, just unpack everything normally
-        if not self.VME_FPGA_VERSION_IS_0008_OR_HIGHER:
-            return unpack_from(format, resp)
-        else:
-            # Parse format string. Expect '<' followed by one uppercase letter or one lowercase letter
-            match = re.search(r'(\A<[A-Z])|(\A<[a-z])', format)
-            if match is not None:
-                # Insert packet identifier byte 'B' into unpack format string
-                try:
-                    unpackedMsg = unpack_from(match.group() + 'B' + format[len(match.group()):] , resp)
-                except struct_error:
-                    raise self._MalformedResponceExcept
-                self._check_packetID( unpackedMsg[1] )
-                unpackedMsg = list(unpackedMsg)
-                unpackedMsg.pop(1) # Don't return packetID
-                return tuple(unpackedMsg)  
-        
-            else:
-                raise Exception('Sis3316._unpack_from() unable to parse format string')
+        codec = self.codec
+        try:
+            unpackedMsg = codec.responce(format).unpack_from(resp)
+        except struct_error:
+            raise self._MalformedResponceExcept
+        if not codec.with_pid:
+            return unpackedMsg
+        self._check_packetID( unpackedMsg[1] )
+        return unpackedMsg[:1] + unpackedMsg[2:] # Don't return packetID
 
     def _check_packetID(self, packetID):
-        """ Checks packet ID and increments to next packet number """
+        """ Checks packet ID and increments to next packet number (None for old VME FPGA versions) """
+        if packetID is None:
+            return
         if packetID != self.packet_identifier:
             raise self._PacketsLossExcept #TODO Send relisten command with (xEE) instead
-        self.packet_identifier = uint8(self.packet_identifier + 1)
+        self.packet_identifier = (packetID + 1) & 0xFF
                 
 
 # ----------- Interface  ----------------------
@@ -322,113 +505,304 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
             self._write_vme([addr], [word])
         else:
             raise ValueError('Address 0x%X is wrong.' % addr)
+        self._shadow_written(addr, word)
     
     def read_list(self, addrlist):
         """ Read a sequence of addresses at once. """
         # Check addresses.
-        if any(addr/0x100000 for addr in addrlist): #any address is out of range
+        if any(addr >= 0x100000 for addr in addrlist): #any address is out of range
             raise ValueError('Some addresses are wrong.')
             
         if any(addr < 0x20 for addr in addrlist):
             raise NotImplementedError    #no sequential reads for link interface addresses.
         
+        if self.codec.with_pid and len(addrlist) > VME_READ_LIMIT and self.vme_pipeline_depth > 1:
+            return self._read_vme_pipelined(list(addrlist))
         return retry_on_timeout(self.__class__._read_vme)(self,addrlist)
 
     def write_list(self, addrlist, datalist):
         """ Write to a sequence of addresses at once. """
         # Check addresses.
-        if not all(addr < 0x100000 for addr in addrlist):
-            raise ValueError('Address {0} is wrong.'.format(hex(addr)))
+        if any(addr >= 0x100000 for addr in addrlist):
+            raise ValueError('Some addresses are wrong.')
             
-        if not all(addr < 0x20 for addr in addrlist):
+        if any(addr < 0x20 for addr in addrlist):
             raise NotImplementedError    #no sequential writes for link interface addresses.
             
-        return self._write_vme(self, addrlist, datalist) # In general it's not safe to retry write calls, so no retry_on_timeout here!
+        if self.codec.with_pid and len(addrlist) > VME_WRITE_LIMIT and self.vme_pipeline_depth > 1:
+            self._write_vme_pipelined(list(addrlist), list(datalist)) # repeats only writes to ordinary registers
+        else:
+            self._write_vme(addrlist, datalist) # In general it's not safe to retry write calls, so no retry_on_timeout here!
+        for addr, data in zip(addrlist, datalist):
+            self._shadow_written(addr, data)
 
 # ----------- FIFO stuff ----------------------
     def _ack_fifo_write(self, timeout = None):
         """ Get a FIFO write acknowledgement. """
         if timeout == None:
-            timeout = self.default_timeout
+            timeout = self.rtt.timeout
         sock = self._sock
         bufzs = self.jumbo
         
         if select.select([sock], [], [], timeout)[0]:
             chunk, address = sock.recvfrom(bufzs)
-            if not self.VME_FPGA_VERSION_IS_0008_OR_HIGHER:
-                packet_sz_bytes = 2
-            else:
-                packet_sz_bytes = 3
-                self._check_packetID( hex(chunk[1]) )
+            self._on_response()
+            packet_sz_bytes = self.codec.hdr_sz
+            if packet_sz_bytes == 3:
+                self._check_packetID( chunk[1] )
             
             if len(chunk) == packet_sz_bytes:
                 return chunk
             else:
                 raise self._UnexpectedResponceLengthExcept(packet_sz_bytes, len(chunk))
         else:
+            self._on_timeout()
             raise self._TimeoutExcept
     
-    def _ack_fifo_read(self, dest, west_sz, timeout = None):
+    def _fifo_receiver_for(self, hdr_sz):
+        """ A receiver of FIFO packets (see mmsg), `fifo_recv_batch' packets per call. """
+        vlen = max(1, self.fifo_recv_batch)
+        receiver = self._fifo_receiver
+        if receiver is None or receiver.vlen != vlen or receiver.hdr_sz != hdr_sz:
+            if vlen > 1:
+                receiver = batch_receiver(self._sock, hdr_sz, vlen)
+            else:
+                receiver = LoopReceiver(self._sock, hdr_sz, vlen)
+            self._fifo_receiver = receiver
+        return receiver
+    
+    def _recv_fifo_window(self, view, mtu, pid = None, timeout = None):
         """
-        Get responce to FIFO read request.
+        Get responce to FIFO read request, keeping packets which came after lost ones.
+        4-bit sequence numbers tell the place of a packet only in a run of packets
+        which starts with the first packet, or which ends with the last one.
+        Packets between two gaps are dropped (read_fifo requests them again).
         Args:
-            dest: an object which has a `push(smth)' method and an `index' property.
-            west_sz: estimated count of words in responce (to not to wait an extra timeout in the end).
+            view: writable buffer for the whole responce, the i-th packet goes to view[i*mtu:].
+            mtu: payload bytes in a full packet.
+            pid: packet identifier of the request, packets of other (late) responces are dropped.
         Returns:
-            Nothing.
+            (got, burst, t_first): bytearray with a nonzero byte for each packet in place,
+            the longest run of lost packets and arrival time of the first packet (None if nothing came).
         Raise:
-            _WrongResponceExcept, _UnorderedPacketExcept, _UnexpectedResponceLengthExcept
+            _WrongResponceExcept, _SisNoGrantExcept, _SisFifoTimeoutExcept, _SisProtocolErrorExcept
         """
         if timeout == None:
-            timeout = self.default_timeout
-       
+            timeout = self.fifo_rtt.timeout
+        
         if not self.VME_FPGA_VERSION_IS_0008_OR_HIGHER:
             HEADER_SZ_B = 2
             statIndex = 1
         else:
             HEADER_SZ_B = 3
             statIndex = 2
-
+        
         sock = self._sock
-        tempbuf = bytearray(self.jumbo)
+        receiver = self._fifo_receiver_for(HEADER_SZ_B)
+        rhdrs = receiver.hdrs
+        hdrs = np.frombuffer(rhdrs, dtype=np.uint8).reshape(-1, HEADER_SZ_B)
+        seq = np.arange(receiver.vlen)
         
-        packet_idx=0
-        bcount = 0
-        best_sz = west_sz * 4
+        size = len(view)
+        npackets = (size + mtu - 1) // mtu
+        last_sz = size - (npackets - 1) * mtu
+        if self._fifo_scratch is None or len(self._fifo_scratch) < npackets * mtu:
+            self._fifo_scratch = memoryview(bytearray(max(npackets * mtu, FIFO_READ_LIMIT * 4 + mtu)))
+        scratch = self._fifo_scratch
         
-        while select.select([sock], [], [], timeout)[0]:
-            packet_sz, address = sock.recvfrom_into(tempbuf)
-            #TODO:check address
-            #if self.address != address
-            #     cnt_wrong_addr +=1
-            #    pass
+        got = bytearray(npackets)
+        t_first = None
+        ecount = 0  # packets in order from the first one
+        tail = []   # (seq, payload size) of packets after a gap, payloads are in `scratch'
+        prev = -1   # sequence number of the previous packet
+        burst = 0
+        discarded = 0
+        wait = timeout
+        
+        while ecount < npackets and select.select([sock], [], [], wait)[0]:
+            wait = self.fifo_idle_timeout
+            if not tail:
+                region = view[ecount * mtu:]
+            else:
+                region = scratch[len(tail) * mtu : npackets * mtu]
+                if not region:
+                    break
             
-            # Check that a packet is in order and it's status bits are ok.
-            hdr = tempbuf[0]
-            if (hdr != 0x30):
-                raise self._WrongResponceExcept('The packet header is not 0x30')
+            count = receiver.recv(region, mtu)
+            if not count:
+                continue
+            if t_first is None:
+                t_first = time.time()
+            
+            if count == 1: # python scalars are faster for a single packet
+                if rhdrs[0] != 0x30:
+                    raise self._WrongResponceExcept('The packet header is not 0x30')
+                self.__status_err_check(rhdrs[statIndex])
                 
-            stat = tempbuf[statIndex]
-            self.__status_err_check(stat)
+                stat = (rhdrs[statIndex],)
+                payload_sz = (int(receiver.lengths[0]) - HEADER_SZ_B,)
+                valid = (not receiver.flags[0] & MSG_TRUNC and (pid is None or rhdrs[1] == pid),)
+                inorder = (valid[0] and ecount < npackets and stat[0] & 0xF == ecount & 0xF
+                    and payload_sz[0] == (last_sz if ecount == npackets - 1 else mtu))
+                first = 1 if inorder else 0
             
-            packet_no = stat & 0xF
-            if packet_no != packet_idx & 0xF:
-                raise self._UnorderedPacketExcept
+            else:
+                hdr, stat = hdrs[:count, 0], hdrs[:count, statIndex]
+                if (hdr != 0x30).any():
+                    raise self._WrongResponceExcept('The packet header is not 0x30')
+                errors = stat & 0x70
+                if errors.any():
+                    self.__status_err_check(int(errors[errors.nonzero()[0][0]]))
+                
+                payload_sz = receiver.lengths[:count].astype(np.int64) - HEADER_SZ_B
+                valid = (receiver.flags[:count] & MSG_TRUNC) == 0
+                if pid is not None:
+                    valid &= hdrs[:count, 1] == pid
                 
-            packet_idx += 1
-            # -- OK
+                slots = ecount + seq[:count]
+                inorder = valid & (slots < npackets) & (stat & 0xF == slots & 0xF) \
+                    & (payload_sz == np.where(slots == npackets - 1, last_sz, mtu))
+                first = count if inorder.all() else int(inorder.argmin())
             
-            bcount += packet_sz - HEADER_SZ_B
-            assert bcount <= best_sz, "The lenght of responce on FIFO-read request is %d bytes, but only %d bytes was expected." % (bcount, best_sz)
-            assert bcount%4 == 0, "data length in packet is not power or 4: %d"%(bcount,)
+            if tail: # the run from the first packet is already broken
+                first = 0
+            elif first:
+                got[ecount : ecount + first] = b'\x01' * first
+                ecount += first
+                prev = (ecount - 1) & 0xF
             
-            dest.push(tempbuf[HEADER_SZ_B:packet_sz])
-            if bcount == best_sz:
-                return # we have got all we need, so not waiting an extra timeout
+            for j in range(first, count): # the rest goes to the tail
+                if not valid[j]:
+                    discarded += 1
+                    continue
+                packet_no = int(stat[j]) & 0xF
+                burst = max(burst, (packet_no - prev - 1) & 0xF)
+                prev = packet_no
+                scratch[len(tail) * mtu : len(tail) * mtu + payload_sz[j]] = region[j * mtu : j * mtu + payload_sz[j]]
+                tail.append((packet_no, int(payload_sz[j])))
             
+            if tail and last_sz != mtu and tail[-1] == ((npackets - 1) & 0xF, last_sz):
+                break # the last packet is here (the rest would be dropped anyway)
+        
         #end while
-        #~ print "<>timeout cnt %d, est %d" %(bcount, best_sz)
-        raise self._TimeoutExcept
+        
+        # Place the run which ends with the last packet.
+        slot, expected_sz = npackets - 1, last_sz
+        for i in range(len(tail) - 1, -1, -1):
+            packet_no, psize = tail[i]
+            if slot < ecount or packet_no != slot & 0xF or psize != expected_sz:
+                break
+            view[slot * mtu : slot * mtu + psize] = scratch[i * mtu : i * mtu + psize]
+            got[slot] = 1
+            slot -= 1
+            expected_sz = mtu
+        
+        if not got[-1]: # the end of responce is lost
+            burst = max(burst, npackets - ecount - len(tail))
+        
+        received = got.count(1)
+        self.fifo_stats['packets'] += received
+        self.fifo_stats['discarded'] += discarded + ecount + len(tail) - received
+        return got, burst, t_first
+    
+    def _read_fifo_window(self, fifo_addr, view, mtu):
+        """ Request len(view) bytes from FIFO, see _recv_fifo_window. """
+        codec = self.codec
+        pid = self.packet_identifier
+        self._req(codec.fifo_read(pid, len(view)//4, fifo_addr))
+        if codec.with_pid:
+            # a new identifier for each request, so late packets of a previous one are recognized
+            self.packet_identifier = (pid + 1) & 0xFF
+        else:
+            pid = None
+        got, burst, t_first = self._recv_fifo_window(view, mtu, pid, self.fifo_rtt.timeout)
+        if t_first is None:
+            self.fifo_rtt.on_timeout()
+            self.request_stats['timeouts'] += 1
+        else:
+            self.fifo_rtt.sample(t_first - self._t_req)
+        return got, burst, t_first
+    
+    def _fifo_sample(self, t_start, wnum, mtu, got, t_first):
+        """ Make a sample of a FIFO read request (see congestion) and put it to `fifo_samples'. """
+        t_end = time.time()
+        duration = t_end - t_start
+        nbytes = min(got.count(1) * mtu, wnum * 4)
+        sample = {
+            'time': t_start,
+            'window': wnum,
+            'rtt': t_first - t_start if t_first else None,
+            'duration': duration,
+            'packets': len(got),
+            'lost': got.count(0),
+            'bytes': nbytes,
+            'rate': nbytes / duration if duration > 0 else 0.,
+            }
+        self.fifo_samples.append(sample)
+        return sample
+    
+    def link_stats(self, since=None):
+        """
+        Summary of FIFO read samples (the ones after `since' timestamp, if given): 
+        number of samples, mean window [words], mean and minimal rtt [s], loss fraction, 
+        rate [bytes/s] and link utilization (a fraction of `link_speed') during transfers.
+        Returns None if there are no samples.
+        """
+        samples = [s for s in self.fifo_samples if since is None or s['time'] >= since]
+        if not samples:
+            return None
+        
+        rtts = [s['rtt'] for s in samples if s['rtt'] is not None]
+        duration = sum(s['duration'] for s in samples)
+        rate = sum(s['bytes'] for s in samples) / duration if duration > 0 else 0.
+        return {
+            'samples': len(samples),
+            'window': sum(s['window'] for s in samples) / len(samples),
+            'rtt': sum(rtts) / len(rtts) if rtts else None,
+            'rtt_min': min(rtts) if rtts else None,
+            'loss': sum(s['lost'] for s in samples) / float(sum(s['packets'] for s in samples)),
+            'rate': rate,
+            'utilization': rate * 8 / self.link_speed,
+            }
+    
+    @staticmethod
+    def _fifo_gaps(got):
+        """ Ranges of missing packets: [(first, last+1), ...]. """
+        gaps = []
+        idx = got.find(0)
+        while idx >= 0:
+            end = got.find(1, idx)
+            if end < 0:
+                end = len(got)
+            gaps.append((idx, end))
+            idx = got.find(0, end)
+        return gaps
+    
+    def _refetch_fifo_gaps(self, grp_no, mem_no, fifo_addr, woffset, view, got, mtu):
+        """
+        Request missing parts of a FIFO read window again (up to `fifo_retransmit_max' times).
+        Args:
+            woffset: memory address of the window.
+        Returns:
+            True if the FIFO logic is ready to continue right after the window.
+        """
+        wmtu = mtu//4
+        wsize = len(view)//4
+        wnext = None # where the FIFO logic stopped
+        
+        for attempt in range(self.fifo_retransmit_max):
+            gaps = self._fifo_gaps(got)
+            if not gaps:
+                break
+            
+            for first, last in gaps:
+                wfirst, wlast = first * wmtu, min(last * wmtu, wsize)
+                self.fifo_stats['retransmits'] += 1
+                self._fifo_transfer_start(grp_no, mem_no, woffset + wfirst)
+                got[first:last] = self._read_fifo_window(fifo_addr, view[wfirst*4 : wlast*4], mtu)[0]
+                wnext = wlast
+        
+        return wnext is None or wnext == wsize
 
     #~ def _write_fifo(self, addr, datalist):
         #~ dlen = len(datalist)
@@ -456,94 +830,437 @@ class Sis3316(device.Sis3316, i2c.Sis3316, fifo.Sis3316, readout.Sis3316, clkMul
 
 
 
-    def read_fifo(self, dest, grp_no, mem_no, nwords, woffset=0):
+    def _fifo_wmtu(self):
+        """ Words per FIFO responce packet. Only the jumbo frame flag is read (`flags' reads all of them). """
+        flag = self._conf_flags['jumbo_ena']
+        if self._get_field(flag.reg, flag.offset, 0b1):
+            return 8192//4
+        return 1440//4
+
+    def read_fifo(self, dest, grp_no, mem_no, nwords, woffset=0, keep=False):
         """
         Get data from ADC unit's DDR memory. 
-        Readout is robust (retransmit on failure) and congestion-aware (adjusts an amount of data per request).
+        Readout is robust (missing packets are requested again) and congestion-aware (adjusts an amount of data per request).
+        The transfer logic is set up with a single request (reset and read command together), 
+        and not set up at all if the previous read of the group was kept and ended right at `woffset'.
         Attrs:
             dest: an object which has a `push(smth)' method and an `index' property.
+                If it also has `buffer(count)' and `commit(count)' methods (see readout.destination), 
+                packets are received directly into the buffer.
             grp_no: ADC group number.
             mem_no: memory unit number.
             nwords: number of words to read to dest.
             woffset: index of the first word.
+            keep: do not reset the transfer logic at the end, so the next read can continue 
+                from here without a setup (readout() keeps it between chunks of a channel).
         Returns:
             Number of words.
         """
         #TODO: make finished an argument by ref, so we can get the value even after Except
         
         fifo_addr = SIS3316_FPGA_ADC_GRP_MEM_BASE + grp_no * SIS3316_FPGA_ADC_GRP_MEM_OFFSET
+        wmtu = self._fifo_wmtu()
         
         # Network congestion window:
-        wcwnd_limit = FIFO_READ_LIMIT
-        wcwnd = wcwnd_limit//2
-        wcwnd_max = wcwnd_limit//2
-       
+        cc = self.congestion
+        cc.start(FIFO_READ_LIMIT, wmtu)
+        hardfails = 0
         
-        if 'jumbo_ena' in getattr(self,'flags'):
-            wmtu = 8192//4 
-        else:
-            wmtu = 1440//4
+        zerocopy = hasattr(dest, 'buffer')
+        if not zerocopy and self._fifo_windowbuf is None:
+            self._fifo_windowbuf = memoryview(bytearray(FIFO_READ_LIMIT * 4))
         
+        stats = self.fifo_stats
         wfinished = 0
-        binitial_index = dest.index
+        setupfails = 0
+        # the logic is ready if the last read of the group was kept and stopped here
+        in_place = self._fifo_positions.pop(grp_no, None) == (mem_no, woffset)
+        if in_place:
+            stats['setups_skipped'] += 1
         
-        while wfinished < nwords:
-            try: # Configure FIFO
-                self._fifo_transfer_reset(grp_no) #cleanup
-                self._fifo_transfer_read(grp_no, mem_no, woffset + wfinished)
-                
-            except self._WrongResponceExcept: #some trash in socket
-                self.cleanup_socket()
-                #~ print "<< trash in socket"
-                sleep(self.default_timeout)
-                continue
-                
-            except self._TimeoutExcept:
-                sleep(self.default_timeout)
-                continue #FIXME: Retry on timeout forever?!
-            
-            
-            # Data transmission
+        try:
             while wfinished < nwords:
+                try: # Configure FIFO
+                    if not in_place:
+                        t_setup = time.time()
+                        self._fifo_transfer_start(grp_no, mem_no, woffset + wfinished)
+                        stats['setups'] += 1
+                        stats['setup_time'] += time.time() - t_setup
+                    
+                except self._WrongResponceExcept: #some trash in socket
+                    self.cleanup_socket()
+                    #~ print "<< trash in socket"
+                    self.request_stats['retries'] += 1
+                    sleep(self._retry_delay(setupfails))
+                    setupfails += 1
+                    continue
+                    
+                except self._TimeoutExcept:
+                    self.request_stats['retries'] += 1
+                    sleep(self._retry_delay(setupfails))
+                    setupfails += 1
+                    continue #FIXME: Retry on timeout forever?!
+                setupfails = 0
                 
-                try: 
-                    wnum = int(min(nwords - wfinished, FIFO_READ_LIMIT, wcwnd))
-
-                    msg = b''.join(( b'\x30', self._pack('<HI', wnum-1, fifo_addr) ))
-                    self._req(msg)
-                    self._ack_fifo_read(dest, wnum) # <- exceptions are most probable here 
+                
+                # Data transmission
+                while wfinished < nwords:
+                    wnum = int(min(nwords - wfinished, FIFO_READ_LIMIT, cc.window))
+                    
+                    if zerocopy:
+                        view = dest.buffer(wnum * 4)
+                    else:
+                        view = self._fifo_windowbuf[:wnum * 4]
                     
-                    if wcwnd_max > wcwnd: #recovery after congestion
-                        wcwnd += (wcwnd_max - wcwnd)//2 
+                    t_start = time.time()
+                    in_place = False # the logic position is not known until the window is done
+                    got, burst, t_first = self._read_fifo_window(fifo_addr, view, wmtu * 4) # <- exceptions are most probable here 
+                    sample = self._fifo_sample(t_start, wnum, wmtu * 4, got, t_first)
+                    
+                    nlost = sample['lost']
+                    if nlost == len(got):
+                        # hardfail (network congestion)
+                        stats['congestion'] += 1
+                        cc.on_congestion(sample)
+                        hardfails += 1
+                        break
+                    hardfails = 0
+                    
+                    wdone = wnum
+                    in_place = True
+                    if nlost:
+                        # softfail: some packets dropped, get only them again
+                        stats['lost'] += nlost
+                        if burst >= self.fifo_congestion_burst:
+                            # many packets lost in a row: network congestion
+                            stats['congestion'] += 1
+                            cc.on_congestion(sample)
+                        else:
+                            cc.on_loss(sample)
                         
-                    else:    #probe new maximum
-                        wcwnd = min(wcwnd_limit, wcwnd + wmtu + (wcwnd - wcwnd_max) ) 
-                
-                except self._UnorderedPacketExcept:
-                    # softfail: some packets accidentally dropped
-                    # print ("UnorderedPacketExcept<< ", wcwnd)
-                    break
+                        try:
+                            in_place = self._refetch_fifo_gaps(grp_no, mem_no, fifo_addr, woffset + wfinished, view, got, wmtu * 4)
+                        except (self._TimeoutExcept, self._WrongResponceExcept):
+                            in_place = False
+                        
+                        if 0 in got: # take what is in order
+                            wdone = got.index(0) * wmtu
+                            in_place = False
                     
-                except self._TimeoutExcept:
-                    # hardfail (network congestion)
-                    wcwnd_max = wcwnd
-                    wcwnd = wcwnd // 2 # Reduce window by 50%
-                    # print ("TimeoutExcept<< ", wcwnd, '%0.3f%%'% (1.0 * wfinished/nwords  * 100,) , 'cwnd reduced')
-                    break
+                    else:
+                        cc.on_success(sample)
+                    
+                    if zerocopy:
+                        dest.commit(wdone * 4)
+                    else:
+                        dest.push(view[:wdone * 4])
+                    wfinished += wdone
+                    
+                    if not in_place:
+                        break # set up FIFO logic again
+                    
+                #end while
+                if cc.window == 0 or hardfails >= self.retry_max_count:
+                    raise self._TimeoutExcept("many")
             
-                finally: # Note: executes before `break'
-                    bfinished = (dest.index - binitial_index)
-                    assert bfinished % 4 == 0, "Should read a four-byte words. %d, init %d" %(bfinished, binitial_index)
-                    wfinished = bfinished//4
-                
             #end while
-            if wcwnd is 0:
-                raise self._TimeoutExcept("many")
+        finally:
+            if hasattr(dest, 'flush'): # data received in place is buffered
+                dest.flush()
         
-        #end while
-        self._fifo_transfer_reset(grp_no) #cleanup
+        if keep and in_place:
+            self._fifo_positions[grp_no] = (mem_no, woffset + wfinished)
+        else:
+            self._fifo_transfer_reset(grp_no) #cleanup
         return wfinished
         
+    def read_fifo_groups(self, jobs):
+        """
+        Read several FIFO regions, interleaving requests to different ADC groups.
+        Each group has its own transfer logic, so a request to one group is sent while data 
+        of another one is still on the link, and its setup latency overlaps with the transfer.
+        The setup of the next job of a group is sent right behind the last window of the current one
+        (the board runs it when the window is sent), and a job which starts where the previous one 
+        ended needs no setup at all.
+        Packets are matched to requests by packet identifier, a window with lost packets is
+        committed up to the first lost one and the rest is requested again.
+        Attrs:
+            jobs: a list of (dest, grp_no, mem_no, nwords, woffset), see read_fifo.
+                Jobs of the same group are read one after another, in the list order.
+        Returns:
+            (words, times): words read for each job, and {grp_no: seconds} from the start 
+            till the end of the last job of the group.
+        """
+        t0 = time.time()
+        if not self.codec.with_pid: # responces can't be told apart
+            words, times = [], {}
+            for idx, (dest, grp_no, mem_no, nwords, woffset) in enumerate(jobs):
+                following = [job for job in jobs[idx+1:] if job[1] == grp_no]
+                keep = bool(following) and (following[0][2], following[0][4]) == (mem_no, woffset + nwords)
+                words.append(self.read_fifo(dest, grp_no, mem_no, nwords, woffset, keep))
+                times[grp_no] = time.time() - t0
+            return words, times
+        
+        wmtu = self._fifo_wmtu()
+        mtu = wmtu * 4
+        
+        cc = self.congestion
+        cc.start(FIFO_READ_LIMIT, wmtu)
+        codec = self.codec
+        stats = self.fifo_stats
+        sock = self._sock
+        packet = bytearray(self.jumbo)
+        pview = memoryview(packet)
+        # packets which wait in the socket should fit into its buffer,
+        # (a kernel buffer takes about twice the payload size, Linux reports the doubled value)
+        budget = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 4
+        
+        words = [0] * len(jobs)
+        times = {}
+        groups = {}
+        for idx, job in enumerate(jobs):
+            grp = groups.get(job[1])
+            if grp is None:
+                grp = groups[job[1]] = _GroupTransfer(job[1])
+            grp.jobs.append(idx)
+            self._fifo_positions.pop(job[1], None) # the logic is reset at the end
+        inflight = {} # pid: group
+        ready = deque() # groups waiting for a free window slot
+        
+        def transmit(grp, msg):
+            """ Send a request with a new identifier, returns the identifier. """
+            pid = self.packet_identifier
+            self.packet_identifier = (pid + 1) & 0xFF
+            sock.sendto(msg(pid), self.address)
+            self.request_stats['requests'] += 1
+            inflight[pid] = grp
+            return pid
+        
+        def send(grp, msg, state):
+            inflight.pop(grp.pid, None)
+            grp.pid, grp.state, grp.t_sent = transmit(grp, msg), state, time.time()
+        
+        def setup_msg(grp_no, start):
+            """ Reset the transfer logic and start a read from `start' (mem_no, woffset) in one request. """
+            reg, cmd = self._fifo_read_cmd(grp_no, start[0], start[1])
+            return lambda pid: codec.vme_write(pid, [reg, 0, reg, cmd])
+        
+        def start_of(idx):
+            dest, grp_no, mem_no, nwords, woffset = jobs[idx]
+            return (mem_no, woffset + words[idx])
+        
+        def setup(grp):
+            """ Get the transfer logic to the current position of the job. """
+            while grp.jobs and words[grp.jobs[0]] >= jobs[grp.jobs[0]][3]:
+                dest = jobs[grp.jobs.popleft()][0]
+                if hasattr(dest, 'flush'): # do not hold a buffer of a pool till the end
+                    dest.flush()
+            prepared, grp.prepared = grp.prepared, None
+            if not grp.jobs:
+                inflight.pop(grp.pid, None)
+                if prepared:
+                    inflight.pop(prepared[0], None)
+                grp.state = None
+                times[grp.grp_no] = time.time() - t0
+                return
+            
+            start = start_of(grp.jobs[0])
+            if grp.position == start: # continues from the end of the previous job
+                stats['setups_skipped'] += 1
+                enqueue(grp)
+                return
+            if prepared and prepared[1] == start:
+                if prepared[3]: # done while the last window was received
+                    grp.position = start
+                    enqueue(grp)
+                else: # wait for it as for an ordinary setup
+                    inflight.pop(grp.pid, None)
+                    grp.pid, grp.state, grp.t_sent = prepared[0], 'setup', prepared[2]
+                    grp.target = start
+                return
+            if prepared: # the last window was not complete, the logic is somewhere else
+                inflight.pop(prepared[0], None)
+            
+            grp.position, grp.target = None, start
+            send(grp, setup_msg(grp.grp_no, start), 'setup')
+            stats['setups'] += 1
+        
+        def prepare(grp, idx):
+            """ Send the setup of job `idx' behind the last window of the current job. """
+            start = start_of(idx)
+            grp.prepared = [transmit(grp, setup_msg(grp.grp_no, start)), start, time.time(), False]
+            stats['setups'] += 1
+        
+        def enqueue(grp):
+            """ The transfer logic of the group is ready, send a data request when there is a free slot. """
+            inflight.pop(grp.pid, None)
+            grp.state = 'ready'
+            ready.append(grp)
+            dispatch()
+        
+        def dispatch():
+            while ready:
+                data = [g for g in set(inflight.values()) if g.state == 'data']
+                if data and (len(data) >= self.fifo_group_windows
+                        or (sum(g.wnum for g in data) + FIFO_READ_LIMIT) * 4 > budget):
+                    break
+                request(ready.popleft())
+        
+        def request(grp):
+            """ Request the next window of the job. """
+            idx = grp.jobs[0]
+            dest, grp_no, mem_no, nwords, woffset = jobs[idx]
+            wnum = int(min(nwords - words[idx], FIFO_READ_LIMIT, cc.window))
+            if wnum <= 0: # the window has collapsed
+                raise self._TimeoutExcept("many")
+            if hasattr(dest, 'buffer'):
+                grp.view = dest.buffer(wnum * 4)
+            else:
+                if grp.buf is None:
+                    grp.buf = memoryview(bytearray(FIFO_READ_LIMIT * 4))
+                grp.view = grp.buf[:wnum * 4]
+            grp.wnum = wnum
+            grp.npackets = (wnum * 4 + mtu - 1) // mtu
+            grp.count = 0
+            grp.t_first = None
+            fifo_addr = SIS3316_FPGA_ADC_GRP_MEM_BASE + grp_no * SIS3316_FPGA_ADC_GRP_MEM_OFFSET
+            send(grp, lambda pid: codec.fifo_read(pid, wnum, fifo_addr), 'data')
+            
+            if words[idx] + wnum >= nwords and len(grp.jobs) > 1 \
+                    and start_of(grp.jobs[1]) != (mem_no, woffset + nwords):
+                prepare(grp, grp.jobs[1]) # the last window, the next job is elsewhere
+        
+        def finish(grp, complete):
+            """ Commit what came in order, continue with the next window or job. """
+            idx = grp.jobs[0]
+            dest, grp_no, mem_no, nwords, woffset = jobs[idx]
+            got = bytearray(grp.npackets)
+            got[:grp.count] = b'\x01' * grp.count
+            sample = self._fifo_sample(grp.t_sent, grp.wnum, mtu, got, grp.t_first)
+            stats['packets'] += grp.count
+            
+            wdone = min(grp.count * wmtu, grp.wnum)
+            if hasattr(dest, 'commit'):
+                dest.commit(wdone * 4)
+            else:
+                dest.push(grp.view[:wdone * 4])
+            words[idx] += wdone
+            
+            if complete:
+                cc.on_success(sample)
+                grp.fails = 0
+                grp.position = (mem_no, woffset + words[idx])
+            elif grp.count:
+                stats['lost'] += 1
+                cc.on_loss(sample)
+                grp.fails = 0
+            else:
+                stats['congestion'] += 1
+                cc.on_congestion(sample)
+                grp.fails += 1
+            if not complete:
+                grp.position = None
+            
+            if words[idx] >= nwords:
+                setup(grp) # the next job
+            elif complete:
+                enqueue(grp) # the transfer logic continues from here
+            else:
+                setup(grp)
+            dispatch() # the window slot may be free now
+        
+        done = False
+        try:
+            self.cleanup_socket()
+            for grp in groups.values():
+                setup(grp)
+            t_rx = time.time() # the last time something came
+            
+            while inflight:
+                # the board serves requests one by one, so a request waits while anything else comes
+                now = time.time()
+                deadline = None
+                for grp in set(inflight.values()):
+                    if grp.state == 'setup':
+                        grp.deadline = max(grp.t_sent, t_rx) + self.rtt.timeout
+                    elif grp.t_first is None:
+                        grp.deadline = max(grp.t_sent, t_rx) + self.fifo_rtt.timeout
+                    else:
+                        grp.deadline = grp.t_last + self.fifo_idle_timeout
+                    if deadline is None or grp.deadline < deadline:
+                        deadline = grp.deadline
+                
+                if not select.select([sock], [], [], max(0, deadline - now))[0]:
+                    now = time.time()
+                    for grp in [g for g in set(inflight.values()) if g.deadline <= now]:
+                        self.request_stats['timeouts'] += 1
+                        if grp.state == 'data':
+                            finish(grp, False)
+                        else:
+                            grp.fails += 1
+                            setup(grp)
+                        if grp.fails >= self.retry_max_count:
+                            raise self._TimeoutExcept("many")
+                    continue
+                
+                nbytes = sock.recv_into(packet)
+                grp = inflight.get(packet[1]) if nbytes >= 3 else None
+                if grp is None: # a late packet
+                    continue
+                t_rx = time.time()
+                
+                if grp.state == 'setup' or packet[1] != grp.pid: # a setup, maybe a prepared one
+                    if packet[0] != 0x21:
+                        continue
+                    try:
+                        self.__status_err_check(packet[2])
+                    except self._SisFifoTimeoutExcept:
+                        pass # not reading anything, FIFO-empty bit can be '1'
+                    if packet[1] != grp.pid:
+                        inflight.pop(packet[1])
+                        grp.prepared[3] = True
+                    else:
+                        grp.position = grp.target
+                        enqueue(grp)
+                    continue
+                
+                if packet[0] != 0x30:
+                    continue
+                stat = packet[2]
+                self.__status_err_check(stat)
+                if grp.t_first is None:
+                    grp.t_first = t_rx
+                grp.t_last = t_rx
+                
+                if (stat & 0xF) != (grp.count & 0xF): # a packet is lost
+                    finish(grp, False)
+                    continue
+                
+                offset = grp.count * mtu
+                size = nbytes - 3
+                if offset + size > len(grp.view):
+                    raise self._WrongResponceExcept('The responce is too long')
+                grp.view[offset : offset + size] = pview[3:nbytes]
+                grp.count += 1
+                if grp.count == grp.npackets:
+                    finish(grp, True)
+            done = True
+        
+        finally:
+            for dest, grp_no, mem_no, nwords, woffset in jobs:
+                if hasattr(dest, 'flush'): # data received in place is buffered
+                    dest.flush()
+            
+            regs = [SIS3316_DATA_TRANSFER_GRP_CTRL_REG + 0x4 * grp_no for grp_no in groups]
+            if done:
+                self._write_vme(regs, [0] * len(regs)) #cleanup
+            else: # also after a failure, but keep its exception
+                try:
+                    self._write_vme(regs, [0] * len(regs))
+                except Sis3316Except:
+                    pass
+        return words, times
+        
     def write_fifo(self, source, grp_no, mem_no, nwords, woffset=0):
         pass
 
@@ -0,0 +1,148 @@
+#
+# This file is part of sis3316 python package.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Disk writes in a separate thread.
+# The readout receives FIFO data into buffers of a BufferPool (see readout.destination),
+# a full buffer is queued and a writer thread writes it to the file with one large write.
+# A slow disk does not stall the receive loop until all buffers wait for it,
+# then the readout waits for a free buffer (backpressure) instead of allocating more memory.
+
+import queue
+import threading
+from time import time
+
+
+class BufferPool(object):
+    """
+    `count' preallocated buffers of `size' bytes (not less than a FIFO read window, 256 KB)
+    and a writer thread to drain them.
+    Buffers of one target are written in the order they were submitted.
+    Keep at least one buffer per destination which is filled at the same time (a channel in readout_groups),
+    if all buffers are held by destinations and none is queued, get() adds one (counted as `added').
+    `stats':
+        waits, wait_time: how many times and how long the readout waited for a free buffer,
+        queued: buffers waiting for the disk now, high_watermark: the most of them at once,
+        writes, bytes, write_time, write_max: the writes done, and the longest one [s].
+    """
+
+    def __init__(self, count=32, size=4*1024*1024):
+        self.count = count
+        self.size = size
+        self._free = queue.Queue()
+        for i in range(count):
+            self._free.put(bytearray(size))
+        self._full = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+        self.stats = {'waits': 0, 'wait_time': 0., 'queued': 0, 'high_watermark': 0,
+            'writes': 0, 'bytes': 0, 'write_time': 0., 'write_max': 0., 'added': 0}
+
+    def start(self):
+        """ Start the writer thread (submit() does it if needed). """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sis3316-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def get(self):
+        """ A free buffer, waits for one if all are in use. """
+        self._check()
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if not self.stats['queued']: # no buffer would come back
+                self.stats['added'] += 1
+                self.count += 1
+                return bytearray(self.size)
+        t_start = time()
+        buf = self._free.get()
+        with self._lock:
+            self.stats['waits'] += 1
+            self.stats['wait_time'] += time() - t_start
+        return buf
+
+    def release(self, buf):
+        """ Return an unused buffer. """
+        self._free.put(buf)
+
+    def submit(self, target, buf, count):
+        """ Write the first `count' bytes of `buf' to `target', then return it to the pool. """
+        self._check()
+        self.start()
+        with self._lock:
+            stats = self.stats
+            stats['queued'] += 1
+            stats['high_watermark'] = max(stats['high_watermark'], stats['queued'])
+        self._full.put((target, buf, count))
+
+    @property
+    def pressure(self):
+        """ A fraction of buffers waiting for the disk. """
+        return self.stats['queued'] / float(self.count)
+
+    def drain(self):
+        """ Wait until everything submitted is written. """
+        if self._thread is not None:
+            self._full.join()
+        self._check()
+
+    def close(self):
+        """ Write everything submitted and stop the writer thread. """
+        if self._thread is not None:
+            self._full.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check()
+
+    def _check(self):
+        """ Raise a write error of the writer thread in the caller's one. """
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                self._full.task_done()
+                return
+
+            target, buf, count = item
+            t_start = time()
+            try:
+                view = memoryview(buf)[:count]
+                while len(view):
+                    view = view[target.write(view):] # a raw file may write less
+            except Exception as e: # reported to the readout thread, the data is lost
+                self._error = e
+            elapsed = time() - t_start
+            self._free.put(buf) # before `queued' is decreased, see get()
+
+            with self._lock:
+                stats = self.stats
+                stats['queued'] -= 1
+                stats['writes'] += 1
+                stats['bytes'] += count
+                stats['write_time'] += elapsed
+                stats['write_max'] = max(stats['write_max'], elapsed)
+            self._full.task_done()
+
+    def __repr__(self):
+        return 'BufferPool(count=%d, size=%d, queued=%d)' % (self.count, self.size, self.stats['queued'])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of register-read encoding and decoding (no hardware needed).
+`before' is the format-string based packing which was used until the codec module,
+`after' is the precompiled codec (sis3316.codec) with the device's packet counter.
+Each call encodes a VME read request and decodes its responce.
+"""
+
+import sys,os
+import argparse
+import re
+import timeit
+from struct import pack, unpack_from
+from numpy import uint8
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import sis3316
+
+
+class legacy (object):
+    """ _pack, _unpack_from and _check_packetID as they were before the codec. """
+    def __init__(self):
+        self.packet_identifier = 0
+    
+    def _pack(self, format, *args):
+        return pack('<B' + format[1:], self.packet_identifier, *args)
+    
+    def _unpack_from(self, format, resp):
+        match = re.search(r'(\A<[A-Z])|(\A<[a-z])', format)
+        unpackedMsg = unpack_from(match.group() + 'B' + format[len(match.group()):] , resp)
+        self._check_packetID( unpackedMsg[1] )
+        unpackedMsg = list(unpackedMsg)
+        unpackedMsg.pop(1)
+        return tuple(unpackedMsg)
+    
+    def _check_packetID(self, packetID):
+        if packetID != self.packet_identifier:
+            raise ValueError('packet identifier')
+        self.packet_identifier = uint8(self.packet_identifier + 1)
+    
+    def read(self, addrlist, resp):
+        cnum = len(addrlist)
+        msg = b''.join(( b'\x20', self._pack('<H%dI' % (cnum), cnum-1, *addrlist) ))
+        r = resp(msg)
+        hdr, stat = self._unpack_from('<BB', r[:3])
+        return unpack_from('<%dI' % (cnum), r[3:])
+
+
+def codec_read(dev, addrlist, resp):
+    codec = dev.codec
+    msg = codec.vme_read(dev.packet_identifier, addrlist)
+    r = resp(msg)
+    hdr, pid, stat = codec.header(r)
+    dev._check_packetID(pid)
+    return codec.words(r, len(addrlist))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=100000, help='calls per measurement')
+    parser.add_argument('-w', '--words', type=int, nargs='+', default=[1, 16, 64], help='addresses per request')
+    args = parser.parse_args()
+    
+    dev = sis3316.Sis3316_udp('127.0.0.1', 0, local_port=0)
+    old = legacy()
+    
+    print('%-6s %12s %12s %8s' % ('words', 'before, us', 'after, us', 'speedup'))
+    for nwords in args.words:
+        addrlist = list(range(0x1000, 0x1000 + 4*nwords, 4))
+        data = pack('<%dI' % nwords, *addrlist)
+        # a responce to the request: the same packet identifier, status 0, data words
+        responces = [bytes((0x20, pid, 0)) + data for pid in range(256)]
+        resp = lambda msg: responces[msg[1]]
+        
+        assert list(old.read(addrlist, resp)) == list(codec_read(dev, addrlist, resp)) == addrlist
+        
+        t_old = min(timeit.repeat(lambda: old.read(addrlist, resp), number=args.number, repeat=3)) / args.number
+        t_new = min(timeit.repeat(lambda: codec_read(dev, addrlist, resp), number=args.number, repeat=3)) / args.number
+        print('%-6d %12.2f %12.2f %7.1fx' % (nwords, t_old*1e6, t_new*1e6, t_old/t_new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of FIFO-read receive paths (no hardware needed).
+A local UDP sender answers every FIFO read request with a burst of packets,
+the same as SIS3316 does, and the client receives them with _recv_fifo_window
+and each receiver (sis3316.mmsg): loop is a recvmsg_into call per packet,
+batch is recvmmsg (where available).
+The whole burst is queued in the socket before the receive starts,
+so only the receiving side is measured.
+"""
+
+import sys,os
+import argparse
+import socket
+import struct
+import time
+from multiprocessing import Process, Event, Value
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import sis3316
+from sis3316.mmsg import LoopReceiver, batch_receiver
+
+
+def sender(port, mtu, ready, sent):
+    """ Answer FIFO read requests (0x30) with responce packets. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port.value = sock.getsockname()[1]
+    ready.set()
+
+    payload = bytes(mtu)
+    cache = {}
+
+    while True:
+        msg, address = sock.recvfrom(64)
+        if msg[0] != 0x30:
+            continue
+        pid, nwords = struct.unpack_from('<BH', msg, 1)
+
+        packets = cache.get(pid)
+        if packets is None:
+            packets = cache[pid] = [bytes((0x30, pid, seq)) + payload for seq in range(16)]
+
+        nbytes = (nwords + 1) * 4
+        seq = 0
+        while nbytes > mtu:
+            sock.sendto(packets[seq & 0xF], address)
+            nbytes -= mtu
+            seq += 1
+        sock.sendto(bytes((0x30, pid, seq & 0xF)) + payload[:nbytes], address)
+        sent.set()
+
+
+def bench(dev, sent, mode, batch, nwords, mtu, duration):
+    """ Returns (packets, receive seconds, failed requests). """
+    hdr_sz = 3 if dev.VME_FPGA_VERSION_IS_0008_OR_HIGHER else 2
+    dev.fifo_recv_batch = batch
+    if mode == 'loop':
+        dev._fifo_receiver = LoopReceiver(dev._sock, hdr_sz, batch)
+    else:
+        dev._fifo_receiver = batch_receiver(dev._sock, hdr_sz, batch)
+    target = bytearray(nwords * 4)
+    view = memoryview(target)
+    msg = b''.join(( b'\x30', dev._pack('<HI', nwords-1, sis3316.sis3316_udp.SIS3316_FPGA_ADC_GRP_MEM_BASE) ))
+    npackets = (nwords * 4 + mtu - 1) // mtu
+
+    packets = failed = 0
+    elapsed = 0.
+    t0 = time.time()
+    while time.time() - t0 < duration:
+        sent.clear()
+        dev._req(msg)
+        sent.wait()
+
+        t = time.perf_counter()
+        got, burst, t_first = dev._recv_fifo_window(view, mtu, dev.packet_identifier)
+        ok = 0 not in got
+        
+        if ok:
+            elapsed += time.perf_counter() - t
+            packets += npackets
+        else:
+            dev.cleanup_socket()
+            failed += 1
+
+    return packets, elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--words', type=int, default=sis3316.sis3316_udp.FIFO_READ_LIMIT//2, help='words per request')
+    parser.add_argument('-b', '--batch', type=int, default=64, help='packets per receiver call')
+    parser.add_argument('-t', '--time', type=float, default=2., help='seconds per receive path')
+    parser.add_argument('--jumbo', action='store_true', help='8192-byte packets')
+    parser.add_argument('--modes', nargs='+', default=['loop', 'batch'], choices=['loop', 'batch'])
+    args = parser.parse_args()
+
+    mtu = 8192 if args.jumbo else 1440
+
+    port, ready, sent = Value('i', 0), Event(), Event()
+    proc = Process(target=sender, args=(port, mtu, ready, sent))
+    proc.daemon = True
+    proc.start()
+    ready.wait()
+
+    dev = sis3316.Sis3316_udp('127.0.0.1', port.value, local_port=0)
+    dev._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8*1024*1024) # whole window fits in the socket
+
+    print('%-10s %12s %12s %10s %8s' % ('mode', 'packets/s', 'MB/s', 'us/packet', 'failed'))
+    for mode in args.modes:
+        packets, dt, failed = bench(dev, sent, mode, args.batch, args.words, mtu, args.time)
+        dt = max(dt, 1e-9)
+        print('%-10s %12.0f %12.1f %10.2f %8d' % (mode, packets/dt, packets*mtu/dt/1e6, dt/max(packets,1)*1e6, failed))
+
+    proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
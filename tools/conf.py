@@ -3,10 +3,12 @@
 
 # from __future__ import print_function
 import sys, os,  argparse, json
+import hashlib
 
 #sys.path.append("../")
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import sis3316
+from sis3316.common import set_bits
 
 def dump_conf(dev):
     if not isinstance(dev, sis3316.Sis3316_udp):
@@ -26,21 +28,118 @@ def dump_conf(dev):
     
     
 def conf_load(dev, config):
+    """ Load a configuration dict to the device. 
+    The config is compiled to a register plan (see conf_compile), 
+    plans are cached by config contents, so reloading the same config is fast.
+    """
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+    plan = _plan_cache.get(key)
+    if plan is None:
+        plan = conf_compile(dev, config)
+        _plan_cache[key] = plan
+    conf_apply(dev, plan)
+
+
+_plan_cache = {} # {config hash: plan}
+
+
+class _Uncompilable(Exception):
+    """ A property setter talks to the device directly. """
+
+
+def _walk(confpart, path=()):
+    """ Yield (path, key, value) for every property in a config dict. 
+    path is a sequence of (list attribute, index) pairs from the device to the object.
+    """
+    for key, val in confpart.items():
+        if isinstance(val, dict): #then key -- list, attr
+            for idx, subconfig in val.items():
+                for item in _walk(subconfig, path + ((key, int(idx)),) ):
+                    yield item
+        else:
+            yield path, key, val
+
+
+def _resolve(dev, path):
+    obj = dev
+    for attr, idx in path:
+        obj = getattr(obj, attr)[idx]
+    return obj
+
+
+def conf_compile(dev, config):
+    """ Compile a configuration dict to a plan: a list of steps 
+        ('regs', [(addr, mask, value), ...]) -- bit-fields merged per register,
+        ('set', path, key, value) -- properties which need a live exchange with the device (SPI, I2C...).
+    The order of the config is kept, consecutive register fields are merged into one 'regs' step.
+    The device is not accessed.
+    """
+    plan = []
+    regs = {} # {addr: [mask, value]}
     
-    def set_recur(obj, confpart, key_is_index = False, ):
-        for key, val in confpart.items():
-            key = key.encode('ascii','replace') #convert unicode strings to str
+    def record(addr, value, offset, mask):
+        mask_value = regs.setdefault(addr, [0, 0])
+        mask_value[0] |= mask << offset
+        mask_value[1] = set_bits(mask_value[1], value, offset, mask)
+    
+    def forbid(*args, **kwargs):
+        raise _Uncompilable
+    
+    def close_block():
+        if regs:
+            plan.append(('regs', [(addr, m, v) for addr, (m, v) in sorted(regs.items())] ))
+            regs.clear()
+    
+    dev._set_field, dev.read, dev.write = record, forbid, forbid
+    try:
+        for path, key, val in _walk(config):
+            saved = {addr: list(mv) for addr, mv in regs.items()}
+            try:
+                setattr(_resolve(dev, path), key, val)
+            except _Uncompilable:
+                regs.clear()
+                regs.update(saved) #drop the fields the setter did record
+                close_block()
+                plan.append(('set', path, key, val))
+        close_block()
+    finally:
+        del dev._set_field, dev.read, dev.write
+    
+    return plan
+
+
+def conf_apply(dev, plan):
+    """ Execute a compiled configuration plan. 
+    Registers are read and written with multi-address requests, unchanged registers are not written.
+    """
+    for step in plan:
+        if step[0] == 'set':
+            path, key, val = step[1:]
+            setattr(_resolve(dev, path), key, val)
+            continue
+        
+        link = [r for r in step[1] if r[0] < 0x20]
+        vme = [r for r in step[1] if r[0] >= 0x20]
+        
+        for addr, mask, value in link: #no multi-address requests for link interface
+            old = dev.read(addr)
+            new = (old & ~mask) | value
+            if new != old:
+                dev.write(addr, new)
+        
+        if vme:
+            addrs = [r[0] for r in vme]
+            olds = dev.read_list(addrs)
+            
+            waddrs, wdata = [], []
+            for (addr, mask, value), old in zip(vme, olds):
+                new = (old & ~mask) | value
+                if new != old:
+                    waddrs.append(addr)
+                    wdata.append(new)
             
-            if isinstance(val, dict): #then key -- list, attr
-                for idx, subconfig in val.items():
-                    idx = int(idx)
-                    a = getattr(obj, key.decode("utf-8") )
-                    set_recur(a[idx], subconfig)
-                
-            else:
-                setattr(obj, key.decode("utf-8"), val)
-                #~ print('set', obj, key, val)
-    set_recur(dev,config)
+            if waddrs:
+                dev.write_list(waddrs, wdata)
     
 
 def main():
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+''' Write an event index (FILE.idx) for raw data files: offsets and timestamps of every N-th event.
+An existing index is brought up to date, with --follow it is updated while the file grows.
+'''
+import sys
+import time
+import argparse
+
+from parse import update_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('infile', nargs='+', type=str,
+            help='raw data files')
+    parser.add_argument('--stride', type=int, default=256,
+            help='index every N-th event (of a new index)')
+    parser.add_argument('--maw-length', type=int, default=None,
+            help='MAW length of the config, if the MAW test buffer is saved')
+    parser.add_argument('--follow', type=float, default=None, metavar='SECONDS',
+            help='update the indexes every SECONDS until Ctrl+C')
+    args = parser.parse_args()
+
+    try:
+        while True:
+            for path in args.infile:
+                count = update_index(path, stride=args.stride, maw_length=args.maw_length)
+                sys.stderr.write('%s: %d entries\n' % (path, count))
+            if args.follow is None:
+                break
+            time.sleep(args.follow)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
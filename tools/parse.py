@@ -16,6 +16,13 @@ import io
 import ctypes 
 import signal
 import binascii
+import mmap
+import stat
+import bisect
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from sis3316 import framing
 
 debug = False #enable debug messages
 nevents = 0 #a number of events processed
@@ -33,42 +40,311 @@ __fields__ = (
     )
 
 
-class PeekableObject(object):
-    ''' A wrapper to a file object. Makes possible to read same data twice.
+MAX_HDR_LEN = 18 * 4 # [bytes]
+
+def event_dtype(header, maw_length=0):
+    ''' Guess a numpy dtype of an event from its header (as it is in a file).
+    Return (dtype, chan) or raise ValueError/EOFError.
+    Events with average data (0xA) are not supported.
+    '''
+    try:
+        ch_fmt, ts_hi = unpack('<HH', header[0:4])
+        ch, fmt = ch_fmt >> 4, (ch_fmt & 0xF)
+        
+        fields = [('ch_fmt', '<u2'), ('ts_hi', '<u2'), ('ts_lo', '<u4')]
+        if fmt & 0b1:
+            fields += [('peak', '<i2'), ('npeak', '<i2'), ('acc1_info', '<i4')]
+            fields += [('acc%d' % i, '<i4') for i in range(2, 7)]
+        if fmt & 0b10:
+            fields += [('acc7', '<i4'), ('acc8', '<i4')]
+        if fmt & 0b100:
+            fields += [('maw_max', '<i4'), ('maw_after_trig', '<i4'), ('maw_before_trig', '<i4')]
+        if fmt & 0b1000:
+            fields += [('e_start', '<i4'), ('e_max', '<i4')]
+        
+        pos = np.dtype(fields).itemsize #raw data header position [bytes]
+        hdr_raw = unpack('<I', header[pos:pos+4])[0]
+        
+    except struct_error:
+        raise EOFError
+    
+    OxE, fMAW, n_raw = hdr_raw >> 28,  bool(hdr_raw & (1<<27)),  2 * (hdr_raw & 0x1FFffFF)
+    
+    if OxE == 0xA:
+        raise ValueError('average data is not supported')
+    elif OxE != 0xE:
+        raise ValueError('no 0xE')
+    
+    if n_raw > Parse.MAX_RAW:
+        raise ValueError('n_raw is more than MAX_EVENT_LENGTH')
+    
+    fields.append(('hdr_raw', '<u4'))
+    if n_raw:
+        fields.append(('raw', '<i2', (n_raw,)))
+    if fMAW and maw_length:
+        fields.append(('maw', '<i4', (maw_length,)))
+    
+    return np.dtype(fields), ch
+
+
+def decode_buffer(buf, maw_length=0):
+    ''' Decode back-to-back events of the same format from a bytes-like `buf`.
+    The format is taken from the first event, decoding stops on the first event 
+    which doesn't match it (or doesn't look like ADC data).
+    
+    Returns (events, nbytes): a numpy structured array with fields
+        ts, chan, [peak, npeak, info, acc1..acc8], [maw_*], [e_start, e_max], [raw], [maw]
+    (depending on the format bits) and a number of bytes decoded.
+    Raise ValueError if the first event is wrong, EOFError if there is no complete event in `buf`.
+    '''
+    dtype, ch = event_dtype(bytes(buf[:MAX_HDR_LEN]), maw_length)
+    sz = dtype.itemsize
+    count = len(buf) // sz
+    if not count:
+        raise EOFError
+    
+    data = np.frombuffer(buf, dtype=dtype, count=count)
+    names = dtype.names
+    
+    # validate headers all at once
+    valid = (data['ch_fmt'] == data['ch_fmt'][0])
+    valid &= (data['hdr_raw'] >> 28) == 0xE
+    valid &= (data['hdr_raw'] & 0xFffFFFF) == (data['hdr_raw'][0] & 0xFffFFFF)
+    for a in ('acc2','acc3','acc4','acc5','acc6','acc7','acc8',
+            'maw_max','maw_after_trig','maw_before_trig'):
+        if a in names:
+            valid &= data[a] < (1<<28)
+    
+    if not valid.all():
+        count = int(np.argmin(valid))
+        if count == 0:
+            raise ValueError('wrong event header')
+        data = data[:count]
+    
+    # output array
+    out_fields = [('ts', '<u8'), ('chan', '<u2')]
+    for name, descr in zip(names, dtype.descr):
+        if name == 'acc1_info':
+            out_fields += [('info', '<i2'), ('acc1', '<i4')]
+        elif name not in ('ch_fmt', 'ts_hi', 'ts_lo', 'hdr_raw'):
+            out_fields.append(descr)
+    
+    events = np.empty(count, dtype=out_fields)
+    events['ts'] = (data['ts_hi'].astype(np.uint64) << np.uint64(32)) + data['ts_lo']
+    events['chan'] = ch
+    for name in events.dtype.names:
+        if name in names:
+            events[name] = data[name]
+    if 'acc1_info' in names:
+        events['acc1'] = data['acc1_info'] & 0xffffff
+        events['info'] = data['acc1_info'] >> 24
+    
+    return events, count * sz
+
+
+def _header_layout(fmt):
+    ''' Offsets of the raw data header and of words with 4 zero high bits (acc2..acc8, maw_*) in an event header. '''
+    pos, zero = 8, []
+    if fmt & 0b1:
+        zero += [16, 20, 24, 28, 32] # acc2..acc6
+        pos += 7 * 4
+    if fmt & 0b10:
+        zero += [pos, pos + 4]
+        pos += 2 * 4
+    if fmt & 0b100:
+        zero += [pos, pos + 4, pos + 8]
+        pos += 3 * 4
+    if fmt & 0b1000:
+        pos += 2 * 4
+    return pos, zero
+
+_HEADER_LAYOUTS = [_header_layout(fmt) for fmt in range(16)]
+_RAW_HDR_POS = np.array([pos for pos, zero in _HEADER_LAYOUTS])
+
+def find_event_candidates(buf, start=0):
+    ''' Offsets in a bytes-like `buf` (not less than `start`) where an event may begin:
+    the raw data header is where the format bits of the first word put it, it has the 0xE marker 
+    (or 0xA with an 0xE average data header after it), a sample count not more than Parse.MAX_RAW,
+    and the accumulator and MAW values have zero high bits.
+    Only places with the whole header in `buf` are checked.
+    Returns a numpy array of offsets, in order.
+    '''
+    a = np.frombuffer(buf, np.uint8)
+    i = np.arange(start, max(start, len(a) - 11)) # the shortest event header is 3 words
+    pos = i + _RAW_HDR_POS[a[i] & 0xF]
+    inside = pos + 4 <= len(a)
+    pos = np.where(inside, pos, 0)
+    
+    marker = a[pos + 3] >> 4
+    ok = inside & ((marker == 0xE) | (marker == 0xA))
+    i, pos, marker = i[ok], pos[ok], marker[ok] # a few candidates left
+    
+    n_raw = a[pos].astype(np.int64) | (a[pos + 1].astype(np.int64) << 8) | (a[pos + 2].astype(np.int64) << 16)
+    n_raw |= (a[pos + 3] & 0x1).astype(np.int64) << 24
+    ok = 2 * n_raw <= Parse.MAX_RAW
+    
+    avg = marker == 0xA # the average data header is read from the first MAX_HDR_LEN bytes (see Parse._parse_next)
+    ok[avg] &= (pos[avg] + 12 <= np.minimum(i[avg] + MAX_HDR_LEN, len(a)))
+    ok[avg] &= (a[np.where(ok & avg, pos + 11, 0)[avg]] >> 4) == 0xE
+    
+    fmt = a[i] & 0xF
+    for f in np.unique(fmt[ok]):
+        zero = _HEADER_LAYOUTS[f][1]
+        sel = ok & (fmt == f)
+        for offset in zero:
+            ok[sel] &= (a[i[sel] + offset + 3] >> 4) == 0
+    return i[ok]
+
+
+RESYNC_WINDOW = 256 * 1024 # [bytes] scanned at once
+
+
+def count_events(path, maw_length=0):
+    ''' Count events in a file of back-to-back events of the same format (a channel file of a run)
+    by the file size (payload sizes of a framed file) and the format of the first event.
+    Returns (events, nbytes): a number of whole events and bytes after them (a truncated event),
+    events is None if the file doesn't start with ADC data.
+    '''
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        header = f.read(framing.HEADER.size + MAX_HDR_LEN)
+        if header[:len(framing.MAGIC)] == framing.MAGIC:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            frames = framing.scan(buf)
+            payload = [min(f_['words'], (size - f_['payload']) // 4) if f_['valid'] is None else f_['valid']
+                for f_ in frames] # an incomplete frame has as much as there is in the file
+            header = buf[framing.HEADER.size : framing.HEADER.size + MAX_HDR_LEN]
+            buf.close()
+        else:
+            payload = [size // 4]
+    if not size:
+        return 0, 0
+    
+    try:
+        dtype, ch = event_dtype(header, maw_length)
+    except (ValueError, EOFError):
+        return None, size
+    events, nbytes = 0, 0
+    for words in payload: # events do not cross frames
+        n, rest = divmod(words * 4, dtype.itemsize)
+        events += n
+        nbytes += rest
+    return events, nbytes + size % 4
+
+
+class MmapObject(object):
+    ''' A zero-copy reader of a static file. 
+    The file is memory-mapped, peek() returns memoryview slices of it.
     '''
-    #TODO: check if some optimization is needed
     
     def __init__(self, fileobj):
         self.fileobj = fileobj
-        self.buf = b''
+        self.pos = fileobj.tell()
+        self.size = os.fstat(fileobj.fileno()).st_size
+        
+        if self.size:
+            self._mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buf = memoryview(self._mmap)
+        else: #can't map an empty file
+            self._mmap = None
+            self.buf = memoryview(b'')
+        
+    def peek(self, size=None):
+        ''' Get some data without moving forward. '''
+        if size is None:
+            return self.buf[self.pos:]
+        return self.buf[self.pos:self.pos + size]
+            
+    def skip(self, size):
+        ''' Move the cursor forward. '''
+        self.pos = min(self.pos + size, self.size)
+
+    def read(self, size=None):
+        contents = self.peek(size)
+        self.skip(len(contents))
+        return contents
+    
+    def next_frame(self):
+        ''' Not framed, there is no next frame. '''
+        return False
+        
+    def progress(self):
+        if self.size:
+            return float(self.pos) / self.size
+        else:
+            return 0
+
+
+class RingBufferObject(object):
+    ''' A wrapper to a file object (a pipe or a growing file). Makes possible to read same data twice.
+    Data is kept in a bounded preallocated buffer, peek() returns memoryview slices of it, 
+    so they are valid only until the next peek/skip call.
+    '''
+    CAPACITY = 16 * 1024 * 1024 # [bytes], grows if a larger peek is requested
+    
+    def __init__(self, fileobj, capacity=None):
+        self.fileobj = fileobj
         self.pos = 0
+        self._buf = bytearray(capacity or self.CAPACITY)
+        self._view = memoryview(self._buf)
+        self._start = 0 #first unread byte in buffer
+        self._end = 0 #end of valid data in buffer
+    
+    def _fill(self, size):
+        ''' Read the file until at least `size` bytes are buffered (or no more data). '''
+        avail = self._end - self._start
+        
+        if size > len(self._buf): #grow
+            buf = bytearray(max(size, 2 * len(self._buf)))
+            buf[:avail] = self._view[self._start:self._end]
+            self._buf, self._view = buf, memoryview(buf)
+            self._start, self._end = 0, avail
         
+        elif self._start + size > len(self._buf): #no room in the tail, move data to the front
+            self._view[:avail] = self._view[self._start:self._end]
+            self._start, self._end = 0, avail
+        
+        while self._end - self._start < size:
+            count = self.fileobj.readinto(self._view[self._end:])
+            if not count: #EOF or no data yet
+                break
+            self._end += count
+    
     def peek(self, size=None):
         ''' Read some data and put it to internal buffer. '''
         if size is None:
-            self.buf += self.fileobj.read()
-            return self.buf
+            while True: # until EOF
+                end = self._end
+                self._fill(len(self._buf) - self._start + 1)
+                if self._end == end:
+                    break
+            return self._view[self._start:self._end]
         
-        if size > len(self.buf):
-            contents = self.fileobj.read(size - len(self.buf))
-            self.buf += contents
+        if size > self._end - self._start:
+            self._fill(size)
         
-        sz = min(len(self.buf), size)
-        
-        return self.buf[:sz]
+        return self._view[self._start:min(self._end, self._start + size)]
             
     def skip(self, size):
-        ''' Shrink internal buffer. '''
-        if size > len(self.buf): #TODO: refactor
-            self.peek(size - len(self.buf))
+        ''' Move forward, drop the data from internal buffer. '''
+        avail = self._end - self._start
+        if size > avail:
+            self._fill(size)
+            size = min(size, self._end - self._start)
             
         self.pos += size
-        self.buf = self.buf[size:]
+        self._start += size
+        if self._start == self._end: #empty, rewind
+            self._start = self._end = 0
 
     def read(self, size=None):
-        contents = self.peek(size)
-        self.skip(size)
+        contents = bytes(self.peek(size))
+        self.skip(len(contents))
         return contents
+    
+    def next_frame(self):
+        ''' Not framed, there is no next frame. '''
+        return False
         
     def progress(self):
         try:
@@ -79,12 +355,194 @@ class PeekableObject(object):
             return float(self.pos) / sz
         else:
             return 0
+
+PeekableObject = RingBufferObject # backward compatibility
+
+
+class FrameReader(object):
+    ''' Payload of a framed file (see sis3316.framing) read through a MmapObject or RingBufferObject.
+    peek() does not cross the end of the current frame (events do not cross frames),
+    next_frame() moves to the payload of the next frame. Padding of failed reads is not shown
+    if the trailer is in the file already. Bytes which are not a frame header are skipped.
+    '''
+    
+    def __init__(self, reader):
+        self.reader = reader
+        self.frame = None # header of the current frame
+        self.left = 0 # payload bytes of the current frame left
+        self.pad = 0 # bytes between them and the trailer
+        self.complete = False # the trailer has been read
+        self.skipped = 0 # bytes which are not frames
+    
+    @property
+    def pos(self):
+        return self.reader.pos
+    
+    def _trailer(self):
+        ''' Read the trailer of the current frame if it is in the file, limit the payload to valid words. '''
+        size = self.left + self.pad
+        buf = self.reader.peek(size + framing.TRAILER.size)
+        if len(buf) < size + framing.TRAILER.size:
+            return
+        try:
+            valid, crc = framing.unpack_trailer(buf[size:])
+        except ValueError: # broken, take the payload as it is
+            pass
+        else:
+            done = self.frame['words'] * 4 - size
+            self.left = max(0, valid * 4 - done)
+            self.pad = size - self.left
+        self.complete = True
+    
+    def _advance(self):
+        ''' Go to the payload of the next non-empty frame. Returns False if it is not in the file (yet). '''
+        reader = self.reader
+        while not self.left:
+            if self.frame is not None: # skip the padding and the trailer
+                size = self.pad + framing.TRAILER.size
+                if len(reader.peek(size)) < size:
+                    return False
+                reader.skip(size)
+                self.frame = None
+            
+            header = reader.peek(framing.HEADER.size)
+            if len(header) < framing.HEADER.size:
+                return False
+            try:
+                frame = framing.unpack_header(header)
+            except ValueError: #jump to the next magic
+                buf = reader.peek(RESYNC_WINDOW)
+                found = bytes(buf).find(framing.MAGIC, 1)
+                step = found if found > 0 else max(1, len(buf) - len(framing.MAGIC) + 1)
+                reader.skip(step)
+                self.skipped += step
+                continue
+            reader.skip(framing.HEADER.size)
+            self.frame = frame
+            self.left, self.pad, self.complete = frame['words'] * 4, 0, False
+            if isinstance(reader, MmapObject): # the whole file is there
+                self._trailer()
+        return True
+    
+    def peek(self, size=None):
+        if not self.left and not self._advance():
+            return self.reader.peek(0)
+        if size is None or size >= self.left:
+            if not self.complete:
+                self._trailer()
+            size = self.left
+        return self.reader.peek(size)
+    
+    def skip(self, size):
+        size = min(size, self.left)
+        self.reader.skip(size)
+        self.left -= size
+    
+    def read(self, size=None):
+        contents = bytes(self.peek(size))
+        self.skip(len(contents))
+        return contents
+    
+    def seek(self, frame, offset):
+        ''' Continue from a file `offset` in the payload of `frame` (see sis3316.framing.scan). '''
+        self.reader.pos = offset
+        self.frame = frame
+        self.left = frame['payload'] + frame['words'] * 4 - offset
+        self.pad, self.complete = 0, False
+        if isinstance(self.reader, MmapObject):
+            self._trailer()
+    
+    def next_frame(self):
+        ''' Skip the rest of the current frame (a truncated event). 
+        Returns False if the frame is still being written, or there are no more frames.
+        '''
+        if self.frame is not None:
+            if not self.complete:
+                self._trailer()
+            if not self.complete:
+                return False
+            self.reader.skip(self.left)
+            self.pad += self.left
+            self.left = 0
+        return self._advance()
         
+    def progress(self):
+        return self.reader.progress()
+
+
+def _is_regular_file(fileobj):
+    try:
+        return stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+        
+
+def _event_layout(fmt, n_raw, n_avg, n_maw):
+    ''' Build a ctypes structure of an event: format bits, numbers of raw samples, average samples
+    (None if there is no average data header) and MAW words. 
+    It has the arguments as `key`, precomputed `size` [bytes] and `offsets` of fields.
+    '''
+    c_format = [
+            ("fmt", ctypes.c_uint, 4),
+            ("chan", ctypes.c_uint, 12),
+            ("ts_hi", ctypes.c_uint, 16),
+            ("ts_lo2", ctypes.c_uint16),
+            ("ts_lo1", ctypes.c_uint16),
+            ]
+    if fmt & 0b1:
+        c_format.extend([
+                ('peak', ctypes.c_int16),
+                ('npeak', ctypes.c_int16),
+                ('acc1_info', ctypes.c_int32),
+                ('acc2', ctypes.c_int32),
+                ('acc3', ctypes.c_int32),
+                ('acc4', ctypes.c_int32),
+                ('acc5', ctypes.c_int32),
+                ('acc6', ctypes.c_int32),
+                ])
+    if fmt & 0b10:
+        c_format.extend([
+                ('acc7', ctypes.c_int32),
+                ('acc8', ctypes.c_int32),
+                ])
+    if fmt & 0b100:
+        c_format.extend([
+                ('maw_max', ctypes.c_int32),
+                ('maw_after_trig', ctypes.c_int32),
+                ('maw_before_trig', ctypes.c_int32),
+                ])
+    if fmt & 0b1000:
+        c_format.extend([
+                ('e_start', ctypes.c_int32),
+                ('e_max', ctypes.c_int32),
+                ])
+    
+    c_format.append( ('hdr_raw', ctypes.c_uint32))
+    if n_avg is not None:
+        c_format.append( ('hdr_avg', ctypes.c_uint32))
+    if n_raw:
+        c_format.append( ('raw', ctypes.c_int16 * n_raw) )
+    if n_avg:
+        c_format.append( ('avg', ctypes.c_int16 * n_avg) )
+    if n_maw:
+        c_format.append( ('maw', ctypes.c_int32 * n_maw) )
+    
+    # build a ctypes structure class
+    class CtypesStruct(ctypes.LittleEndianStructure):
+        _pack_ = 1 #align bitfields without gaps in 1 byte packages (look up pack pragma[n])
+        _fields_ = c_format
+    CtypesStruct.__name__ = 'fmt%d_raw%d' % (fmt, n_raw)
+    CtypesStruct.key = (fmt, n_raw, n_avg, n_maw)
+    CtypesStruct.size = ctypes.sizeof(CtypesStruct)
+    CtypesStruct.offsets = dict((f[0], getattr(CtypesStruct, f[0]).offset) for f in c_format)
+    return CtypesStruct
+
 
 class Parse:
     '''
     Get a fileobject.
     Return the next event if any or raise StopIteration if no more events.                              
+    Framed files (see sis3316.framing) are recognized by the first bytes, events are read from frame payloads.
     '''
     
     MAX_RAW = 65536
@@ -93,24 +551,165 @@ class Parse:
     
     MAW_LENGTH = 1000 # MAW length not auto detected, fill this to match your config file if you want to parse it 
 
-    def __init__(self, fileobj ):
+    def __init__(self, fileobj, follow=False):
+        ''' Set `follow' if the file is still being written. '''
         #check fieldnames
         self._format_cache = None #cached format
+        self._layouts = {} #event structures by (format bits, n_raw, n_avg, MAW length), see _event_layout
+        self.layout_stats = {'hits': 0, 'misses': 0} #_layouts lookups
         self._last_evt = None #cached last event
+        self._framed = None #unknown until there is data
+        self._frames = None #cached frames(), a static file does not change
+        self._skipped = 0 #bytes skipped by _resync()
+        self._fileobj = fileobj
             
         #warn on a common mistake
         if fileobj.isatty():
             raise ValueError('You are trying to read data from a terminal.')
         
-        self._reader = PeekableObject(fileobj)
+        if follow or not _is_regular_file(fileobj):
+            self._reader = RingBufferObject(fileobj)
+        else:
+            self._reader = MmapObject(fileobj)
         
     
     def __iter__(self):
         return self
 
     
+    def _check_framing(self):
+        ''' Read frame payloads if the file starts with a frame header (decided when the first bytes are there). '''
+        if self._framed is None:
+            head = self._reader.peek(len(framing.MAGIC))
+            if len(head) == len(framing.MAGIC):
+                self._framed = bytes(head) == framing.MAGIC
+                if self._framed:
+                    self._reader = FrameReader(self._reader)
+        return self._framed
+    
+    def frames(self):
+        ''' Frames of a framed file (see sis3316.framing.scan), an empty list for other files. '''
+        if not self._check_framing():
+            return []
+        base = self._reader.reader
+        if isinstance(base, MmapObject):
+            if self._frames is None:
+                self._frames = framing.scan(base.buf)
+            return self._frames
+        
+        buf = mmap.mmap(self._fileobj.fileno(), 0, access=mmap.ACCESS_READ) #the file grows, scan it again
+        try:
+            return framing.scan(buf)
+        finally:
+            buf.close()
+    
+    def seek_frame(self, frame):
+        ''' Continue from the beginning of a frame (one of frames()). '''
+        self._seek(frame['payload'], frame)
+    
+    def _seek(self, offset, frame=None):
+        ''' Continue from an event at a file `offset` (in the payload of `frame` of a framed file). '''
+        self._check_framing()
+        base = self._reader.reader if self._framed else self._reader
+        if isinstance(base, RingBufferObject): #drop the buffered data
+            self._fileobj.seek(offset)
+            base = RingBufferObject(self._fileobj)
+        base.pos = offset
+        self._last_evt = None
+        
+        if not self._framed:
+            self._reader = base
+            return
+        
+        if frame is None:
+            frames = self.frames()
+            i = bisect.bisect_right([f['payload'] for f in frames], offset) - 1
+            if i < 0:
+                raise ValueError('offset %d is not in a frame' % offset)
+            frame = frames[i]
+        skipped = self._reader.skipped
+        self._reader = FrameReader(base)
+        self._reader.skipped = skipped
+        self._reader.seek(frame, offset)
+    
+    @property
+    def skipped(self):
+        ''' Bytes skipped since they don't look like ADC data (or frames). '''
+        return self._skipped + (self._reader.skipped if self._framed else 0)
+    
+    def _resync(self):
+        ''' Skip at least a byte, to the next place which may be an event (see find_event_candidates).
+        Returns the number of bytes skipped.
+        '''
+        reader = self._reader
+        skipped = 0
+        size = 4096 #grows up to RESYNC_WINDOW, a candidate is often close
+        while True:
+            buf = reader.peek(size)
+            found = find_event_candidates(buf, 1)
+            if len(found):
+                step = int(found[0])
+            else: #keep a tail which may be a beginning of an event
+                step = min(len(buf), max(1, len(buf) - MAX_HDR_LEN + 1))
+            reader.skip(step)
+            skipped += step
+            if len(found) or len(buf) < size:
+                break
+            size = min(2 * size, RESYNC_WINDOW)
+        
+        if debug:
+            print('resync: skipped %d bytes, pos:%d' % (skipped, reader.pos))
+        self._skipped += skipped
+        return skipped
+    
+    def seek_event(self, n, index=None):
+        ''' Continue from the event number `n` (counted from 0), an index (see update_index) tells 
+        where to start looking for it. `index` is (stride, entries), the file's .idx is loaded by default.
+        Returns False if there are less events.
+        '''
+        stride, entries = index or load_index(self._fileobj.name + INDEX_EXT)
+        k = min(n // stride, len(entries) - 1)
+        if k >= 0:
+            self._seek(int(entries[k]['offset']))
+            first = k * stride
+        else:
+            self._seek(0)
+            first = 0
+        
+        for i in range(first, n): #parse the rest
+            try:
+                self.next()
+            except StopIteration:
+                return False
+        return True
+    
+    def seek_time(self, ts, index=None):
+        ''' Continue from the first event with a timestamp not less than `ts` (clock ticks),
+        timestamps should grow along the file (a run). See seek_event() for `index`.
+        Returns the number of the event, or None if there is no such event.
+        '''
+        stride, entries = index or load_index(self._fileobj.name + INDEX_EXT)
+        k = int(np.searchsorted(entries['ts'], ts, side='right')) - 1
+        if k >= 0:
+            self._seek(int(entries[k]['offset']))
+            n = k * stride
+        else:
+            self._seek(0)
+            n = 0
+        
+        while True:
+            try:
+                evt = self.next()
+            except StopIteration:
+                return None
+            if evt.ts >= ts:
+                self._last_evt = None #return it once more
+                return n
+            n += 1
+    
     def next(self):
         """ Return events. """
+        self._check_framing()
         reader = self._reader
         format_ = self._format_cache
         
@@ -142,11 +741,13 @@ class Parse:
                     format_ = None
                     continue
                 else: #wrong data?
-                    reader.skip(1) #skip a byte, maybe further data is ok
+                    self._resync() #skip to where further data may be ok
                     continue
                 
             except EOFError:
                 self._last_evt = None
+                if reader.next_frame(): #a truncated event at the end of a frame
+                    continue
                 raise StopIteration
             
             if evt:
@@ -171,56 +772,16 @@ class Parse:
             #print('header: %s' % binascii.hexlify(header[0:20]) )
             print('header: %s' % header[0:20] )
         
-        c_format = [
-                ("fmt", ctypes.c_uint, 4),
-                ("chan", ctypes.c_uint, 12),
-                ("ts_hi", ctypes.c_uint, 16),
-                ("ts_lo2", ctypes.c_uint16),
-                ("ts_lo1", ctypes.c_uint16),
-                ]
         try:
             ch_fmt, ts_hi = unpack('<HH', header[0:4] )
-            ch, fmt = ch_fmt >> 4, (ch_fmt & 0xF)
-            pos = 8 #raw data header position [bytes]
-            
-            if fmt & 0b1:
-                pos += 7 * 4
-                c_format.extend([
-                        ('peak', ctypes.c_int16),
-                        ('npeak', ctypes.c_int16),
-                        ('acc1_info', ctypes.c_int32),
-                        ('acc2', ctypes.c_int32),
-                        ('acc3', ctypes.c_int32),
-                        ('acc4', ctypes.c_int32),
-                        ('acc5', ctypes.c_int32),
-                        ('acc6', ctypes.c_int32),
-                        ])
-            if fmt & 0b10:
-                pos += 2 * 4
-                c_format.extend([
-                        ('acc7', ctypes.c_int32),
-                        ('acc8', ctypes.c_int32),
-                        ])
-            if fmt & 0b100:
-                pos += 3 * 4
-                c_format.extend([
-                        ('maw_max', ctypes.c_int32),
-                        ('maw_after_trig', ctypes.c_int32),
-                        ('maw_before_trig', ctypes.c_int32),
-                        ])
-            if fmt & 0b1000:
-                pos += 2 * 4
-                c_format.extend([
-                        ('e_start', ctypes.c_int32),
-                        ('e_max', ctypes.c_int32),
-                        ])
+            fmt = ch_fmt & 0xF
+            pos = _HEADER_LAYOUTS[fmt][0] #raw data header position [bytes]
             
             hdr_raw = unpack('<I', header[pos:pos+4] )[0]
             OxE, fMAW, n_raw = hdr_raw >> 28,  bool(hdr_raw & (1<<27)),  2 * (hdr_raw & 0x1FFffFF)
             pos += 4
-            c_format.append( ('hdr_raw', ctypes.c_uint32))
             
-            n_avg = 0
+            n_avg = None #no average data header
             
             if n_raw > self.MAX_RAW:
                 raise ValueError('n_raw is more than MAX_EVENT_LENGTH')
@@ -231,49 +792,36 @@ class Parse:
                 
                 if OxE != 0xE: 
                     raise ValueError('no 0xE after 0xA')
-                
-                pos += 4
-                c_format.append( ('hdr_avg', ctypes.c_uint32))
         
             elif OxE != 0xE:
                 raise ValueError('no 0xE')
-            
-            if n_raw:
-                pos += 2 * n_raw
-                c_format.append( ('raw', ctypes.c_int16 * n_raw) )
-                    
-            if n_avg:
-                pos += 2 * n_avg
-                c_format.append( ('avg', ctypes.c_int16 * n_avg) )
-            
-            
-            # There is no MAW length field :`(,
-            # so it's not easy to calculate actual event length looking on the data...
-            #
-            # A reasonable workaround is to try to find the next higher timestamp value, since it changes
-            # only once in 17 seconds (on 250 MHz), and assume that MAW is everything between the pos
-            # and the next timestamp.
-            #
-            if fMAW and self.MAW_LENGTH:
-                n_maw=self.MAW_LENGTH
-                pos += 4 * n_maw
-                c_format.append( ('maw', ctypes.c_int32 * n_maw) )
 
         except struct_error:
             # occures than len(header[slice]) is less then expected
             #~ print "eof nohdr" #DELME
             raise EOFError
         
-        # build a ctypes structure class
-        class CtypesStruct(ctypes.LittleEndianStructure):
-            _pack_ = 1 #align bitfields without gaps in 1 byte packages (look up pack pragma[n])
-            _fields_ = c_format
-        CtypesStruct.__name__ = 'ch' + str(ch)
+        # There is no MAW length field :`(,
+        # so it's not easy to calculate actual event length looking on the data...
+        #
+        # A reasonable workaround is to try to find the next higher timestamp value, since it changes
+        # only once in 17 seconds (on 250 MHz), and assume that MAW is everything between the pos
+        # and the next timestamp.
+        #
+        n_maw = self.MAW_LENGTH if fMAW else 0
+        
+        key = (fmt, n_raw, n_avg, n_maw)
+        try:
+            layout = self._layouts[key]
+            self.layout_stats['hits'] += 1
+        except KeyError:
+            layout = self._layouts[key] = _event_layout(*key)
+            self.layout_stats['misses'] += 1
         
         if debug:
-            print('header size ', ctypes.sizeof(CtypesStruct), ' [bytes]')
+            print('header size ', layout.size, ' [bytes]')
         
-        return CtypesStruct
+        return layout
     
     def _peek_next(self, format_):
         """ Interprete bytes from _reader according to format_.
@@ -281,7 +829,7 @@ class Parse:
         if not format_:
             raise ValueError("no format")
         
-        sz = ctypes.sizeof(format_) #estimated length
+        sz = format_.size #estimated length
         data = self._reader.peek(sz)
         try:
             evt = format_.from_buffer_copy(data) #raises ValueError if not enougth data
@@ -307,6 +855,10 @@ class Parse:
             else:
                 raise ValueError('no 0xE in hdr_raw')
         
+        #check the format (the cached one may be of a previous event)
+        if evt.fmt != format_.key[0] or 2 * (evt.hdr_raw & 0x1FFffFF) != format_.key[1]:
+            raise ValueError('another event format')
+        
         #check 0 blocks
         for a in ['acc1','acc2','acc3','acc4','acc5','acc6','acc7','acc8',
     'maw_max','maw_after_trig','maw_before_trig']:
@@ -317,6 +869,42 @@ class Parse:
     
     __next__ = next
     
+    def iter_batches(self, n=10000, offsets=False):
+        ''' Yield events as numpy structured arrays of up to `n` events (see decode_buffer).
+        Bytes which doesn't look like ADC data will be skipped.
+        With `offsets` yield (events, offsets): and an array of file offsets of the events.
+        '''
+        self._check_framing()
+        reader = self._reader
+        
+        if self._last_evt:
+            reader.skip(self._last_evt.sz) #move forward
+            self._last_evt = None
+        
+        while True:
+            try:
+                dtype, ch = event_dtype(reader.peek(MAX_HDR_LEN), self.MAW_LENGTH)
+                buf = reader.peek(n * dtype.itemsize)
+                events, nbytes = decode_buffer(buf, self.MAW_LENGTH)
+            
+            except ValueError as e:
+                if debug:
+                    print('skip %s, pos:%d' % (str(e), reader.pos) )
+                self._resync() #skip to where further data may be ok
+                continue
+                
+            except EOFError:
+                if reader.next_frame(): #a truncated event at the end of a frame
+                    continue
+                return
+            
+            offset = reader.pos
+            reader.skip(nbytes)
+            if offsets: #events of a batch are back to back
+                yield events, offset + np.arange(len(events), dtype=np.uint64) * np.uint64(nbytes // len(events))
+            else:
+                yield events
+    
     
     def get_channels(self): #REFACTORING NEEDED
         if self._last_evt:
@@ -326,13 +914,73 @@ class Parse:
         return self._reader.progress()
 
 
-def fin(signal=None, frame=None):
+INDEX_EXT = '.idx' # chNN.dat.idx
+INDEX_MAGIC = b'S316IDX1'
+INDEX_HEADER = np.dtype([('magic', 'S8'), ('stride', '<u4'), ('reserved', '<u4')])
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('ts', '<u8')]) # of every `stride`-th event
+
+def load_index(path):
+    ''' Read an event index file. Returns (stride, entries): entry k is the file offset
+    and the timestamp of the event number k * stride.
+    Raises ValueError if it is not an index file.
+    '''
+    with open(path, 'rb') as f:
+        header = np.frombuffer(f.read(INDEX_HEADER.itemsize), INDEX_HEADER)
+        if not len(header) or header['magic'][0] != INDEX_MAGIC:
+            raise ValueError('%s is not an event index' % path)
+        count = (os.fstat(f.fileno()).st_size - INDEX_HEADER.itemsize) // INDEX_DTYPE.itemsize
+        entries = np.fromfile(f, INDEX_DTYPE, count)
+    return int(header['stride'][0]), entries
+
+
+def update_index(path, stride=256, maw_length=None):
+    ''' Index events of a data file: write offsets and timestamps of every `stride`-th event to `path`.idx,
+    or append the events written since the last update to it (then its stride is used).
+    Returns the number of entries.
+    '''
+    index_path = path + INDEX_EXT
+    count = 0
+    if os.path.exists(index_path) and os.path.getsize(index_path):
+        stride, entries = load_index(index_path)
+        count = len(entries)
+    else:
+        header = np.zeros(1, INDEX_HEADER)
+        header['magic'], header['stride'] = INDEX_MAGIC, stride
+        with open(index_path, 'wb') as out:
+            out.write(header.tobytes())
+    
+    with open(path, 'rb') as f, open(index_path, 'ab') as out:
+        out.truncate(INDEX_HEADER.itemsize + count * INDEX_DTYPE.itemsize) #a partly written entry
+        p = Parse(f)
+        if maw_length is not None:
+            p.MAW_LENGTH = maw_length
+        
+        first = 0
+        if count: #continue from the last entry
+            p._seek(int(entries[-1]['offset']))
+            first = (count - 1) * stride
+        
+        for events, offsets in p.iter_batches(offsets=True):
+            numbers = np.arange(first, first + len(events))
+            sel = (numbers % stride == 0) & (numbers >= count * stride)
+            new = np.empty(np.count_nonzero(sel), INDEX_DTYPE)
+            new['offset'] = offsets[sel]
+            new['ts'] = events['ts'][sel]
+            out.write(new.tobytes())
+            count += len(new)
+            first += len(events)
+    return count
+
+
+def fin(signal=None, frame=None, p=None):
     global nevents
     
     if signal == 2:
         sys.stderr.write('\nYou pressed Ctrl+C!\n')
 
     sys.stderr.write("%d events found\n" % nevents)
+    if p is not None and p.skipped:
+        sys.stderr.write("%d bytes skipped\n" % p.skipped)
     sys.exit(0)    
 
     
@@ -351,7 +999,7 @@ def main():
             help="print progress to stderr")
             
     parser.add_argument('--skip', type=int, default=0,
-            help='skip first N events')
+            help='skip first N events (quickly if there is an index, see index.py)')
     
     parser.add_argument('--stop', type=int, default=0,
             help='Stop after N events parsed')
@@ -388,9 +1036,12 @@ def main():
         sys.stderr.write("Err: %s \n" % e)
         exit(1)
     
-    signal.signal(signal.SIGINT, fin) #catch Ctrl+C
+    signal.signal(signal.SIGINT, lambda sig, frame: fin(sig, frame, p)) #catch Ctrl+C
     
     nevents = 0
+    if args.skip and args.infile != '-' and os.path.exists(args.infile + INDEX_EXT): #jump there
+        p.seek_event(args.skip)
+        nevents = args.skip
     
     outfile.write("# <timestamp> <channel> <min(data)> {<data[0..N]>-<min(data)>}\n") #format
     
@@ -419,7 +1070,7 @@ def main():
             for a in event._fields_:
                 print( "%s: %s" % ( a[0], getattr(event, a[0]) ) )
                 
-    fin()
+    fin(p=p)
     
 if __name__ == "__main__":
     main()
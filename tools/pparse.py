@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+''' Parse raw data files in parallel processes.
+
+Each file is split into pieces at event boundaries: frames of a framed file,
+entries of the event index (FILE.idx, see index.py) if there is one, or places found by scanning
+for a few back-to-back events. The pieces are decoded by a pool of processes and the results
+(histograms, event fields) are combined in the file order.
+'''
+import sys, os
+import argparse
+import multiprocessing
+from time import time
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+
+from parse import Parse, load_index, INDEX_EXT, framing
+
+VERIFY_EVENTS = 4 # back-to-back events of the same format which make a boundary found by scanning
+MIN_PIECE = 16 * 1024 * 1024 # [bytes], smaller pieces do not pay off the process round trip
+
+
+class Count(object):
+    ''' Count events. '''
+
+    def __call__(self, events):
+        return len(events)
+
+    @staticmethod
+    def combine(results):
+        return sum(results)
+
+
+class Histogram(object):
+    ''' A histogram of an event field, `bins` and `range` are as in numpy.histogram.
+    Events without the field are not counted.
+    '''
+
+    def __init__(self, field, bins=1000, range=None):
+        self.field = field
+        self.edges = np.histogram_bin_edges([], bins, range) if range else None
+
+    def __call__(self, events):
+        if self.edges is None:
+            raise ValueError('histogram range is not set')
+        if self.field not in events.dtype.names: #events of another format
+            return np.zeros(len(self.edges) - 1, np.int64)
+        return np.histogram(events[self.field], self.edges)[0]
+
+    @staticmethod
+    def combine(results):
+        return np.sum(results, axis=0)
+
+
+class Fields(object):
+    ''' Selected event fields as a structured array (e.g. ts, chan, peak). '''
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+
+    def __call__(self, events):
+        return repack_fields(events[self.fields])
+
+    @staticmethod
+    def combine(results):
+        return np.concatenate(results)
+
+
+def _parse(fileobj, maw_length=None):
+    p = Parse(fileobj)
+    if maw_length is not None:
+        p.MAW_LENGTH = maw_length
+    return p
+
+
+def find_boundary(p, offset):
+    ''' The offset of the first event at or after `offset`, which starts VERIFY_EVENTS events
+    of the same format in a row. Returns None if there are no such events.
+    '''
+    p._seek(offset)
+    for events, offsets in p.iter_batches(VERIFY_EVENTS, offsets=True):
+        if len(events) == VERIFY_EVENTS:
+            return int(offsets[0])
+    return None
+
+
+def split_file(path, count, maw_length=None):
+    ''' Split a file to up to `count` pieces of about the same size, which start with an event.
+    Returns [(start, end, frame), ...]: byte ranges, and the first frame of a piece of a framed file (None otherwise).
+    '''
+    size = os.path.getsize(path)
+    count = max(1, min(count, size // MIN_PIECE))
+    if not size:
+        return []
+
+    with open(path, 'rb') as f:
+        p = _parse(f, maw_length)
+        frames = p.frames()
+        if frames:
+            pieces = []
+            for first, last in framing.split(frames, count):
+                end = frames[last]['offset'] if last < len(frames) else size
+                pieces.append( (frames[first]['payload'], end, frames[first]) )
+            return pieces
+
+        nominal = [size * i // count for i in range(1, count)]
+        if os.path.exists(path + INDEX_EXT):
+            offsets = load_index(path + INDEX_EXT)[1]['offset']
+            k = np.searchsorted(offsets, nominal)
+            starts = [int(offsets[i]) for i in k if i < len(offsets)]
+        else:
+            starts = [find_boundary(p, offset) for offset in nominal]
+
+    starts = sorted(set([0] + [s for s in starts if s is not None]))
+    return [(start, end, None) for start, end in zip(starts, starts[1:] + [size])]
+
+
+def parse_piece(task):
+    ''' Decode events of a piece and apply `func` to each batch of them.
+    task: (path, start, end, frame, func, maw_length), see split_file.
+    Returns the combined results, or None if there are no events.
+    '''
+    path, start, end, frame, func, maw_length = task
+    results = []
+    with open(path, 'rb') as f:
+        p = _parse(f, maw_length)
+        if frame is not None:
+            p.seek_frame(frame)
+        else:
+            p._seek(start)
+
+        for events, offsets in p.iter_batches(offsets=True):
+            if offsets[0] >= end:
+                break
+            if offsets[-1] >= end: #the rest is of the next piece
+                events = events[:np.searchsorted(offsets, end)]
+            results.append(func(events))
+
+    return func.combine(results) if results else None
+
+
+def map_files(paths, func, processes=None, pieces=None, maw_length=None):
+    ''' Apply `func` to events of files `paths` in a pool of `processes` (all cores by default).
+    func: a picklable callable of a batch of events (see decode_buffer) with a `combine`
+        function of a list of its results (Count, Histogram, Fields).
+    pieces: per file, by default enough to keep all processes busy.
+    Returns a list of combined results of each file (None for files without events).
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    if pieces is None:
+        pieces = -(-2 * processes // len(paths)) # ceil
+
+    tasks, owners = [], []
+    for i, path in enumerate(paths):
+        for start, end, frame in split_file(path, pieces, maw_length):
+            tasks.append( (path, start, end, frame, func, maw_length) )
+            owners.append(i)
+
+    per_file = [[] for path in paths]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, result in zip(owners, pool.imap(parse_piece, tasks)): # in order
+            if result is not None:
+                per_file[i].append(result)
+    finally:
+        pool.terminate()
+
+    return [func.combine(results) if results else None for results in per_file]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('infile', nargs='+', type=str,
+            help='raw data files (chNN.dat of a run)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+            help='worker processes, all cores by default')
+    parser.add_argument('--pieces', type=int, default=None,
+            help='pieces per file')
+    parser.add_argument('--maw-length', type=int, default=None,
+            help='MAW length of the config, if the MAW test buffer is saved')
+    parser.add_argument('--hist', type=str, default=None, metavar='FIELD',
+            help='histogram of an event field (peak, e_max, maw_max, ...)')
+    parser.add_argument('--bins', type=int, default=1000)
+    parser.add_argument('--range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'),
+            help='histogram range (required with --hist)')
+    parser.add_argument('--fields', type=str, default=None,
+            help='comma separated event fields to save with --outfile (ts,chan,peak)')
+    parser.add_argument('--outfile', '-o', type=str, default=None,
+            help='a .npz file for histograms or fields (an array per input file)')
+    args = parser.parse_args()
+
+    if args.hist:
+        if not args.range:
+            parser.error('--hist needs --range')
+        func = Histogram(args.hist, args.bins, args.range)
+    elif args.fields:
+        func = Fields(args.fields.split(','))
+    else:
+        func = Count()
+
+    t_start = time()
+    results = map_files(args.infile, func, args.processes, args.pieces, args.maw_length)
+    elapsed = time() - t_start
+    size = sum(os.path.getsize(path) for path in args.infile)
+
+    for path, result in zip(args.infile, results):
+        if isinstance(func, Count):
+            print('%s: %d events' % (path, result or 0))
+        elif result is not None:
+            print('%s: %d %s' % (path, np.sum(result) if args.hist else len(result),
+                    'counts' if args.hist else 'events'))
+        else:
+            print('%s: no events' % path)
+    sys.stderr.write('%.1f MB in %.2f s, %.1f MB/s\n' % (size / 1e6, elapsed, size / 1e6 / elapsed))
+
+    if args.outfile and not isinstance(func, Count):
+        arrays = dict(('f%d' % i, r) for i, r in enumerate(results) if r is not None)
+        if args.hist:
+            arrays['edges'] = func.edges
+        np.savez(args.outfile, **arrays)
+
+
+if __name__ == '__main__':
+    main()
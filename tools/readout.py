@@ -7,7 +7,7 @@ Write raw (binary) data to files (one file per channel).
 
 import sys,os
 import argparse
-from time import sleep 
+from time import time
 import io
 from datetime import datetime
 
@@ -15,7 +15,14 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import sis3316
 
 
-def readout_loop(dev, destinations, opts = {}, quiet = False, print_stats = False ):
+CONGESTION = {
+    'aimd': sis3316.congestion.AIMD,
+    'fixed': sis3316.congestion.Fixed,
+    'rate': sis3316.congestion.RateRTT,
+    }
+
+
+def readout_loop(dev, destinations, opts = {}, quiet = False, print_stats = False, status = None, counters = None, stop = None ):
     """ Perform endless readout loop. 
     
         destinations: 
@@ -23,36 +30,130 @@ def readout_loop(dev, destinations, opts = {}, quiet = False, print_stats = Fals
         quiet:
             only errors in stderr
         print_stats:
-            print bytes per channel to stderr (ignores `quiet`)
+            print bytes per channel and link statistics to stderr (ignores `quiet`)
+        status:
+            a function, called with dev.link_stats() of each readout cycle
+        counters:
+            a sis3316.counters.RunCounters, updated every cycle and saved on exit
+        stop:
+            a function, checked while waiting for a bank swap. When it returns True, the loop 
+            toggles the banks and disarms, reads out both banks, closes the pool and returns total bytes.
+            Without it the loop ends on Ctrl-C only.
+        opts['concurrent']:
+            interleave FIFO transfers of different ADC groups (see Sis3316.readout_groups)
+        opts['pool']:
+            a sis3316.writer.BufferPool, files are written by its thread (closed on exit)
+        opts['framed']:
+            write each bank as a frame with a header and a CRC (see sis3316.framing)
+        opts['scheduler']:
+            a sis3316.scheduler.BankScheduler which decides when to swap banks
+            (one with a 1 s maximal latency and the configured addr_threshold by default)
+        opts['stop_timeout']:
+            seconds to read the last banks in after stop (10 by default), channels which would 
+            not fit at the last transfer rate are not read (counted as dropped_words)
     """
     total_bytes = 0
     human_bytes = ''
     units = ( ('GB',1024**3), ('MB', 1024**2), ('KB', 1024), ('Bytes', 1))
+    pool = opts.get('pool')
+    scheduler = opts.get('scheduler') or sis3316.scheduler.BankScheduler(dev)
+    stopping = False
+    out = ''
+    
+    def finish():
+        if pool:
+            pool.close()  # write what is queued
+        if counters and counters.path:
+            counters.save()
+    
+    read_rate = None  # bytes per second of the last bank read, to plan the last one
+    deadline = None  # to read the last banks by
+    chan = None  # the channel being read, errors outside a channel read are counted as shared
     
     while True:
         try:
-            dev.mem_toggle()
+            cycle_start = time()
+            chan = None
+            if stopping:
+                # the last cycle: toggle and disarm at once, then read the bank swapped out, 
+                # and the active one if its sample addresses are kept after disarm
+                banks = scheduler.swap(disarm=True)
+                snapshots = [banks]
+                if any(banks['addr_actual']):
+                    snapshots.append(dict(banks, prev_bank=banks['bank'], addr_prev=banks['addr_actual'],
+                        seq=banks['seq'] + 1))
+            else:
+                banks = scheduler.swap()  # toggle, then a single request for all channels
+                snapshots = [banks]
             recv_bytes = 0
-            stats = []
+            stats = dict((ch, 0) for ch, file_ in destinations)
+            groups = None
             out = ''
-            for ch, file_ in destinations:
-                bytes_ = 0
-                for ret in dev.readout_pipe(ch, file_, 0, opts ):  # per chunk
-                    bytes_ += ret['transfered'] * 4  # words -> bytes
+            for banks in snapshots:
+                todo, dropped = destinations, []
+                if deadline is not None:
+                    todo, dropped = fit_destinations(destinations, banks, read_rate, deadline - time())
+                for ch, words in dropped:
+                    sys.stderr.write('\nStop: no time left to read %d words of channel %02d\n' % (words, ch))
+                    if counters:
+                        counters.add(ch, 'dropped_words', words)
                 
-                stats.append( (ch, bytes_) )    
-                recv_bytes += bytes_
+                read_start = time()
+                read_bytes = 0
+                if opts.get('concurrent'):
+                    link = counters.link(dev) if counters else None
+                    groups = dev.readout_groups(todo, banks, pool, opts.get('framed'))
+                    for ch, file_ in todo:
+                        stats[ch] += groups['channels'].get(ch, 0) * 4  # words -> bytes
+                    read_bytes = groups['bytes']
+                    if counters:
+                        counters.add_link(None, link, counters.link(dev))
+                        for ch, file_ in todo:
+                            counters.add_bank(ch, groups['channels'].get(ch, 0), banks['addr_prev'][ch])
+                else:
+                    for chan, file_ in todo:
+                        bytes_ = 0
+                        link = counters.link(dev) if counters else None
+                        if banks['addr_prev'][chan]:  # skip empty channels
+                            for ret in dev.readout(chan, file_, 0, opts, banks=banks):  # per chunk
+                                bytes_ += ret['transfered'] * 4  # words -> bytes
+                        if counters:
+                            counters.add_link(chan, link, counters.link(dev))
+                            counters.add_bank(chan, bytes_ // 4, banks['addr_prev'][chan])
+                        
+                        stats[chan] += bytes_
+                        read_bytes += bytes_
+                    chan = None
+                
+                if read_bytes:
+                    read_rate = read_bytes / max(time() - read_start, 1e-6)
+                recv_bytes += read_bytes
+            
+            # check the bank was stable during the whole cycle (nothing swaps after disarm)
+            banks_after = dev.poll_banks() if not stopping else banks
+            if banks_after['bank'] != banks['bank'] or banks_after['addr_prev'] != banks['addr_prev']:
+                if counters:
+                    for ch, file_ in destinations:
+                        counters.add(ch, 'swaps_during_read')
+                raise dev._BankSwapDuringReadExcept
                 
 
             total_bytes += recv_bytes
+            link = dev.link_stats(since=cycle_start)
+            if status:
+                status(link)
             
             bytes_str = ''
             stats_str = ''
             
             if print_stats:
                 # bytes per channel
-                stats_str = 'chan         bytes\n' \
-                    + "\n".join( ["%02d\t%10d" % (ch,b) for ch,b in stats] )
+                stats_str = format_link_stats(link) + '\n' \
+                    + format_bank_stats(scheduler.stats()) + '\n' \
+                    + (format_group_stats(groups) + '\n' if groups else '') \
+                    + (format_pool_stats(pool) + '\n' if pool else '') \
+                    + 'chan         bytes\n' \
+                    + "\n".join( ["%02d\t%10d" % (ch,b) for ch,b in stats.items()] )
             
             if not quiet:
                 # human-readable total_bytes
@@ -68,16 +169,94 @@ def readout_loop(dev, destinations, opts = {}, quiet = False, print_stats = Fals
                 out = bytes_str + stats_str
                 sys.stderr.write(out + "\033[F" * out.count('\n') ) 
 
-            sleep(1)
+            if stopping:
+                break
+            # till the bank is full enough, the data gets old, or stop
+            stopping = scheduler.wait(stop) == 'stop'
+            if stopping:
+                deadline = time() + opts.get('stop_timeout', 10.)
             
         except KeyboardInterrupt:
             sys.stderr.write('\n' * out.count('\n') + "\nInterrupted.\n")
+            finish()
             exit(0)
             
+        except dev._BankSwapDuringReadExcept as e:
+            if counters and chan is not None:  # raised by readout() itself
+                counters.add(chan, 'swaps_during_read')
+            timestr = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            sys.stderr.write('\n%s Err: %s\n' % (timestr, e))
+            if stopping:
+                break  # the last bank is lost, do not wait for another one
+            if stop is not None and stop():  # scheduler.wait() is skipped
+                stopping = True
+                deadline = time() + opts.get('stop_timeout', 10.)
+            
         except Exception as e:
             # Ignore all exceptions and continue
+            if counters:
+                counters.add(chan, 'errors')
             timestr = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             sys.stderr.write('\n%s Err: %s\n' % (timestr, e))
+            if stopping:
+                break
+            if stop is not None and stop():  # a run which keeps failing can be stopped too
+                stopping = True
+                deadline = time() + opts.get('stop_timeout', 10.)
+    
+    sys.stderr.write('\n' * out.count('\n') + "\nStopped.\n")
+    finish()
+    return total_bytes
+
+
+def fit_destinations(destinations, banks, rate, time_left):
+    """ Destinations whose previous bank can be read in `time_left` seconds at `rate` bytes per second,
+        in order, and [(chan, words), ...] of the ones which can not. Everything fits if the rate is unknown.
+    """
+    if not rate:
+        return list(destinations), []
+    budget = max(time_left, 0.) * rate / 4  # words
+    todo, dropped = [], []
+    for ch, target in destinations:
+        words = banks['addr_prev'][ch]
+        if words <= budget:
+            todo.append( (ch, target) )
+            budget -= words
+        else:
+            dropped.append( (ch, words) )
+    return todo, dropped
+
+
+def format_link_stats(link):
+    """ A line about FIFO transfers (see Sis3316_udp.link_stats). """
+    if not link:
+        return 'link: idle'
+    rtt = '%.2f ms' % (link['rtt'] * 1e3) if link['rtt'] is not None else '-'
+    return 'link: %.1f MB/s (%d%% of the link), window %d words, rtt %s, loss %.2f%%      ' % (
+        link['rate'] / 1e6, link['utilization'] * 100, link['window'], rtt, link['loss'] * 100)
+
+
+def format_bank_stats(banks):
+    """ A line about bank swaps (see sis3316.scheduler.BankScheduler.stats). """
+    if not banks:
+        return 'banks: no swaps yet'
+    return 'banks: swap every %.2f s (%d%% by threshold), fill %.1f%% (max %.1f%%), dead time %.2f ms (%.3f%%)      ' % (
+        banks['interval'], banks['threshold'] * 100, banks['fill'] * 100, banks['fill_max'] * 100,
+        banks['dead_time'] * 1e3, banks['dead_fraction'] * 100)
+
+
+def format_pool_stats(pool):
+    """ A line about the writer thread buffers (see sis3316.writer.BufferPool). """
+    st = pool.stats
+    rate = st['bytes'] / st['write_time'] / 1e6 if st['write_time'] > 0 else 0.
+    return 'buffers: %d/%d queued (max %d), waited %d times %.2f s, disk %.1f MB/s, longest write %.0f ms      ' % (
+        st['queued'], pool.count, st['high_watermark'], st['waits'], st['wait_time'], rate, st['write_max'] * 1e3)
+
+
+def format_group_stats(groups):
+    """ A line about transfer rates per ADC group (see Sis3316.readout_groups). """
+    rates = ', '.join('g%d %.1f' % (grp, st['rate'] / 1e6) for grp, st in sorted(groups['groups'].items()))
+    return 'groups MB/s: %s, total %.1f      ' % (rates, groups['rate'] / 1e6)
 
         
 def makedirs(path):
@@ -92,7 +271,7 @@ def makedirs(path):
 def main():
     # Defaults
     chunksize = 1024*1024  # how many bytes to request at once
-    opts = {'chunk_size': chunksize/4 }
+    opts = {'chunk_size': chunksize//4 }
     OUTPATH = "data/raw-ch"
     OUTEXT = ".dat"
     PORT = 3333
@@ -134,6 +313,44 @@ def main():
         action='store_true',
         help="print statistics per channel (ignores --quiet)"
         )
+    parser.add_argument('--concurrent',
+        action='store_true',
+        help="read ADC groups concurrently (interleaved FIFO requests)"
+        )
+    parser.add_argument('--chunk',
+        type=lambda x: x if x == 'auto' else int(x),
+        default=opts['chunk_size'],
+        metavar='WORDS',
+        help="words to read per chunk, or 'auto' to tune it from the setup cost \n"\
+            "and the transfer rate, default is %d" % opts['chunk_size']
+        )
+    parser.add_argument('--max-latency',
+        type=float,
+        default=1.,
+        metavar='SECONDS',
+        help="swap banks at least this often, default is 1"
+        )
+    parser.add_argument('--threshold',
+        type=int,
+        metavar='WORDS',
+        help="swap banks when a channel has this many words (sets addr_threshold of all groups), \n"\
+            "the configured addr_threshold is used by default"
+        )
+    parser.add_argument('--buffers',
+        type=int,
+        default=32,
+        metavar='N',
+        help="4 MB buffers for a writer thread, 0 writes files in the readout loop, default is 32"
+        )
+    parser.add_argument('--framed',
+        action='store_true',
+        help="write each bank as a frame with a header and a CRC (tools/parse.py reads both formats)"
+        )
+    parser.add_argument('--congestion',
+        choices=['aimd', 'fixed', 'rate'],
+        default='aimd',
+        help="how to choose the amount of data per request, default is aimd"
+        )
     
             
     # Parse arguments
@@ -164,6 +381,12 @@ def main():
     # Prepare device
     host,port = args.host, args.port
     dev = sis3316.Sis3316_udp(host, port)
+    dev.congestion = CONGESTION[args.congestion]()
+    opts['concurrent'] = args.concurrent
+    opts['chunk_size'] = args.chunk
+    opts['framed'] = args.framed
+    if args.buffers:
+        opts['pool'] = sis3316.writer.BufferPool(args.buffers)
     dev.open()
     if not dev.configure():  # set channel numbers and so on.
         sys.stderr.write('Warning: After configure(), dev.status = false\n')
@@ -171,6 +394,7 @@ def main():
     dev.arm()
     dev.ts_clear()
     dev.mem_toggle()  # flush the device memory to not to read a large chunk of old data
+    opts['scheduler'] = sis3316.scheduler.BankScheduler(dev, args.threshold, args.max_latency)
 
     if not args.quiet:
         if 'jumbo_ena' in getattr(dev,'flags'):
@@ -186,7 +410,8 @@ def main():
 
     # Perform readout
     destinations = list(zip( get_iterable(channels), get_iterable(files_) ))  # Python3 has changed zip behavior, need to wrap in list()
-    readout_loop(dev, destinations, opts, quiet=args.quiet, print_stats=args.stats)
+    counters = sis3316.counters.RunCounters(channels, os.path.join(os.path.dirname(outpath), 'counters.txt'))
+    readout_loop(dev, destinations, opts, quiet=args.quiet, print_stats=args.stats, counters=counters)
 
 
 def get_iterable(x):
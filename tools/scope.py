@@ -72,7 +72,7 @@ class EventParser(Thread):
 
 	def run(self):
 		global args, events, hist
-		p = Parse(args.infile )
+		p = Parse(args.infile, follow=True)
 		data = None
 		
 		while True:
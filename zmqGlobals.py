@@ -6,3 +6,4 @@ PUSH_SOCKET = 5559      # Socket for zmq PUSH from server to status monitor
 OUTHEAD = 'ch' # sis3316 binary output filename starts with this
 OUTEXT = '.dat' # output extension name
 ATTR_FILE = 'attr.txt' # Run attribute file
+COUNTERS_FILE = 'counters.txt' # Readout counters per channel, written next to ATTR_FILE on stop